@@ -0,0 +1,394 @@
+"""
+Offline bulk scoring of exported feeds, without going through the HTTP API.
+
+    python -m app.bulk feed.csv scores.jsonl
+    python -m app.bulk feed.parquet scores.parquet --column image_url --keep post_id,account --batch-size 64
+
+Input: CSV, Parquet or JSONL with one URL or local path per row (--column, default the first of
+url / image_url / path that exists). Output: JSONL (one object per line) or Parquet (a
+directory of part-NNNNN.parquet files, read back with pandas.read_parquet(dir)). Each output row
+has the input row number, the kept input columns, final_prob and the other scores, and one
+<group>_<i>_{pos,neg,passed} column per prompt pair (positions as in GET /prompt_set).
+
+The pipeline: input is read in chunks. The next --prefetch batches download (concurrently,
+through the app's cache / retry / breaker path) while the current batch is decoded, encoded and
+scored by evaluate_fetched, i.e. the same rules and result cache as /evaluate. Results are
+appended as they are produced. After every durable write, progress goes to
+<output>.checkpoint.json, and rerunning the same command resumes after the last committed row
+(--restart starts over). Without a checkpoint, existing output is never overwritten unless
+--restart is given. Throughput and an ETA are logged every --report-every seconds.
+"""
+import argparse
+import json
+import logging
+import math
+import os
+import re
+import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Iterator, List, Optional
+
+import pandas as pd
+import pyarrow.parquet as pq
+
+from .clip_wrapper import fetch_images, load_clip_model
+from .logic import AGG_MODES, evaluate_fetched, prompt_set, rules_version, warm_text_bank
+
+logger = logging.getLogger(__name__)
+
+URL_COLUMNS = ("url", "image_url", "path")
+_PART_RE = re.compile(r"^part-(\d{5})\.parquet$")
+
+
+# ---------- input ----------
+
+def _format(path: str) -> str:
+    p = path.rstrip("/").lower()
+    if p.endswith((".csv", ".csv.gz")):
+        return "csv"
+    if p.endswith((".parquet", ".pq")) or os.path.isdir(path):
+        return "parquet"
+    if p.endswith((".jsonl", ".ndjson", ".jsonl.gz", ".json")):
+        return "jsonl"
+    raise ValueError(f"cannot tell the format of {path!r} (expected .csv, .parquet or .jsonl)")
+
+
+def _chunks(path: str, chunk_rows: int) -> Iterator[pd.DataFrame]:
+    fmt = _format(path)
+    if fmt == "csv":
+        yield from pd.read_csv(path, chunksize=chunk_rows)
+    elif fmt == "jsonl":
+        yield from pd.read_json(path, lines=True, chunksize=chunk_rows)
+    else:
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_rows):
+            yield batch.to_pandas()
+
+
+def count_rows(path: str) -> Optional[int]:
+    """Row count from Parquet metadata; None for CSV / JSONL (not worth a pass over the file)."""
+    if _format(path) != "parquet" or os.path.isdir(path):
+        return None
+    return pq.ParquetFile(path).metadata.num_rows
+
+
+def read_rows(path: str, column: Optional[str] = None, keep: List[str] = (),
+              batch_size: int = 32, skip: int = 0) -> Iterator[pd.DataFrame]:
+    """Batches with columns row, url and `keep`; the first `skip` input rows are dropped."""
+    row = 0
+    pending = []
+    for chunk in _chunks(path, max(batch_size, 4096)):
+        if column is None:
+            column = next((c for c in URL_COLUMNS if c in chunk.columns), None)
+            if column is None:
+                raise ValueError(f"no URL column in {path}; pass --column (have {list(chunk.columns)})")
+        missing = [c for c in [column, *keep] if c not in chunk.columns]
+        if missing:
+            raise ValueError(f"{path} has no column(s) {missing}")
+        n = len(chunk)
+        if row + n <= skip:
+            row += n
+            continue
+        chunk = chunk.iloc[max(0, skip - row):]
+        out = pd.DataFrame({"row": range(max(row, skip), row + n),
+                            "url": ["" if pd.isna(u) else str(u) for u in chunk[column]]})
+        for c in keep:
+            out[c] = chunk[c].to_numpy()
+        row += n
+        pending.append(out)
+        buffered = pd.concat(pending, ignore_index=True) if len(pending) > 1 else pending[0]
+        pending = []
+        for start in range(0, len(buffered) - batch_size + 1, batch_size):
+            yield buffered.iloc[start:start + batch_size]
+        rest = len(buffered) % batch_size
+        if rest:
+            pending = [buffered.iloc[len(buffered) - rest:]]
+    if pending:
+        yield pending[0]
+
+
+# ---------- output rows ----------
+
+@lru_cache(maxsize=1)
+def _pair_counts() -> tuple:
+    """(group, number of pairs) for every group: all pairs get columns, so every row has one schema."""
+    return tuple((group, len(pairs)) for group, pairs in prompt_set()["pairs"].items())
+
+
+def _clean(v):
+    """NaN / numpy scalars -> JSON-friendly Python values (kept input columns may carry either)."""
+    if hasattr(v, "item"):
+        v = v.item()
+    if isinstance(v, float) and math.isnan(v):
+        return None
+    return v
+
+
+def flatten(result: dict, row: int, extra: dict, fetch_error=None) -> dict:
+    """One output row from a detail="scores" result."""
+    gate = result.get("gate") or {}
+    out = {
+        "row": row,
+        **{k: _clean(v) for k, v in extra.items()},
+        "url": result["url"],
+        "final_prob": result["final_prob"],
+        "clothing_value": result.get("clothing_value"),
+        "ff_value": result.get("ff_value"),
+        "be_value": result.get("be_value"),
+        "votes": result.get("votes"),
+        "gate_female": gate.get("female"),
+        "gate_person": gate.get("person"),
+        "gate_passed": gate.get("passed"),
+        "error": result.get("error") if fetch_error is None else f"{result.get('error')}: {fetch_error}",
+        "prompt_set": result.get("prompt_set"),
+    }
+    pairs = result.get("pairs") or {}
+    for group, n in _pair_counts():
+        scored = pairs.get(group) or []
+        for i in range(n):
+            pos, neg, passed = scored[i] if i < len(scored) else (None, None, None)
+            out[f"{group}_{i}_pos"], out[f"{group}_{i}_neg"], out[f"{group}_{i}_passed"] = pos, neg, passed
+    return out
+
+
+# ---------- writers ----------
+# A writer appends rows and reports when they are durable; the checkpoint only moves then.
+
+class JsonlWriter:
+    """Appends lines; every write is fsynced, and resume truncates back to the checkpointed size.
+
+    Without a checkpoint, a non-empty output is only overwritten when overwrite is set.
+    """
+
+    def __init__(self, path: str, state: Optional[dict] = None, overwrite: bool = False):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        if state is None and not overwrite and os.path.exists(path) and os.path.getsize(path):
+            raise FileExistsError(f"{path} is not empty and has no checkpoint to resume from; "
+                                  f"use --restart to overwrite it")
+        if state is not None and not overwrite:
+            size = os.path.getsize(path) if os.path.exists(path) else 0
+            if size < state["bytes"]:
+                raise FileExistsError(f"{path} has {size} bytes but the checkpoint recorded {state['bytes']}; "
+                                      f"it was truncated or replaced, use --restart to start over")
+        self._f = open(path, "ab")
+        if state is not None or overwrite:
+            self._f.truncate((state or {}).get("bytes", 0))   # drop rows after the checkpoint
+        self._f.seek(0, os.SEEK_END)
+
+    def write(self, rows: List[dict]) -> bool:
+        self._f.write("".join(json.dumps(r, ensure_ascii=False) + "\n" for r in rows).encode("utf-8"))
+        self._f.flush()
+        os.fsync(self._f.fileno())
+        return True
+
+    def state(self) -> dict:
+        return {"bytes": self._f.tell()}
+
+    def close(self) -> bool:
+        self._f.close()
+        return False
+
+
+class ParquetWriter:
+    """Buffers rows and writes them as part-NNNNN.parquet files of part_rows rows (via pandas).
+
+    Other files in the directory are left alone; existing parts without a checkpoint are only
+    overwritten when overwrite is set.
+    """
+
+    def __init__(self, path: str, state: Optional[dict] = None, part_rows: int = 10_000,
+                 overwrite: bool = False):
+        self.path = path
+        self.part_rows = part_rows
+        self.parts = (state or {}).get("parts", 0)
+        self._rows: List[dict] = []
+        os.makedirs(path, exist_ok=True)
+        parts = [(int(m.group(1)), name) for name in os.listdir(path) for m in [_PART_RE.match(name)] if m]
+        if state is None and parts and not overwrite:
+            raise FileExistsError(f"{path} already has part files and no checkpoint to resume from; "
+                                  f"use --restart to overwrite them")
+        for n, name in parts:   # parts written after the last checkpoint
+            if n >= self.parts:
+                os.remove(os.path.join(path, name))
+
+    def _flush(self) -> None:
+        tmp = os.path.join(self.path, f".part-{self.parts:05d}.parquet.tmp")
+        pd.DataFrame(self._rows).to_parquet(tmp, index=False)
+        os.replace(tmp, os.path.join(self.path, f"part-{self.parts:05d}.parquet"))
+        self.parts += 1
+        self._rows = []
+
+    def write(self, rows: List[dict]) -> bool:
+        self._rows.extend(rows)
+        if len(self._rows) < self.part_rows:
+            return False
+        self._flush()
+        return True
+
+    def state(self) -> dict:
+        return {"parts": self.parts}
+
+    def close(self) -> bool:
+        if not self._rows:
+            return False
+        self._flush()
+        return True
+
+
+def _writer(path: str, state: Optional[dict], part_rows: int, overwrite: bool = False):
+    if _format(path) == "parquet":
+        return ParquetWriter(path, state, part_rows, overwrite)
+    if _format(path) == "jsonl":
+        return JsonlWriter(path, state, overwrite)
+    raise ValueError("output must be .jsonl or .parquet")
+
+
+# ---------- checkpoint ----------
+
+def _load_checkpoint(path: str, expect: dict) -> Optional[dict]:
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        ckpt = json.load(f)
+    changed = {k: (ckpt["run"].get(k), v) for k, v in expect.items() if ckpt["run"].get(k) != v}
+    if changed:
+        raise SystemExit(f"{path} belongs to a different run ({changed}); use --restart to start over")
+    return ckpt
+
+
+def _save_checkpoint(path: str, ckpt: dict) -> None:
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(ckpt, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+# ---------- progress ----------
+
+class Progress:
+    def __init__(self, total: Optional[int], done: int, every_s: float):
+        self.total, self.start_done, self.done = total, done, done
+        self.errors = self.passed = 0
+        self.every_s = every_s
+        self.start = self._last_t = time.monotonic()
+        self._last_done = done
+
+    def update(self, rows: List[dict]) -> None:
+        self.done += len(rows)
+        self.errors += sum(1 for r in rows if r["error"])
+        self.passed += sum(1 for r in rows if r["gate_passed"])
+        now = time.monotonic()
+        if now - self._last_t >= self.every_s:
+            self.log(now)
+
+    def rate(self) -> float:
+        return (self.done - self.start_done) / max(time.monotonic() - self.start, 1e-9)
+
+    def log(self, now: Optional[float] = None) -> None:
+        now = now or time.monotonic()
+        recent = (self.done - self._last_done) / max(now - self._last_t, 1e-9)
+        msg = f"{self.done}" + (f"/{self.total}" if self.total else "") + \
+              f" rows  {self.rate():.1f} rows/s (last {recent:.1f})  errors {self.errors}  gate passed {self.passed}"
+        if self.total and self.rate() > 0:
+            msg += f"  eta {(self.total - self.done) / self.rate():.0f}s"
+        logger.info(msg)
+        self._last_t, self._last_done = now, self.done
+
+
+# ---------- run ----------
+
+def run(input_path: str, output_path: str, column: Optional[str] = None, keep: List[str] = (),
+        batch_size: int = 32, prefetch: int = 2, timeout: int = 30, part_rows: int = 10_000,
+        agg: str = "weighted_pos", weight_key: str = "diff", fast: bool = True, k: int = 4,
+        restart: bool = False, report_every_s: float = 10.0, model_bundle=None) -> dict:
+    """Score every row of input_path into output_path; returns a summary. model_bundle: (model, preprocess, device)."""
+    ckpt_path = output_path.rstrip("/") + ".checkpoint.json"
+    run_info = {"input": os.path.abspath(input_path), "column": column, "keep": list(keep),
+                "agg": agg, "weight_key": weight_key, "fast": fast, "k": k, "prompt_set": rules_version()}
+    if restart and os.path.exists(ckpt_path):
+        os.remove(ckpt_path)
+    ckpt = _load_checkpoint(ckpt_path, run_info) or {"run": run_info, "rows_done": 0, "writer": None}
+    try:
+        writer = _writer(output_path, ckpt["writer"], part_rows, overwrite=restart)
+    except FileExistsError as e:
+        raise SystemExit(str(e))
+    if ckpt["rows_done"]:
+        logger.info(f"Resuming {input_path} after row {ckpt['rows_done']}")
+
+    model, preprocess, device = model_bundle or load_clip_model()
+    warm_text_bank(model, device)
+    progress = Progress(count_rows(input_path), ckpt["rows_done"], report_every_s)
+    opts = dict(agg=agg, weight_key=weight_key, fast=fast, k=k, detail="scores")
+
+    def fetch(batch: pd.DataFrame):
+        urls = batch["url"].tolist()
+        return fetch_images(urls, timeout=timeout, deadline=time.monotonic() + timeout)
+
+    batches = read_rows(input_path, column, keep, batch_size, skip=ckpt["rows_done"])
+    in_flight = deque()
+    with ThreadPoolExecutor(max_workers=max(1, prefetch), thread_name_prefix="bulk-fetch") as pool:
+        def submit_next() -> None:
+            batch = next(batches, None)
+            if batch is not None:
+                in_flight.append((batch, pool.submit(fetch, batch)))
+
+        for _ in range(max(1, prefetch)):
+            submit_next()
+        while in_flight:
+            batch, fut = in_flight.popleft()
+            fetched = fut.result()
+            submit_next()   # keep the downloads ahead of the encoder
+            urls = batch["url"].tolist()
+            results = evaluate_fetched(urls, fetched, model, preprocess, device, **opts)
+            extras = batch[list(keep)].to_dict("records") if keep else [{}] * len(batch)
+            rows = [flatten(r, int(n), x, f if isinstance(f, Exception) else None)
+                    for r, n, x, f in zip(results, batch["row"], extras, fetched)]
+            if writer.write(rows):
+                ckpt.update(rows_done=int(batch["row"].iloc[-1]) + 1, writer=writer.state())
+                _save_checkpoint(ckpt_path, ckpt)
+            progress.update(rows)
+    if writer.close():
+        ckpt.update(rows_done=progress.done, writer=writer.state())
+        _save_checkpoint(ckpt_path, ckpt)
+    progress.log()
+    return {"input": input_path, "output": output_path, "rows": progress.done,
+            "rows_this_run": progress.done - progress.start_done, "errors": progress.errors,
+            "gate_passed": progress.passed, "rows_per_s": round(progress.rate(), 2),
+            "elapsed_s": round(time.monotonic() - progress.start, 1)}
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(prog="python -m app.bulk", description=__doc__.strip().splitlines()[0])
+    ap.add_argument("input", help=".csv, .parquet or .jsonl with one image URL / local path per row")
+    ap.add_argument("output", help=".jsonl file or .parquet directory")
+    ap.add_argument("--column", help=f"URL column (default: first of {', '.join(URL_COLUMNS)})")
+    ap.add_argument("--keep", default="", help="comma-separated input columns copied to the output")
+    ap.add_argument("--batch-size", type=int, default=32, help="images scored per step")
+    ap.add_argument("--prefetch", type=int, default=2, help="batches downloading ahead of the encoder")
+    ap.add_argument("--timeout", type=int, default=30, help="download deadline per batch, seconds")
+    ap.add_argument("--part-rows", type=int, default=10_000, help="rows per Parquet part (checkpoint interval)")
+    ap.add_argument("--agg", default="weighted_pos", choices=AGG_MODES)
+    ap.add_argument("--weight-key", default="diff")
+    ap.add_argument("--no-fast", dest="fast", action="store_false", help="use every gate pair, not the first k")
+    ap.add_argument("--k", type=int, default=4)
+    ap.add_argument("--restart", action="store_true",
+                    help="ignore the checkpoint and start over, overwriting existing output")
+    ap.add_argument("--report-every", type=float, default=10.0, help="seconds between progress lines")
+    args = ap.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="[%(levelname)s] %(asctime)s %(message)s")
+    summary = run(args.input, args.output, args.column, [c for c in args.keep.split(",") if c],
+                  batch_size=args.batch_size, prefetch=args.prefetch, timeout=args.timeout,
+                  part_rows=args.part_rows, agg=args.agg, weight_key=args.weight_key, fast=args.fast,
+                  k=args.k, restart=args.restart, report_every_s=args.report_every)
+    print(json.dumps(summary, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,31 +1,59 @@
+import asyncio
+import atexit
+import functools
 import logging
+import numpy as np
 import torch
 import clip
+from clip.clip import _transform   # not public API: CLIP is pinned to a rev in pyproject.toml
+from clip.model import build_model
 from PIL import Image
 import requests
-from io import BytesIO
 import time
 import os
 import io
 import hashlib
+import email.utils
+import mmap
 from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
-from typing import List, Dict
+import threading
+from collections import OrderedDict
+from urllib.parse import urlsplit
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Dict, NamedTuple, Optional, Tuple
 from contextlib import nullcontext
 
+from .decode_pool import DecodePool, reduce_image
+from .feature_cache import NpyStore
+from .image_cache import DiskImageCache
+from .netguard import PERMANENT_STATUSES, CircuitBreaker, NegativeCache, PermanentFetchError
+from .singleflight import SingleFlight
+from .stages import STAGES
+from .url_keys import DedupStats, canonical_key
+from .config import (BREAKER_COOLDOWN_S, BREAKER_THRESHOLD, CPU_BACKEND, DECODE_PROCESSES, DECODE_QUEUE_DEPTH, EMBED_CACHE_DIR, EMBED_CACHE_MAX_BYTES,
+                     ENCODE_TIMEOUT_S,
+                     HTTP_POOL_HOSTS, HTTP_POOL_SIZE,
+                     IMAGE_CACHE_DIR, IMAGE_CACHE_MAX_BYTES, INFER_WORKERS, IO_WORKERS,
+                     FAST_DECODE, MODEL_WEIGHTS_PATH, NEGATIVE_CACHE_TTL_S, PIXEL_CACHE_DIR, PIXEL_CACHE_MAX_BYTES)
+
 logger = logging.getLogger(__name__)
 
+MODEL_NAME = "ViT-B/32"
+TEXT_CACHE_DIR = ".cache/text"
+TEXT_LRU_SIZE = 1024   # ad-hoc prompts (e.g. /analyze) kept beyond the fixed bank
+ENCODE_BATCH_SIZE = 16 # images per image-tower forward
+
 # ----------------------- download -----------------------
 
-def _http_session():
-    """Returns a requests.Session with retry logic and User-Agent."""
-    retry = Retry(
-        total=3,              
-        backoff_factor=0.6,    
-        status_forcelist=[429, 500, 502, 503, 504],
-        allowed_methods=["GET", "HEAD"],
-        raise_on_status=False,
-    )
+_SESSION = None
+_SESSION_LOCK = threading.Lock()
+
+def _build_http_session():
+    """
+    Returns a requests.Session with User-Agent and a keep-alive connection pool.
+    Retries are done by _download, which can stop them at the request deadline.
+    """
     s = requests.Session()
     s.headers.update({
         "User-Agent": ("Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
@@ -33,59 +61,215 @@ def _http_session():
                        "Chrome/120.0.0.0 Safari/537.36"),
         "Accept": "image/avif,image/webp,image/apng,image/*,*/*;q=0.8",
     })
-    s.mount("http://", HTTPAdapter(max_retries=retry))
-    s.mount("https://", HTTPAdapter(max_retries=retry))
+    adapter = HTTPAdapter(max_retries=0,
+                          pool_connections=HTTP_POOL_HOSTS,
+                          pool_maxsize=HTTP_POOL_SIZE,
+                          pool_block=True)   # cap connections per host instead of opening throwaway ones
+    s.mount("http://", adapter)
+    s.mount("https://", adapter)
     return s
 
-def _cache_path_for_url(url: str, cache_dir: str = ".cache/images") -> str:
-    os.makedirs(cache_dir, exist_ok=True)
-    h = hashlib.sha1(url.encode("utf-8")).hexdigest()[:20]
-    return os.path.join(cache_dir, f"{h}.img")
+def _http_session():
+    """Process-wide shared session, so CDN connections (TCP+TLS) are reused across downloads."""
+    global _SESSION
+    if _SESSION is None:
+        with _SESSION_LOCK:
+            if _SESSION is None:
+                _SESSION = _build_http_session()
+    return _SESSION
+
+_IO_POOL = None
+
+def _io_pool() -> ThreadPoolExecutor:
+    """Bounded pool shared by all requests for download + decode + preprocess."""
+    global _IO_POOL
+    if _IO_POOL is None:
+        with _SESSION_LOCK:
+            if _IO_POOL is None:
+                _IO_POOL = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix="image-io")
+    return _IO_POOL
+
+_INFER_POOL = None
+
+def _infer_pool() -> ThreadPoolExecutor:
+    """Dedicated pool for torch work called from async endpoints; sized apart from I/O threads."""
+    global _INFER_POOL
+    if _INFER_POOL is None:
+        with _SESSION_LOCK:
+            if _INFER_POOL is None:
+                _INFER_POOL = ThreadPoolExecutor(max_workers=INFER_WORKERS, thread_name_prefix="clip-infer")
+    return _INFER_POOL
+
+async def run_in_inference_pool(fn, *args, **kwargs):
+    """Await a CPU-bound call on the inference pool without blocking the event loop."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_infer_pool(), functools.partial(fn, *args, **kwargs))
+
+_DEDUP = DedupStats()
 
-def _load_image_with_cache(url: str, timeout_read: int = 20,
-                           cache_dir: str = ".cache/images") -> Image.Image:
+def dedup_stats() -> dict:
+    return _DEDUP.stats()
+
+_IMAGE_CACHES: Dict[str, DiskImageCache] = {}
+_IMAGE_CACHES_LOCK = threading.Lock()
+
+def _image_cache(cache_dir: str = IMAGE_CACHE_DIR) -> DiskImageCache:
+    """Shared size-bounded disk cache for one directory (index is built once per process)."""
+    cache = _IMAGE_CACHES.get(cache_dir)
+    if cache is None:
+        with _IMAGE_CACHES_LOCK:
+            cache = _IMAGE_CACHES.get(cache_dir)
+            if cache is None:
+                cache = DiskImageCache(cache_dir, max_bytes=IMAGE_CACHE_MAX_BYTES)
+                _IMAGE_CACHES[cache_dir] = cache
+    return cache
+
+def image_cache_stats() -> dict:
+    return _image_cache().stats()
+
+class FetchedImage(NamedTuple):
+    url: str
+    data: bytes         # raw bytes, or a read-only mmap for disk cache hits
+    content_hash: str   # sha1 of the bytes: identity of the image regardless of URL
+    path: Optional[str] = None   # file holding the bytes (local input or cache blob), if any
+
+_NEGATIVE = NegativeCache(ttl_s=NEGATIVE_CACHE_TTL_S)
+_BREAKER = CircuitBreaker(threshold=BREAKER_THRESHOLD, cooldown_s=BREAKER_COOLDOWN_S)
+_RETRY_STATUSES = {429, 500, 502, 503, 504}
+_RETRY_AFTER_STATUSES = {429, 503}   # the ones urllib3's Retry honored Retry-After for
+_RETRIES = 3
+_BACKOFF_S = 0.6
+
+def netguard_stats() -> dict:
+    return {"negative_cache": _NEGATIVE.stats(), "circuit_breaker": _BREAKER.stats()}
+
+def _read_body(resp, deadline) -> bytes:
+    """Stream the body, giving up once the request deadline has passed (slow-drip responses)."""
+    chunks = []
+    for chunk in resp.iter_content(chunk_size=64 * 1024):
+        chunks.append(chunk)
+        if deadline is not None and time.monotonic() > deadline:
+            resp.close()
+            raise TimeoutError("image deadline exceeded")
+    return b"".join(chunks)
+
+def _retry_after(resp) -> Optional[float]:
+    """Seconds asked for by a Retry-After header (delta-seconds or HTTP-date); None if absent or invalid."""
+    value = resp.headers.get("Retry-After", "").strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+def _download(url: str, timeout_read: int, deadline=None) -> bytes:
     """
-    Check the local cache first; if missing, download (with retries, User-Agent, and Referer) and write to cache.
-    - Connect timeout fixed at 5 seconds; read timeout controlled by timeout_read.
-    - Supports local file paths or file://.
+    GET with Referer, deadline-aware retries (429/5xx/connection errors, exponential backoff or the
+    server's Retry-After on 429/503), the negative cache for permanent failures and the per-host
+    circuit breaker. Connect/read timeouts are capped by what is left of the download deadline;
+    a retry that would have to wait past it fails at once.
     """
-    if url.startswith("file://") or os.path.exists(url):
-        path = url.replace("file://", "")
-        return Image.open(path).convert("RGB")
-
-    cache_path = _cache_path_for_url(url, cache_dir)
-    if os.path.exists(cache_path):
-        with open(cache_path, "rb") as f:
-            return Image.open(io.BytesIO(f.read())).convert("RGB")
+    status = _NEGATIVE.get(url)
+    if status is not None:
+        raise PermanentFetchError(status, url, cached=True)
+    host = urlsplit(url).hostname or ""
+    _BREAKER.before(host)
 
     # avoid Referer
     try:
-        host = url.split("/")[2]
-        referer = f"https://{host}"
+        referer = f"https://{url.split('/')[2]}"
     except Exception:
         referer = ""
 
     sess = _http_session()
-    try:
-        resp = sess.get(
-            url,
-            timeout=(5, max(8, int(timeout_read))),  # (connect, read)
-            stream=True,
-            headers={"Referer": referer} if referer else None,
-        )
-        resp.raise_for_status()
-        data = resp.content
-    except Exception as e:
-        raise
+    attempt = 0
+    while True:
+        budget = _remaining(deadline)
+        if budget is not None and budget <= 0:
+            raise TimeoutError("image deadline exceeded")
+        read_timeout = max(8, int(timeout_read)) if budget is None else min(max(8, int(timeout_read)), budget)
+        connect_timeout = 5 if budget is None else min(5, budget)
+        wait = None
+        try:
+            resp = sess.get(
+                url,
+                timeout=(connect_timeout, read_timeout),
+                stream=True,
+                headers={"Referer": referer} if referer else None,
+            )
+            if resp.status_code in PERMANENT_STATUSES:
+                resp.close()
+                _BREAKER.success(host)   # the host answered; only this URL is dead
+                _NEGATIVE.put(url, resp.status_code)
+                raise PermanentFetchError(resp.status_code, url)
+            if resp.status_code not in _RETRY_STATUSES:
+                resp.raise_for_status()
+                data = _read_body(resp, deadline)
+                _BREAKER.success(host)
+                return data
+            if resp.status_code in _RETRY_AFTER_STATUSES:
+                wait = _retry_after(resp)
+            error = requests.HTTPError(f"{resp.status_code} Server Error for url: {url}", response=resp)
+            resp.close()
+        except (requests.ConnectionError, requests.Timeout) as e:
+            error = e
+        except requests.HTTPError:
+            _BREAKER.success(host)
+            raise
+
+        attempt += 1
+        backoff = _BACKOFF_S * (2 ** (attempt - 1)) if wait is None else wait
+        if attempt > _RETRIES or (deadline is not None and time.monotonic() + backoff >= deadline):
+            _BREAKER.failure(host)
+            raise error
+        time.sleep(backoff)
+
+def _fetch_cached(url: str, timeout_read: int = 20,
+                  cache_dir: str = IMAGE_CACHE_DIR, deadline=None) -> FetchedImage:
+    """
+    Check the local cache first; if missing, download (see _download) and write to cache.
+    - Connect timeout 5 seconds, read timeout from timeout_read; both capped by the deadline.
+    - Supports local file paths or file://.
+    - Cache entries are keyed by the canonical URL and stored once per content hash.
+    """
+    if url.startswith("file://") or os.path.exists(url):
+        path = url.replace("file://", "")
+        with open(path, "rb") as f:
+            data = f.read()
+        return FetchedImage(url, data, hashlib.sha1(data).hexdigest(), path)
+
+    key = canonical_key(url)
+    _DEDUP.seen_url(url, key)
+    cache = _image_cache(cache_dir)
+    hit = cache.get(key)
+    if hit is not None:
+        _DEDUP.cache_hit(len(hit.data))
+        return FetchedImage(url, hit.data, hit.content_hash, hit.path)
+
+    with STAGES.timed("download"):
+        data = _download(url, timeout_read, deadline)
 
     # cache
+    content_hash = hashlib.sha1(data).hexdigest()
+    duplicate = False
     try:
-        with open(cache_path, "wb") as f:
-            f.write(data)
-    except Exception:
-        pass
+        duplicate = cache.put(key, data, content_hash)
+    except Exception as e:
+        logger.warning(f"Image cache write failed for {url}: {e}")
+    _DEDUP.downloaded(len(data), duplicate)
+
+    return FetchedImage(url, data, content_hash)
 
-    return Image.open(io.BytesIO(data)).convert("RGB")
+def _open_image(data) -> Image.Image:
+    """PIL image over raw bytes or a cached mmap (read in place, no copy)."""
+    if isinstance(data, mmap.mmap):
+        data.seek(0)
+        return Image.open(data)
+    return Image.open(io.BytesIO(data))
 
 
 # ----------------------- accumulation tool -----------------------
@@ -127,20 +311,716 @@ def _amp_ctx_for(device):
         return torch.cuda.amp.autocast(dtype=torch.float16)
     return nullcontext()
 
+def _image_amp_ctx(model, device):
+    """_amp_ctx_for, plus bfloat16 autocast for the image tower of a CPU_BACKEND=bf16 model."""
+    if getattr(model, "cpu_backend", "fp32") == "bf16" and not (hasattr(device, "type") and device.type == "cuda"):
+        return torch.autocast("cpu", dtype=torch.bfloat16)
+    return _amp_ctx_for(device)
+
 # ----------------------- CLIP -----------------------
 
-def load_clip_model(device=None):
+def load_clip_model(device=None, weights_path: str = MODEL_WEIGHTS_PATH, backend: str = CPU_BACKEND):
     """
     load CLIP model
+    backend: image-tower CPU backend, see apply_cpu_backend (ignored on CUDA).
+    weights_path: local TorchScript archive or state dict (see save_model_snapshot) used instead of
+    MODEL_NAME, which skips clip's download check (a SHA256 over the whole checkpoint) on every start.
     """
     if device is None:
         device = "cuda" if torch.cuda.is_available() else "cpu"
-    model, preprocess = clip.load("ViT-B/32", device=device)
+    if weights_path:
+        model, preprocess = _load_local_weights(weights_path, device)
+    else:
+        model, preprocess = clip.load(MODEL_NAME, device=device)
+    model.weights_id = weights_id(weights_path)
     if str(device).startswith("cuda") or (hasattr(device, "type") and device.type == "cuda"):
         model.half()
+        backend = "fp32"   # CPU backends only; CUDA keeps its fp16 path
     model.eval()
+    model.cpu_backend = apply_cpu_backend(model, backend)
     return model, preprocess, device
 
+def weights_id(weights_path: str = "") -> str:
+    """
+    Identity of the loaded weights for cache keys: MODEL_NAME, or MODEL_NAME@<hash of the path, size
+    and mtime> for a local weights file (hashing the file itself is the check weights_path skips).
+    """
+    if not weights_path:
+        return MODEL_NAME
+    st = os.stat(weights_path)
+    key = f"{os.path.abspath(weights_path)}|{st.st_size}|{st.st_mtime_ns}"
+    return f"{MODEL_NAME}@{hashlib.sha1(key.encode('utf-8')).hexdigest()[:12]}"
+
+# ----------------------- CPU inference backends -----------------------
+# Only the image tower is swapped: text features are computed once per prompt set (and cached on
+# disk by weights_id), so they stay fp32 and the prompt bank is shared by every backend.
+
+CPU_BACKENDS = ("fp32", "int8", "bf16", "traced")
+
+def bf16_supported() -> bool:
+    """Native bfloat16 matmul on this CPU (AVX512-BF16 / AMX); emulated bf16 is slower than fp32."""
+    try:
+        return bool(torch.ops.mkldnn._is_mkldnn_bf16_supported())
+    except (AttributeError, RuntimeError):
+        return False
+
+def _traced_image_encoder(model):
+    """encode_image replacement: channels-last input through a traced + frozen copy of the image tower."""
+    res = model.visual.input_resolution
+    visual = model.visual.to(memory_format=torch.channels_last)
+    example = torch.zeros((2, 3, res, res)).contiguous(memory_format=torch.channels_last)
+    with torch.no_grad():
+        traced = torch.jit.freeze(torch.jit.trace(visual, example, check_trace=False).eval())
+
+    def encode_image(image):
+        return traced(image.float().contiguous(memory_format=torch.channels_last))
+    return encode_image
+
+def apply_cpu_backend(model, backend: str) -> str:
+    """
+    Switch the image tower of a CPU fp32 model to `backend`; returns the backend actually in use.
+      fp32:   eager (default)
+      int8:   dynamic int8 quantization of the transformer's Linear layers (weights int8, activations
+              quantized per batch)
+      bf16:   bfloat16 autocast around encode_image; falls back to fp32 without native CPU support
+      traced: TorchScript trace + freeze (constant folding, fused ops) with channels-last input
+    """
+    if backend not in CPU_BACKENDS:
+        raise ValueError(f"CPU_BACKEND must be one of {CPU_BACKENDS}, got {backend!r}")
+    if backend == "int8":
+        model.visual = torch.ao.quantization.quantize_dynamic(model.visual, {torch.nn.Linear}, dtype=torch.qint8)
+    elif backend == "bf16" and not bf16_supported():
+        logger.warning("CPU_BACKEND=bf16 but this CPU has no native bfloat16 support, using fp32")
+        return "fp32"
+    elif backend == "traced":
+        model.encode_image = _traced_image_encoder(model)
+    return backend
+
+def _load_local_weights(path: str, device):
+    """clip.load(jit=False) for a local file (clip.load itself does not rewind after the TorchScript probe)."""
+    if not os.path.isfile(path):
+        raise FileNotFoundError(f"MODEL_WEIGHTS_PATH not found: {path}")
+    try:
+        state_dict = torch.jit.load(path, map_location="cpu").state_dict()
+    except RuntimeError:
+        state_dict = torch.load(path, map_location="cpu")
+    model = build_model(state_dict).to(device)
+    if str(device) == "cpu":
+        model.float()
+    return model, _transform(model.visual.input_resolution)
+
+def save_model_snapshot(path: str) -> str:
+    """Write MODEL_NAME's weights as a plain state dict, loadable with MODEL_WEIGHTS_PATH=path."""
+    model, _ = clip.load(MODEL_NAME, device="cpu", jit=False)
+    tmp = f"{path}.tmp"
+    torch.save(model.state_dict(), tmp)
+    os.replace(tmp, path)
+    return path
+
+def warmup_image_encoder(model, device, batch_sizes: List[int]) -> Dict[int, float]:
+    """
+    One dummy forward per batch size, so allocator growth, cuDNN autotuning and lazy kernel init
+    happen before the first real request. Returns seconds per batch size.
+    """
+    res = getattr(getattr(model, "visual", None), "input_resolution", 224)
+    blank = torch.zeros((3, res, res), dtype=torch.uint8)
+    timings = {}
+    for b in batch_sizes:
+        if b <= 0:
+            continue
+        start = time.perf_counter()
+        encode_images([blank] * b, model, device, batch_size=b)
+        timings[b] = round(time.perf_counter() - start, 4)
+    return timings
+
+def _normalize(features):
+    return features / features.norm(dim=-1, keepdim=True)
+
+def _fetch_one(image_url: str, timeout: int = 8, deadline=None) -> FetchedImage:
+    return _fetch_cached(image_url, timeout_read=timeout, deadline=deadline)
+
+def _decode_input(data: bytes, preprocess):
+    """Decode and preprocess one image -> [3, H, W] tensor on CPU."""
+    return preprocess(_open_image(data).convert("RGB"))
+
+# ----------------------- pixel / embedding tiers -----------------------
+
+_STORES: Dict[str, NpyStore] = {}
+_STORES_LOCK = threading.Lock()
+
+def _store(root: str, max_bytes: int) -> NpyStore:
+    store = _STORES.get(root)
+    if store is None:
+        with _STORES_LOCK:
+            store = _STORES.get(root)
+            if store is None:
+                store = NpyStore(root, max_bytes)
+                _STORES[root] = store
+    return store
+
+_CLIP_MEAN = (0.48145466, 0.4578275, 0.40821073)
+_CLIP_STD = (0.26862954, 0.26130258, 0.27577711)
+
+def encoder_id(model) -> str:
+    """Everything besides the image bytes that changes the model's image features (part of cache keys)."""
+    ident = getattr(model, "weights_id", MODEL_NAME)
+    ident = f"{ident}+draft" if FAST_DECODE else ident
+    backend = getattr(model, "cpu_backend", "fp32")
+    return ident if backend == "fp32" else f"{ident}+{backend}"
+
+def _split_preprocess(preprocess):
+    """
+    CLIP's preprocess is Compose([Resize, CenterCrop, to_rgb, ToTensor, Normalize]).
+    Returns (pil_stage, target_size, id) split at ToTensor, so the uint8 crop can be cached and
+    normalized later for a whole batch at once; None for any other preprocess callable.
+    """
+    ts = getattr(preprocess, "transforms", None)
+    if not ts or len(ts) < 3 or type(ts[-2]).__name__ != "ToTensor" or type(ts[-1]).__name__ != "Normalize":
+        return None
+    norm = ts[-1]
+    if tuple(norm.mean) != _CLIP_MEAN or tuple(norm.std) != _CLIP_STD:
+        return None
+    head = ts[:-2]
+    size = getattr(head[0], "size", None)
+    if isinstance(size, (list, tuple)):
+        size = size[0] if len(size) == 1 else None
+    ident = "|".join(getattr(t, "__name__", None) or repr(t) for t in head) + ("|draft" if FAST_DECODE else "")
+    return head, size, hashlib.sha1(ident.encode("utf-8")).hexdigest()[:12]
+
+def _open_reduced(data, size: int) -> Image.Image:
+    """Decode bytes/mmap at reduced resolution (see decode_pool.reduce_image)."""
+    return reduce_image(_open_image(data), size)
+
+_DECODE_POOL = None
+_DECODE_POOL_LOCK = threading.Lock()
+
+def _decode_pool():
+    """Process pool for decode + crop (DECODE_PROCESSES > 0), created on first use."""
+    global _DECODE_POOL
+    if DECODE_PROCESSES <= 0:
+        return None
+    if _DECODE_POOL is None:
+        with _DECODE_POOL_LOCK:
+            if _DECODE_POOL is None:
+                _DECODE_POOL = DecodePool(workers=DECODE_PROCESSES, slots=DECODE_QUEUE_DEPTH)
+                atexit.register(_DECODE_POOL.close)
+    return _DECODE_POOL
+
+def decode_pool_stats():
+    return _DECODE_POOL.stats() if _DECODE_POOL is not None else None
+
+def _is_clip_head(head, size) -> bool:
+    """[Resize(size, BICUBIC), CenterCrop(size), to_rgb]: what decode_pool.clip_crop reproduces."""
+    if len(head) != 3 or not size:
+        return False
+    resize, crop = head[0], head[1]
+    return (type(resize).__name__ == "Resize" and getattr(resize.interpolation, "name", "") == "BICUBIC"
+            and getattr(resize, "max_size", None) is None
+            and type(crop).__name__ == "CenterCrop" and tuple(crop.size) == (size, size))
+
+def _normalize_pixels(batch: torch.Tensor) -> torch.Tensor:
+    """uint8 [N, 3, H, W] -> CLIP-normalized float (same arithmetic as ToTensor + Normalize)."""
+    mean = torch.tensor(_CLIP_MEAN, dtype=torch.float32).view(1, 3, 1, 1)
+    std = torch.tensor(_CLIP_STD, dtype=torch.float32).view(1, 3, 1, 1)
+    return batch.float().div(255).sub_(mean).div_(std)
+
+def _stack_inputs(chunk: List) -> torch.Tensor:
+    """Stack [3, H, W] inputs; uint8 crops from the pixel path are normalized as one batch."""
+    if all(x.dtype == torch.uint8 for x in chunk):
+        return _normalize_pixels(torch.stack(chunk, dim=0))
+    return torch.stack([_normalize_pixels(x[None])[0] if x.dtype == torch.uint8 else x for x in chunk], dim=0)
+
+def _prepare_input(fetched: FetchedImage, preprocess):
+    """
+    Model input for a fetched image, decoding only on a pixel-tier miss.
+    CLIP's preprocess yields a uint8 [3, H, W] crop (normalized later in encode_images);
+    any other preprocess yields its own float tensor.
+    """
+    split = _split_preprocess(preprocess)
+    if split is None:
+        with STAGES.timed("decode"):
+            return _decode_input(fetched.data, preprocess)
+    head, size, ident = split
+    store = _store(os.path.join(PIXEL_CACHE_DIR, ident), PIXEL_CACHE_MAX_BYTES)
+    pixels = store.get(fetched.content_hash)
+    if pixels is not None:
+        return torch.from_numpy(np.array(pixels)).permute(2, 0, 1)
+
+    pool = _decode_pool() if _is_clip_head(head, size) else None
+    shared = None
+    if pool is not None and pool.size == size:
+        with STAGES.timed("decode"):   # decode + crop, both in the worker
+            shared = pool.decode(fetched.path or bytes(fetched.data), FAST_DECODE)
+    if shared is not None:
+        # view into the pool's shared memory; the slot is recycled once this tensor is freed
+        store.put(fetched.content_hash, shared)
+        return torch.from_numpy(shared).permute(2, 0, 1)
+
+    with STAGES.timed("decode"):
+        if FAST_DECODE and size:
+            img = _open_reduced(fetched.data, size)
+        else:
+            img = _open_image(fetched.data).convert("RGB")
+    with STAGES.timed("preprocess"):
+        for t in head:
+            img = t(img)
+        pixels = np.array(img, dtype=np.uint8)
+    store.put(fetched.content_hash, pixels)
+    return torch.from_numpy(pixels).permute(2, 0, 1)
+
+def _embedding_store(model, device) -> NpyStore:
+    """Embeddings differ per model and per device precision (fp16 on CUDA)."""
+    kind = device.type if hasattr(device, "type") else str(device).split(":")[0]
+    namespace = f"{encoder_id(model).replace('/', '-')}-{kind}"
+    return _store(os.path.join(EMBED_CACHE_DIR, namespace), EMBED_CACHE_MAX_BYTES)
+
+def _cached_embeddings(hashes: List[str], model, device) -> List:
+    """[1, D] feature rows from the embedding tier, None where missing."""
+    store = _embedding_store(model, device)
+    rows = []
+    for h in hashes:
+        arr = store.get(h)
+        rows.append(None if arr is None else torch.from_numpy(np.array(arr)).unsqueeze(0).to(device))
+    return rows
+
+def _store_embeddings(hashes: List[str], rows: List, model, device) -> None:
+    store = _embedding_store(model, device)
+    if not store.enabled:
+        return
+    for h, r in zip(hashes, rows):
+        if isinstance(r, torch.Tensor):
+            store.put(h, r[0].detach().cpu().numpy())
+
+def feature_cache_stats() -> dict:
+    return {root: store.stats() for root, store in list(_STORES.items())}
+
+def _map_io(fn: Callable, args_list: List[tuple]) -> List:
+    """Run fn(*args) for every args on the shared I/O pool; one result or Exception per entry, in order."""
+    if len(args_list) == 1:
+        futures = None
+    else:
+        pool = _io_pool()
+        futures = [pool.submit(fn, *a) for a in args_list]
+    out: List = []
+    for i, a in enumerate(args_list):
+        try:
+            out.append(futures[i].result() if futures else fn(*a))
+        except Exception as e:
+            out.append(e)
+    return out
+
+async def _amap_io(fn: Callable, args_list: List[tuple]) -> List:
+    loop = asyncio.get_running_loop()
+    return list(await asyncio.gather(*[loop.run_in_executor(_io_pool(), fn, *a) for a in args_list],
+                                     return_exceptions=True))
+
+def encode_images(image_inputs: List, model, device, batch_size: int = ENCODE_BATCH_SIZE):
+    """
+    Run the CLIP image tower over preprocessed images in fixed-size chunks
+    (uint8 crops from _prepare_input are normalized per chunk).
+    Returns L2-normalized image features of shape [N, D].
+    """
+    amp_ctx = _image_amp_ctx(model, device)
+    outs = []
+    with torch.no_grad(), amp_ctx:
+        for i in range(0, len(image_inputs), batch_size):
+            chunk = image_inputs[i:i + batch_size]
+            with STAGES.timed("preprocess", len(chunk)):
+                batch = _to_device_image(_stack_inputs(chunk), device)
+            start = time.time()
+            with STAGES.timed("encode", len(chunk)):
+                feats = model.encode_image(batch)
+            if feats.dtype == torch.bfloat16:
+                feats = feats.float()   # downstream math and the .npy embedding tier are fp32
+            outs.append(_normalize(feats))
+            logger.info(f"Image encode time: {time.time() - start:.4f} 秒 (batch={len(chunk)})")
+    return torch.cat(outs, dim=0)
+
+def _encode_rows(image_inputs: List, model, device, batch_size: int = ENCODE_BATCH_SIZE) -> List:
+    """encode_images, but one [1, D] entry (or Exception) per input."""
+    try:
+        feats = encode_images(image_inputs, model, device, batch_size=batch_size)
+        return [feats[j:j + 1] for j in range(len(image_inputs))]
+    except Exception:
+        # a bad tensor poisons its whole batch; retry one by one so only it fails
+        logger.exception("Batched encode failed, falling back to per-image encode")
+        rows = []
+        for x in image_inputs:
+            try:
+                rows.append(encode_images([x], model, device))
+            except Exception as e:
+                rows.append(e)
+        return rows
+
+def _scatter(entries: List, idx: List[int], values: List) -> List:
+    out = list(entries)
+    for i, v in zip(idx, values):
+        out[i] = v
+    return out
+
+def _remaining(deadline):
+    return None if deadline is None else max(0.0, deadline - time.monotonic())
+
+def encode_deadline():
+    """Deadline for decode + encode, started once the downloads are done (ENCODE_TIMEOUT_S; 0 = none)."""
+    return time.monotonic() + ENCODE_TIMEOUT_S if ENCODE_TIMEOUT_S > 0 else None
+
+# ----------------------- single-flight -----------------------
+# Concurrent calls (from any request) share one download per image_key(url)
+# and one decode + forward per content hash. A follower whose raw URL differs from
+# the leader's does not keep the leader's permanent failure: it retries its own URL.
+
+_FLIGHT = SingleFlight()
+
+def image_key(image_url: str) -> str:
+    """Identity used to coalesce concurrent downloads of the same image."""
+    return canonical_key(image_url)
+
+def singleflight_stats() -> dict:
+    return _FLIGHT.stats()
+
+def _claim(keys: List) -> tuple:
+    claims = [_FLIGHT.claim(k) for k in keys]
+    return claims, [i for i, (_, leader) in enumerate(claims) if leader]
+
+def _publish(keys: List, lead: List[int], results: List) -> None:
+    for n, i in enumerate(lead):
+        _FLIGHT.resolve(keys[i], results[n] if n < len(results) else RuntimeError("image work aborted"))
+
+def _coalesce(keys: List, compute: Callable, deadline=None) -> List:
+    """compute(lead_positions) runs only for keys nobody else is already working on."""
+    claims, lead = _claim(keys)
+    results = []
+    try:
+        if lead:
+            results = compute(lead)
+    finally:
+        _publish(keys, lead, results)
+    out = []
+    for f, _ in claims:
+        try:
+            out.append(f.result(timeout=_remaining(deadline)))
+        except Exception:
+            out.append(TimeoutError("image deadline exceeded"))
+    return out
+
+async def _acoalesce(keys: List, compute: Callable, deadline=None) -> List:
+    """Async _coalesce; compute is a coroutine function."""
+    claims, lead = _claim(keys)
+    results = []
+    try:
+        if lead:
+            results = await compute(lead)
+    finally:
+        _publish(keys, lead, results)
+    out = []
+    for f, _ in claims:
+        try:
+            out.append(await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(f)), timeout=_remaining(deadline)))
+        except (asyncio.TimeoutError, TimeoutError):
+            out.append(TimeoutError("image deadline exceeded"))
+    return out
+
+def _inherited_failures(image_urls: List[str], entries: List) -> List[int]:
+    """
+    Positions holding another raw URL's permanent failure, shared through the canonical-key flight.
+    A differently signed URL for the same image may still work, so those retry their own URL.
+    """
+    return [i for i, e in enumerate(entries) if isinstance(e, PermanentFetchError) and e.url != image_urls[i]]
+
+def _log_failures(entries: List) -> List:
+    for e in entries:
+        if isinstance(e, Exception):
+            logger.error(f"Failed to load photos: {str(e)}")
+    return entries
+
+# ----------------------- image pipeline -----------------------
+
+def fetch_images(image_urls: List[str], timeout: int = 8, deadline=None) -> List:
+    """
+    Fetch all URLs concurrently (cache first). Network wait is max() over the URLs rather than sum(),
+    and every download (including its retries) stops at the shared request deadline.
+    Returns one entry per URL, in order: FetchedImage, or the Exception that URL raised.
+    """
+    keys = [("fetch", image_key(u)) for u in image_urls]
+    compute = lambda lead: _map_io(_fetch_one, [(image_urls[i], timeout, deadline) for i in lead])
+    out = _coalesce(keys, compute, deadline)
+    retry = _inherited_failures(image_urls, out)
+    if retry:
+        out = _scatter(out, retry, _map_io(_fetch_one, [(image_urls[i], timeout, deadline) for i in retry]))
+    return _log_failures(out)
+
+async def afetch_images(image_urls: List[str], timeout: int = 8, deadline=None) -> List:
+    keys = [("fetch", image_key(u)) for u in image_urls]
+
+    async def compute(lead):
+        return await _amap_io(_fetch_one, [(image_urls[i], timeout, deadline) for i in lead])
+    out = await _acoalesce(keys, compute, deadline)
+    retry = _inherited_failures(image_urls, out)
+    if retry:
+        out = _scatter(out, retry, await _amap_io(_fetch_one, [(image_urls[i], timeout, deadline) for i in retry]))
+    return _log_failures(out)
+
+def encode_fetched(
+    fetched: List,
+    model,
+    preprocess,
+    device,
+    batch_size: int = ENCODE_BATCH_SIZE,
+    scheduler=None,
+    deadline=None
+) -> List:
+    """
+    Decode + preprocess (I/O pool) and encode fetched images in one batch.
+    Embedding / preprocessed-pixel tiers (app/feature_cache.py) short-circuit repeat content.
+    Exception entries pass through; others become [1, D] features or the Exception they raised.
+    With a scheduler (app.scheduler.EncodeScheduler) the forward is shared with concurrent requests.
+    """
+    items = [i for i, f in enumerate(fetched) if isinstance(f, FetchedImage)]
+    keys = [("encode", fetched[i].content_hash) for i in items]
+
+    def compute(lead):
+        hashes = [fetched[items[j]].content_hash for j in lead]
+        cached = _cached_embeddings(hashes, model, device)
+        miss = [n for n, r in enumerate(cached) if r is None]
+        inputs = _map_io(_prepare_input, [(fetched[items[lead[n]]], preprocess) for n in miss])
+        ok = [n for n, x in enumerate(inputs) if not isinstance(x, Exception)]
+        if scheduler is not None:
+            rows = scheduler.encode([inputs[n] for n in ok], deadline=deadline)
+        else:
+            rows = _encode_rows([inputs[n] for n in ok], model, device, batch_size) if ok else []
+        fresh = _scatter(inputs, ok, rows)
+        _store_embeddings([hashes[n] for n in miss], fresh, model, device)
+        return _scatter(cached, miss, fresh)
+
+    return _scatter(fetched, items, _coalesce(keys, compute, deadline))
+
+async def aencode_fetched(
+    fetched: List,
+    model,
+    preprocess,
+    device,
+    batch_size: int = ENCODE_BATCH_SIZE,
+    scheduler=None,
+    deadline=None
+) -> List:
+    """Async encode_fetched: decode on the I/O pool, forward via the scheduler or the inference pool."""
+    items = [i for i, f in enumerate(fetched) if isinstance(f, FetchedImage)]
+    keys = [("encode", fetched[i].content_hash) for i in items]
+
+    async def compute(lead):
+        hashes = [fetched[items[j]].content_hash for j in lead]
+        cached = _cached_embeddings(hashes, model, device)
+        miss = [n for n, r in enumerate(cached) if r is None]
+        inputs = await _amap_io(_prepare_input, [(fetched[items[lead[n]]], preprocess) for n in miss])
+        ok = [n for n, x in enumerate(inputs) if not isinstance(x, Exception)]
+        if scheduler is not None:
+            rows = await scheduler.aencode([inputs[n] for n in ok], deadline=deadline)
+        elif ok:
+            rows = await run_in_inference_pool(_encode_rows, [inputs[n] for n in ok], model, device, batch_size)
+        else:
+            rows = []
+        fresh = _scatter(inputs, ok, rows)
+        _store_embeddings([hashes[n] for n in miss], fresh, model, device)
+        return _scatter(cached, miss, fresh)
+
+    return _scatter(fetched, items, await _acoalesce(keys, compute, deadline))
+
+def encode_images_from_urls(
+    image_urls: List[str],
+    model,
+    preprocess,
+    device,
+    timeout: int = 8,
+    batch_size: int = ENCODE_BATCH_SIZE,
+    scheduler=None
+) -> List:
+    """
+    Batched image encoding for a whole request.
+    Returns one entry per URL, in request order: [1, D] features, or the Exception that URL raised.
+    A failing URL never affects the others; `timeout` is the deadline of all downloads,
+    decode + encode then get ENCODE_TIMEOUT_S of their own.
+    """
+    fetched = fetch_images(image_urls, timeout=timeout, deadline=time.monotonic() + timeout)
+    return encode_fetched(fetched, model, preprocess, device, batch_size=batch_size,
+                          scheduler=scheduler, deadline=encode_deadline())
+
+async def aencode_images_from_urls(
+    image_urls: List[str],
+    model,
+    preprocess,
+    device,
+    timeout: int = 8,
+    batch_size: int = ENCODE_BATCH_SIZE,
+    scheduler=None
+) -> List:
+    """
+    Async encode_images_from_urls: downloads are awaited on the I/O pool,
+    the forward goes to the scheduler (or the inference pool), so the event loop never blocks.
+    """
+    fetched = await afetch_images(image_urls, timeout=timeout, deadline=time.monotonic() + timeout)
+    return await aencode_fetched(fetched, model, preprocess, device, batch_size=batch_size,
+                                 scheduler=scheduler, deadline=encode_deadline())
+
+def encode_image_from_url(
+    image_url: str,
+    model,
+    preprocess,
+    device,
+    timeout: int = 8
+):
+    """
+    Load, preprocess and run the CLIP image tower once.
+    Returns L2-normalized image features of shape [1, D]; raises if the image cannot be loaded.
+    """
+    res = encode_images_from_urls([image_url], model, preprocess, device, timeout=timeout)[0]
+    if isinstance(res, Exception):
+        raise res
+    return res
+
+# ----------------------- text features -----------------------
+
+# Keyed by (weights_id, prompt): a reload with other weights must not reuse the old features.
+_TEXT_BANK: Dict[Tuple[str, str], torch.Tensor] = {}                     # fixed prompt set, never evicted
+_TEXT_LRU: "OrderedDict[Tuple[str, str], torch.Tensor]" = OrderedDict()  # ad-hoc prompts, bounded
+_TEXT_LOCK = threading.Lock()
+
+def prompt_set_hash(prompts: List[str]) -> str:
+    return hashlib.sha1("\n".join(prompts).encode("utf-8")).hexdigest()[:16]
+
+def _encode_text_uncached(prompts: List[str], model, device):
+    text_tokens = _tokenize_cached(prompts, device)
+    with torch.no_grad(), _amp_ctx_for(device):
+        text_features = model.encode_text(text_tokens)
+    return _normalize(text_features)
+
+def build_text_bank(prompts: List[str], model, device,
+                    model_name: Optional[str] = None, cache_dir: str = TEXT_CACHE_DIR) -> str:
+    """
+    Load normalized text features for a fixed prompt set from disk, or encode and persist them.
+    The file is keyed by the model's weights_id + prompt-set hash, so editing prompts or loading
+    other weights (MODEL_WEIGHTS_PATH) invalidates it. Returns the bank file path.
+    """
+    prompts = list(dict.fromkeys(prompts))
+    model_name = model_name or getattr(model, "weights_id", MODEL_NAME)
+    fname = f"{model_name.replace('/', '-').replace('@', '-')}-{prompt_set_hash(prompts)}.pt"
+    path = os.path.join(cache_dir, fname)
+
+    features = None
+    if os.path.exists(path):
+        try:
+            saved = torch.load(path, map_location="cpu")
+            if saved.get("prompts") == prompts and saved.get("model") == model_name:
+                features = saved["features"]
+        except Exception as e:
+            logger.warning(f"Ignoring unreadable text bank {path}: {e}")
+
+    if features is None:
+        features = _encode_text_uncached(prompts, model, device).float().cpu()
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp = f"{path}.{os.getpid()}.tmp"
+            torch.save({"model": model_name, "prompts": prompts, "features": features}, tmp)
+            os.replace(tmp, path)
+        except Exception as e:
+            logger.warning(f"Could not persist text bank {path}: {e}")
+
+    features = features.to(device=device, dtype=model.dtype)
+    ident = getattr(model, "weights_id", MODEL_NAME)
+    with _TEXT_LOCK:
+        for p, f in zip(prompts, features):
+            _TEXT_BANK[(ident, p)] = f
+    logger.info(f"Text bank ready: {len(prompts)} prompts ({path})")
+    return path
+
+def encode_text(prompts: List[str], model, device):
+    """
+    L2-normalized text features of shape [len(prompts), D].
+    Served from the prompt bank / LRU; only unseen prompts go through the text tower.
+    """
+    ident = getattr(model, "weights_id", MODEL_NAME)
+    rows: List = [None] * len(prompts)
+    with _TEXT_LOCK:
+        for i, p in enumerate(prompts):
+            f = _TEXT_BANK.get((ident, p))
+            if f is None:
+                f = _TEXT_LRU.get((ident, p))
+                if f is not None:
+                    _TEXT_LRU.move_to_end((ident, p))
+            rows[i] = f
+
+    missed = list(dict.fromkeys(p for p, f in zip(prompts, rows) if f is None))
+    if missed:
+        fresh = dict(zip(missed, _encode_text_uncached(missed, model, device)))
+        with _TEXT_LOCK:
+            for p, f in fresh.items():
+                _TEXT_LRU[(ident, p)] = f
+                _TEXT_LRU.move_to_end((ident, p))
+            while len(_TEXT_LRU) > TEXT_LRU_SIZE:
+                _TEXT_LRU.popitem(last=False)
+        rows = [f if f is not None else fresh[p] for p, f in zip(prompts, rows)]
+
+    return torch.stack(rows, dim=0)
+
+def predict_probs_matrix(image_features, model, device, prompts: List[str]) -> List[List[float]]:
+    """
+    Softmax over prompts for already encoded images ([N, D] -> N rows of len(prompts)).
+    Same math as CLIP's forward: logit_scale * img @ txt.T, so scores match model(image, text).
+    """
+    text_features = encode_text(prompts, model, device)
+    with torch.no_grad(), _amp_ctx_for(device):
+        logits_per_image = model.logit_scale.exp() * image_features @ text_features.t()
+        return logits_per_image.softmax(dim=-1).float().cpu().numpy().tolist()
+
+def predict_probs_from_features(image_features, model, device, prompts: List[str]) -> Dict[str, float]:
+    """Softmax over prompts for a single encoded image ([1, D])."""
+    probs = predict_probs_matrix(image_features, model, device, prompts)[0]
+    return {p: float(s) for p, s in zip(prompts, probs)}
+
+def predict_probs_from_urls(
+    image_urls: List[str],
+    model,
+    preprocess,
+    device,
+    prompts: List[str],
+    timeout: int = 8,
+    scheduler=None
+) -> List[dict]:
+    """
+    Batched predict_probs_from_url: one image-tower pass for all URLs, results in request order.
+    """
+    encoded = encode_images_from_urls(image_urls, model, preprocess, device, timeout=timeout,
+                                      scheduler=scheduler)
+    return _scores_from_encoded(image_urls, encoded, model, device, prompts)
+
+async def apredict_probs_from_urls(
+    image_urls: List[str],
+    model,
+    preprocess,
+    device,
+    prompts: List[str],
+    timeout: int = 8,
+    scheduler=None
+) -> List[dict]:
+    """Async predict_probs_from_urls (see aencode_images_from_urls)."""
+    encoded = await aencode_images_from_urls(image_urls, model, preprocess, device, timeout=timeout,
+                                             scheduler=scheduler)
+    return await run_in_inference_pool(_scores_from_encoded, image_urls, encoded, model, device, prompts)
+
+@STAGES.timed("scoring")
+def _scores_from_encoded(image_urls: List[str], encoded: List, model, device, prompts: List[str]) -> List[dict]:
+    ok = [i for i, f in enumerate(encoded) if not isinstance(f, Exception)]
+    rows = predict_probs_matrix(torch.cat([encoded[i] for i in ok], dim=0), model, device, prompts) if ok else []
+    scores = dict(zip(ok, rows))
+
+    results = []
+    for i, u in enumerate(image_urls):
+        if i in scores:
+            results.append({"url": u, "scores": {p: float(s) for p, s in zip(prompts, scores[i])}})
+        else:
+            results.append({"url": u, "error": str(encoded[i])})
+    return results
+
 def predict_probs_from_url(
     image_url: str,
     model,
@@ -152,25 +1032,4 @@ def predict_probs_from_url(
     """
     Use CLIP model to predict content of photo
     """
-    try:
-        image = _load_image_with_cache(image_url, timeout_read=timeout, cache_dir=".cache/images")
-    except Exception as e:
-        msg = f"Failed to load photos: {str(e)}"
-        logger.error(msg)
-        return {"url": image_url, "error": str(e)}
-
-    # preprocessing & inference
-    image_input = _to_device_image(preprocess(image).unsqueeze(0), device)
-    text_tokens = _tokenize_cached(prompts, device)
-
-    amp_ctx = _amp_ctx_for(device)
-    with torch.no_grad(), amp_ctx:
-        start = time.time()
-        logits_per_image, _ = model(image_input, text_tokens)
-        probs = logits_per_image.softmax(dim=-1).cpu().numpy()[0].tolist()
-        logger.info(f"Image inference time: {time.time() - start:.4f} 秒")
-
-    return {
-        "url": image_url,
-        "scores": {p: float(s) for p, s in zip(prompts, probs)}
-    }
+    return predict_probs_from_urls([image_url], model, preprocess, device, prompts, timeout=timeout)[0]
@@ -0,0 +1,98 @@
+"""
+Runtime knobs, read once from environment variables.
+"""
+import os
+from typing import List, Tuple
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+def _env_int_list(name: str, default: str) -> List[int]:
+    try:
+        return [int(x) for x in os.environ.get(name, default).split(",") if x.strip()]
+    except ValueError:
+        return [int(x) for x in default.split(",") if x.strip()]
+
+
+def _env_bool(name: str, default: bool) -> bool:
+    v = os.environ.get(name)
+    if v is None:
+        return default
+    return v.strip().lower() in ("1", "true", "yes", "on")
+
+
+def _env_choice(name: str, default: str, choices: Tuple[str, ...]) -> str:
+    v = os.environ.get(name, default).strip().lower()
+    if v not in choices:
+        raise ValueError(f"{name} must be one of {choices}, got {v!r}")
+    return v
+
+
+# ---------- cross-request micro-batching (app/scheduler.py) ----------
+SCHEDULER_ENABLED = _env_bool("CLIP_SCHEDULER", True)
+SCHEDULER_MAX_BATCH = _env_int("CLIP_MAX_BATCH", 16)      # images per image-tower forward
+SCHEDULER_MAX_WAIT_MS = _env_float("CLIP_MAX_WAIT_MS", 10.0)  # how long the first job waits for company
+ENCODE_TIMEOUT_S = _env_float("ENCODE_TIMEOUT_S", 10.0)   # decode + encode budget after the downloads; 0 = none
+
+# ---------- model lifecycle (app/main.py) ----------
+MODEL_LOAD = _env_choice("MODEL_LOAD", "background", ("startup", "background", "lazy"))
+MODEL_WEIGHTS_PATH = os.environ.get("MODEL_WEIGHTS_PATH", "")   # local TorchScript / state-dict file; empty = clip.load(MODEL_NAME)
+CPU_BACKEND = os.environ.get("CPU_BACKEND", "fp32")   # image tower on CPU: fp32 | int8 | bf16 | traced
+WARMUP_BATCH_SIZES = _env_int_list("WARMUP_BATCH_SIZES", f"1,{SCHEDULER_MAX_BATCH}")   # dummy forwards before ready; empty = none
+
+# ---------- per-user window (app/window.py) ----------
+WINDOW_STORE = os.environ.get("WINDOW_STORE", "memory")   # memory | sqlite | package.module:ClassName
+WINDOW_DB = os.environ.get("WINDOW_DB", ".cache/windows.sqlite")   # file for WINDOW_STORE=sqlite
+WINDOW_MAX_USERS = _env_int("WINDOW_MAX_USERS", 1_000_000)       # in-memory windows kept (LRU); 0 = unbounded
+WINDOW_IDLE_TTL_S = _env_float("WINDOW_IDLE_TTL_S", 24 * 3600)   # drop users idle this long; 0 = never
+WINDOW_LOCK_STRIPES = _env_int("WINDOW_LOCK_STRIPES", 64)        # shards (one lock each) of the in-memory store
+WINDOW_JOURNAL_DIR = os.environ.get("WINDOW_JOURNAL_DIR", "")    # journal + snapshots of the in-memory store; empty = off
+WINDOW_JOURNAL_FSYNC_MS = _env_float("WINDOW_JOURNAL_FSYNC_MS", 200)   # batch write + fsync interval (max loss on crash)
+WINDOW_SNAPSHOT_INTERVAL_S = _env_float("WINDOW_SNAPSHOT_INTERVAL_S", 300)   # full snapshot + journal truncation; 0 = never
+
+# ---------- image download (app/clip_wrapper.py) ----------
+HTTP_POOL_HOSTS = _env_int("HTTP_POOL_HOSTS", 8)    # distinct hosts kept in the connection pool
+HTTP_POOL_SIZE = _env_int("HTTP_POOL_SIZE", 32)     # keep-alive connections per host
+IO_WORKERS = _env_int("IO_WORKERS", 16)             # concurrent downloads/decodes across all requests
+INFER_WORKERS = _env_int("INFER_WORKERS", 1)        # threads running torch calls for async endpoints
+
+# ---------- torch threading (applied in app/main.py) ----------
+TORCH_THREADS = _env_int("TORCH_THREADS", 0)         # intra-op threads; 0 = torch default (all cores)
+TORCH_INTEROP_THREADS = _env_int("TORCH_INTEROP_THREADS", 0)
+
+# ---------- evaluation result cache (app/result_cache.py) ----------
+RESULT_CACHE_SIZE = _env_int("RESULT_CACHE_SIZE", 50000)          # in-memory entries
+RESULT_CACHE_TTL_S = _env_float("RESULT_CACHE_TTL_S", 7 * 24 * 3600)
+RESULT_CACHE_DB = os.environ.get("RESULT_CACHE_DB", "")           # e.g. .cache/results.sqlite; empty = memory only
+
+# ---------- on-disk image cache (app/image_cache.py) ----------
+IMAGE_CACHE_DIR = os.environ.get("IMAGE_CACHE_DIR", ".cache/images")
+IMAGE_CACHE_MAX_BYTES = _env_int("IMAGE_CACHE_MAX_BYTES", 2 * 1024 ** 3)   # LRU-evicted above this
+
+# ---------- derived per-image tiers (app/feature_cache.py); max bytes 0 disables a tier ----------
+PIXEL_CACHE_DIR = os.environ.get("PIXEL_CACHE_DIR", ".cache/pixels")
+PIXEL_CACHE_MAX_BYTES = _env_int("PIXEL_CACHE_MAX_BYTES", 1024 ** 3)        # ~150 KB per image at 224px
+EMBED_CACHE_DIR = os.environ.get("EMBED_CACHE_DIR", ".cache/embeddings")
+EMBED_CACHE_MAX_BYTES = _env_int("EMBED_CACHE_MAX_BYTES", 256 * 1024 ** 2)  # ~2 KB per image
+
+# ---------- image decode (app/clip_wrapper.py) ----------
+FAST_DECODE = _env_bool("FAST_DECODE", False)  # JPEG draft()/reduce() to ~224px before the CLIP resize; changes pixels, off until measured
+DECODE_PROCESSES = _env_int("DECODE_PROCESSES", 0)      # decode/crop worker processes; 0 = inline on IO_WORKERS threads
+DECODE_QUEUE_DEPTH = _env_int("DECODE_QUEUE_DEPTH", 64)  # shared-memory output slots = decoded images in flight
+
+# ---------- download guards (app/netguard.py) ----------
+NEGATIVE_CACHE_TTL_S = _env_float("NEGATIVE_CACHE_TTL_S", 600.0)   # remember 403/404/410 URLs; 0 disables
+BREAKER_THRESHOLD = _env_int("BREAKER_THRESHOLD", 5)                # consecutive host failures to open; 0 disables
+BREAKER_COOLDOWN_S = _env_float("BREAKER_COOLDOWN_S", 30.0)         # fail fast this long before a trial request
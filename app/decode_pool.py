@@ -0,0 +1,170 @@
+"""
+Multi-process decode + CLIP crop stage.
+
+JPEG decode and resize hold the GIL for most of their runtime, so doing them on I/O threads
+competes with torch for the interpreter. DecodePool runs them in worker processes instead:
+each job is given a slot in one SharedMemory block, the worker writes the uint8 224x224x3
+crop straight into it, and the parent wraps the slot as an ndarray (no pickling of pixels).
+A slot returns to the free list when the last array/tensor viewing it is garbage-collected,
+so the number of slots is also the maximum number of decoded images in flight (queue depth).
+
+The workers only import PIL/numpy: the CLIP Resize(BICUBIC) + CenterCrop is reproduced
+with plain PIL calls (same size arithmetic as torchvision, so the output is identical).
+"""
+import io
+import logging
+import multiprocessing as mp
+import queue
+import threading
+import weakref
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+from typing import Optional
+
+import numpy as np
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+
+# ---------- pure-PIL helpers (also used inline by app/clip_wrapper.py) ----------
+
+def reduce_image(img: Image.Image, size: int) -> Image.Image:
+    """
+    RGB image shrunk towards `size` (shorter side) without going below it, before the real resize:
+    JPEG via draft() (DCT-domain scaling, the full-resolution bitmap is never built),
+    other formats (WebP/PNG/AVIF) via an integer box reduce() after decode.
+    """
+    if img.format == "JPEG":
+        img.draft("RGB", (size, size))
+    img = img.convert("RGB")
+    factor = min(img.size) // size
+    if factor >= 2:
+        img = img.reduce(factor)
+    return img
+
+
+def clip_crop(img: Image.Image, size: int) -> np.ndarray:
+    """CLIP's Resize(size, BICUBIC) + CenterCrop(size) on an RGB image -> uint8 [size, size, 3]."""
+    w, h = img.size
+    short, long = (w, h) if w <= h else (h, w)
+    new_short, new_long = size, int(size * long / short)
+    new_w, new_h = (new_short, new_long) if w <= h else (new_long, new_short)
+    if (new_w, new_h) != (w, h):
+        img = img.resize((new_w, new_h), Image.BICUBIC)
+    top = int(round((new_h - size) / 2.0))
+    left = int(round((new_w - size) / 2.0))
+    return np.asarray(img.crop((left, top, left + size, top + size)), dtype=np.uint8)
+
+
+def decode_pixels(src, size: int, fast: bool) -> np.ndarray:
+    """src: file path or encoded bytes -> uint8 [size, size, 3] CLIP crop."""
+    img = Image.open(src if isinstance(src, str) else io.BytesIO(src))
+    img = reduce_image(img, size) if fast else img.convert("RGB")
+    return clip_crop(img, size)
+
+
+# ---------- worker side ----------
+
+_WORKER_SHM = None
+
+
+def _attach(shm_name: str) -> None:
+    global _WORKER_SHM
+    # workers share the parent's resource tracker, so attaching does not take ownership;
+    # the parent unlinks the block in close()
+    _WORKER_SHM = shared_memory.SharedMemory(name=shm_name)
+
+
+def _decode_into(slot: int, src, size: int, fast: bool) -> None:
+    out = np.ndarray((size, size, 3), dtype=np.uint8, buffer=_WORKER_SHM.buf, offset=slot * size * size * 3)
+    out[...] = decode_pixels(src, size, fast)
+
+
+# ---------- parent side ----------
+
+class DecodePool:
+    def __init__(self, workers: int = 4, slots: int = 64, size: int = 224, slot_wait_s: float = 1.0):
+        self.workers = int(workers)
+        self.slots = max(1, int(slots))
+        self.size = int(size)
+        self.slot_wait_s = slot_wait_s
+        self._slot_bytes = self.size * self.size * 3
+        self._shm = shared_memory.SharedMemory(create=True, size=self.slots * self._slot_bytes)
+        self._free: "queue.SimpleQueue[int]" = queue.SimpleQueue()
+        for i in range(self.slots):
+            self._free.put(i)
+        methods = mp.get_all_start_methods()
+        ctx = mp.get_context("forkserver" if "forkserver" in methods else "spawn")
+        self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=ctx,
+                                         initializer=_attach, initargs=(self._shm.name,))
+        self._lock = threading.Lock()
+        self._in_use = 0
+        self.max_in_use = 0
+        self.jobs_done = 0
+        self.jobs_failed = 0
+        self.slot_timeouts = 0
+
+    def _release(self, slot: int) -> None:
+        self._free.put(slot)
+        with self._lock:
+            self._in_use -= 1
+
+    def decode(self, src, fast: bool) -> Optional[np.ndarray]:
+        """
+        uint8 [size, size, 3] view into shared memory, or None when every slot is still held
+        after slot_wait_s or the pool is broken (caller decodes inline). Decode errors are raised.
+        """
+        try:
+            slot = self._free.get(timeout=self.slot_wait_s)
+        except queue.Empty:
+            with self._lock:
+                self.slot_timeouts += 1
+            return None
+        with self._lock:
+            self._in_use += 1
+            self.max_in_use = max(self.max_in_use, self._in_use)
+        try:
+            self._pool.submit(_decode_into, slot, src, self.size, fast).result()
+        except BrokenProcessPool:
+            # a worker died (e.g. OOM-killed); callers fall back to inline decode
+            self._release(slot)
+            with self._lock:
+                self.jobs_failed += 1
+            logger.error("Decode pool is broken, decoding inline")
+            return None
+        except BaseException:
+            self._release(slot)
+            with self._lock:
+                self.jobs_failed += 1
+            raise
+        arr = np.ndarray((self.size, self.size, 3), dtype=np.uint8,
+                         buffer=self._shm.buf, offset=slot * self._slot_bytes)
+        weakref.finalize(arr, self._release, slot)
+        with self._lock:
+            self.jobs_done += 1
+        return arr
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "slots": self.slots,
+                "slots_in_use": self._in_use,
+                "max_slots_in_use": self.max_in_use,
+                "jobs_done": self.jobs_done,
+                "jobs_failed": self.jobs_failed,
+                "slot_timeouts": self.slot_timeouts,
+            }
+
+    def close(self) -> None:
+        self._pool.shutdown(wait=True, cancel_futures=True)
+        try:
+            self._shm.close()
+        except BufferError:
+            pass   # arrays still alive; the OS reclaims the mapping at exit
+        try:
+            self._shm.unlink()
+        except FileNotFoundError:
+            pass
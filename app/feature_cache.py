@@ -0,0 +1,56 @@
+"""
+Derived per-image tiers on top of the image cache, keyed by image content hash:
+  - pixels:     the preprocessed image before ToTensor/Normalize (uint8 224x224x3 .npy, ~150 KB),
+                so a repeat hit skips JPEG decode, RGB conversion, resize and crop
+  - embeddings: the L2-normalized image feature row (.npy), so a repeat hit skips the model
+
+Both are DiskImageCache stores (sharded, atomic writes, LRU byte budget) read back with
+np.load(mmap_mode="r"). Embeddings live in one sub-directory per model/backend namespace.
+"""
+import io
+import logging
+from typing import Optional
+
+import numpy as np
+
+from .image_cache import DiskImageCache
+
+logger = logging.getLogger(__name__)
+
+
+def _npy_bytes(arr: np.ndarray) -> bytes:
+    buf = io.BytesIO()
+    np.save(buf, np.ascontiguousarray(arr), allow_pickle=False)
+    return buf.getvalue()
+
+
+class NpyStore:
+    """Content-hash -> ndarray store; a disabled store (max_bytes <= 0) never hits and never writes."""
+
+    def __init__(self, root: str, max_bytes: int):
+        self.enabled = max_bytes > 0
+        self._store = DiskImageCache(root, max_bytes=max_bytes, suffix=".npy") if self.enabled else None
+
+    def get(self, content_hash: str) -> Optional[np.ndarray]:
+        if not self.enabled:
+            return None
+        hit = self._store.get_content(content_hash)
+        if hit is None:
+            return None
+        hit.data.close()
+        try:
+            return np.load(hit.path, mmap_mode="r", allow_pickle=False)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Feature cache: unreadable entry {hit.path}: {e}")
+            return None
+
+    def put(self, content_hash: str, arr: np.ndarray) -> None:
+        if not self.enabled:
+            return
+        try:
+            self._store.put_content(content_hash, _npy_bytes(arr))
+        except Exception as e:
+            logger.warning(f"Feature cache write failed ({content_hash}): {e}")
+
+    def stats(self) -> Optional[dict]:
+        return self._store.stats() if self.enabled else None
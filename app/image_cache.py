@@ -0,0 +1,289 @@
+"""
+Size-bounded, sharded, crash-safe on-disk cache for downloaded image bytes.
+
+Layout under root:
+    blobs/ab/cd/<content_hash>.img   content-addressed image bytes (same photo stored once)
+    index.log                        append-only "<key> <content_hash>" lines (URL key -> blob)
+
+- writes go to a temp file in the target shard and are os.replace()d into place, so a crash
+  or a concurrent writer can never leave a truncated blob behind
+- an in-memory index (key -> hash, hash -> size in LRU order) gives O(1) lookups and stats
+- when total bytes exceed max_bytes, least recently used blobs are deleted
+- hits are returned as read-only mmaps instead of f.read() copies
+
+Several worker processes may share one root. Eviction and index compaction run under an
+exclusive flock on <root>/.lock and first rescan blobs/, so every process counts the blobs the
+others wrote (and forgets the ones they evicted) against the one shared max_bytes; a process
+rescans at the latest after writing 1/16 of the budget itself. Blobs new to a process count as
+recently used; other processes' hits only reach its LRU order through the hourly mtime touch.
+Compaction merges the index lines other processes appended (appends take the lock shared).
+
+The same store (without the key index) backs the preprocessed-pixel and embedding tiers in
+app/feature_cache.py, which are addressed by content hash directly.
+"""
+import logging
+import mmap
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:   # no flock (Windows): one process per cache directory
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+_TOUCH_INTERVAL_S = 3600  # persist LRU order (mtime) at most this often per blob
+_SYNC_FRACTION = 16       # rescan the shared directory after writing max_bytes / this
+
+
+class CachedImage(NamedTuple):
+    content_hash: str
+    path: str
+    data: mmap.mmap
+
+
+class DiskImageCache:
+    def __init__(self, root: str = ".cache/images", max_bytes: int = 2 * 1024 ** 3, suffix: str = ".img"):
+        self.root = root
+        self.suffix = suffix
+        self.max_bytes = int(max_bytes)
+        self._lock = threading.Lock()
+        self._blobs: "OrderedDict[str, int]" = OrderedDict()   # content_hash -> size, LRU order
+        self._touched: Dict[str, float] = {}
+        self._keys: Dict[str, str] = {}                        # key -> content_hash
+        self._index_lines = 0
+        self._unsynced_bytes = 0                               # written since the last rescan
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.writes = 0
+
+        os.makedirs(os.path.join(root, "blobs"), exist_ok=True)
+        self._index_path = os.path.join(root, "index.log")
+        self._lock_fd = os.open(os.path.join(root, ".lock"), os.O_RDWR | os.O_CREAT, 0o644)
+        with self._lock, self._dir_lock():
+            self._scan()
+
+    # ---------- paths ----------
+    def _blob_path(self, content_hash: str) -> str:
+        return os.path.join(self.root, "blobs", content_hash[:2], content_hash[2:4], f"{content_hash}{self.suffix}")
+
+    @contextmanager
+    def _dir_lock(self, shared: bool = False):
+        """flock on <root>/.lock, serializing eviction / compaction across worker processes."""
+        if fcntl is None:
+            yield
+            return
+        fcntl.flock(self._lock_fd, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+
+    # ---------- startup ----------
+    def _scan_blobs(self) -> List[Tuple[float, str, int]]:
+        """(mtime, content_hash, size) of every blob on disk; removes stale temp files."""
+        found = []
+        for d1 in os.scandir(os.path.join(self.root, "blobs")):
+            if not d1.is_dir():
+                continue
+            for d2 in os.scandir(d1.path):
+                if not d2.is_dir():
+                    continue
+                for f in os.scandir(d2.path):
+                    try:
+                        if f.name.endswith(self.suffix):
+                            st = f.stat()
+                            found.append((st.st_mtime, f.name[:-len(self.suffix)], st.st_size))
+                        elif ".tmp" in f.name and time.time() - f.stat().st_mtime > 3600:
+                            os.remove(f.path)   # leftover of a crashed writer
+                    except FileNotFoundError:
+                        pass                    # evicted / renamed by another worker meanwhile
+        return found
+
+    def _scan(self) -> None:
+        """Startup: load blobs and the key index (caller holds the directory lock)."""
+        self._resync_locked()
+        if os.path.exists(self._index_path):
+            with open(self._index_path, "r") as f:
+                for line in f:
+                    parts = line.split()
+                    if len(parts) == 2 and parts[1] in self._blobs:
+                        self._keys[parts[0]] = parts[1]
+                    self._index_lines += 1
+        self._evict_locked()
+        self._maybe_compact_locked()
+        logger.info(f"Image cache: {len(self._blobs)} blobs, {self.total_bytes / 1e6:.1f} MB, {len(self._keys)} keys")
+
+    def _resync_locked(self) -> None:
+        """Match the blob table to disk: adopt other workers' blobs, forget the ones they evicted."""
+        on_disk = {h: (mtime, size) for mtime, h, size in self._scan_blobs()}
+        for h in [h for h in self._blobs if h not in on_disk]:
+            self._drop_blob_locked(h)
+        for mtime, h, size in sorted((m, h, size) for h, (m, size) in on_disk.items() if h not in self._blobs):
+            self._blobs[h] = size
+            self._touched[h] = mtime
+            self.total_bytes += size
+        self._unsynced_bytes = 0
+
+    # ---------- lookup ----------
+    def get(self, key: str) -> Optional[CachedImage]:
+        with self._lock:
+            h = self._keys.get(key)
+        if h is None:
+            with self._lock:
+                self.misses += 1
+            return None
+        return self.get_content(h)
+
+    def get_content(self, content_hash: str) -> Optional[CachedImage]:
+        h = content_hash
+        with self._lock:
+            if h not in self._blobs:
+                self.misses += 1
+                return None
+            self._blobs.move_to_end(h)
+            touch = time.time() - self._touched.get(h, 0.0) > _TOUCH_INTERVAL_S
+            if touch:
+                self._touched[h] = time.time()
+        path = self._blob_path(h)
+        try:
+            if touch:
+                os.utime(path)
+            with open(path, "rb") as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            # evicted by another worker, or empty file
+            with self._lock:
+                self._drop_blob_locked(h)
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return CachedImage(h, path, data)
+
+    def contains_content(self, content_hash: str) -> bool:
+        with self._lock:
+            return content_hash in self._blobs
+
+    # ---------- store ----------
+    def put(self, key: str, data: bytes, content_hash: str) -> bool:
+        """
+        Store bytes for key. Returns True if the same content was already cached
+        (then only the key -> blob mapping is recorded).
+        """
+        duplicate = self.put_content(content_hash, data)
+        with self._lock:
+            if self._keys.get(key) != content_hash:
+                self._keys[key] = content_hash
+                self._append_index_locked(key, content_hash)
+        return duplicate
+
+    def put_content(self, content_hash: str, data: bytes) -> bool:
+        """Store a blob under its content hash; returns True if it was already cached."""
+        with self._lock:
+            duplicate = content_hash in self._blobs
+        if not duplicate:
+            path = self._blob_path(content_hash)
+            shard = os.path.dirname(path)
+            os.makedirs(shard, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=shard, prefix=f".{content_hash[:8]}.", suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(data)
+                os.replace(tmp, path)
+            except BaseException:
+                try:
+                    os.remove(tmp)
+                except OSError:
+                    pass
+                raise
+
+        with self._lock:
+            if not duplicate and content_hash not in self._blobs:
+                self._blobs[content_hash] = len(data)
+                self._touched[content_hash] = time.time()
+                self.total_bytes += len(data)
+                self._unsynced_bytes += len(data)
+                self.writes += 1
+            if content_hash in self._blobs:
+                self._blobs.move_to_end(content_hash)
+            if self.total_bytes > self.max_bytes or self._unsynced_bytes > self.max_bytes // _SYNC_FRACTION:
+                with self._dir_lock():
+                    self._resync_locked()
+                    self._evict_locked()
+                    self._maybe_compact_locked()
+        return duplicate
+
+    def _append_index_locked(self, key: str, content_hash: str) -> None:
+        with self._dir_lock(shared=True):   # not while another worker rewrites the file
+            with open(self._index_path, "a") as f:
+                f.write(f"{key} {content_hash}\n")
+        self._index_lines += 1
+        if self._index_lines > 2 * len(self._keys) + 1024:
+            with self._dir_lock():
+                self._resync_locked()
+                self._compact_index_locked()
+
+    def _maybe_compact_locked(self) -> None:
+        # key -> evicted blob entries are dropped lazily by get(); prune once they dominate
+        if len(self._keys) > 4 * max(1, len(self._blobs)) + 1024 or self._index_lines > 2 * len(self._keys) + 1024:
+            self._compact_index_locked()
+
+    def _compact_index_locked(self) -> None:
+        """Rewrite index.log with the live keys, other workers' lines included (under the directory lock)."""
+        keys = {}
+        if os.path.exists(self._index_path):
+            with open(self._index_path, "r") as f:
+                for line in f:
+                    parts = line.split()
+                    if len(parts) == 2 and parts[1] in self._blobs:
+                        keys[parts[0]] = parts[1]
+        keys.update((k, h) for k, h in self._keys.items() if h in self._blobs)
+        self._keys = keys
+        fd, tmp = tempfile.mkstemp(dir=self.root, prefix=".index.", suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            for k, h in self._keys.items():
+                f.write(f"{k} {h}\n")
+        os.replace(tmp, self._index_path)
+        self._index_lines = len(self._keys)
+
+    # ---------- eviction ----------
+    def _drop_blob_locked(self, content_hash: str) -> None:
+        size = self._blobs.pop(content_hash, None)
+        self._touched.pop(content_hash, None)
+        if size is not None:
+            self.total_bytes -= size
+
+    def _evict_locked(self) -> None:
+        """Delete least recently used blobs down to max_bytes (under the directory lock)."""
+        while self.total_bytes > self.max_bytes and self._blobs:
+            h, _ = next(iter(self._blobs.items()))
+            self._drop_blob_locked(h)
+            self.evictions += 1
+            try:
+                os.remove(self._blob_path(h))
+            except OSError:
+                pass
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "keys": len(self._keys),
+                "blobs": len(self._blobs),
+                "bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": (self.hits / lookups) if lookups else 0.0,
+                "writes": self.writes,
+                "evictions": self.evictions,
+            }
@@ -5,11 +5,24 @@
 #          Require TOTAL_VOTE_REQUIRE=8 passed pairs; else final_prob=0
 #          Aggregate passed pairs into clothing_value using agg (default "weighted_pos")
 #          final_prob = clothing_value
-# Efficiency: exactly one CLIP forward per stage (batch prompts)
+# Efficiency: the image is loaded and encoded exactly once; both stages score against that embedding
 # Important: For every pair (pos_text, neg_text), we re-normalize to ensure pos_prob+neg_prob == 1,
 #            regardless of whether upstream returns global softmax or raw logits.
 
-from .clip_wrapper import predict_probs_from_url
+import json
+import logging
+import time
+
+import numpy as np
+import torch
+
+from . import config
+from .clip_wrapper import (FetchedImage, aencode_fetched, afetch_images, build_text_bank, encode_fetched,
+                           encode_deadline, encoder_id, fetch_images, predict_probs_matrix, prompt_set_hash, run_in_inference_pool)
+from .result_cache import ResultCache
+from .stages import STAGES
+
+logger = logging.getLogger(__name__)
 
 # ====== Thresholds (tunable) ======
 MARGIN_THRESHOLD = 0.5           # positive prob lower bound for a pair to be considered
@@ -64,6 +77,14 @@ FEMALE_PAIRS = [
     ("a woman in the photo", "a man in the photo"),
 ]
 
+# Every prompt the 2-stage pipeline can ask for; precomputed once into the text bank
+ALL_PAIR_PROMPTS = [t for pairs in (FEMALE_PAIRS, PERSON_PAIRS, FORM_FIT_PAIRS, BODY_EXPOSURE_PAIRS)
+                    for pair in pairs for t in pair]
+
+def warm_text_bank(model, device) -> str:
+    """Build (or load from disk) the text features for all gate + FF/BE prompts."""
+    return build_text_bank(ALL_PAIR_PROMPTS, model, device)
+
 # ====== Helpers ======
 def _judge_pair_by_thresholds(pos_prob: float, neg_prob: float) -> dict:
     maxp = max(pos_prob, neg_prob)
@@ -99,6 +120,8 @@ def _weighted_mean(pairs, value_key="pos_prob", weight_key="diff"):
         return None, 0.0
     return num / den, den
 
+AGG_MODES = ("weighted_pos", "weighted_gap", "max_pos", "max_gap")
+
 def _aggregate_value_from_passed(records, agg="weighted_pos", weight_key="diff"):
     """
     Aggregate a single score from passed=True records.
@@ -153,224 +176,373 @@ def _pairs_to_prompts_with_index(group_name, pairs):
         idx_map[(group_name, i, "neg")] = len(prompts); prompts.append(neg)
     return prompts, idx_map
 
-def _gather_rows(scores_dict, prompts, idx_map, group_name, num_pairs):
+# ====== Array helpers: same rules over an [images x pairs] matrix ======
+# Sums use a left-to-right cumsum so results are bit-identical to the dict helpers above.
+def _seqsum(x):
+    if x.shape[1] == 0:
+        return np.zeros(x.shape[0], dtype=np.float64)
+    return np.cumsum(x, axis=1)[:, -1]
+
+def _renormalize_pairs(probs, pos_cols, neg_cols):
+    """probs: [N, P] prompt softmax -> (pos, neg) of shape [N, pairs] with pos+neg == 1 (0/0 -> 0)."""
+    raw_pos = probs[:, pos_cols]
+    raw_neg = probs[:, neg_cols]
+    denom = raw_pos + raw_neg
+    ok = denom > 0.0
+    safe = np.where(ok, denom, 1.0)
+    return np.where(ok, raw_pos / safe, 0.0), np.where(ok, raw_neg / safe, 0.0)
+
+def _judge_pairs_array(pos, neg) -> dict:
+    """Vectorized _judge_pair_by_thresholds; every value is an [N, pairs] array."""
+    maxp = np.maximum(pos, neg)
+    diff = pos - neg
+    evidence_ok = maxp >= BORDERLINE_ABS_MARGIN
+    margin_ok = pos >= MARGIN_THRESHOLD
+    gap_ok = diff >= DIFF_MIN
+    return {
+        "pos_prob": pos,
+        "neg_prob": neg,
+        "diff": diff,
+        "evidence_ok": evidence_ok,
+        "margin_ok": margin_ok,
+        "gap_ok": gap_ok,
+        "passed": evidence_ok & margin_ok & gap_ok,
+        "confidence": maxp,
+    }
+
+def _judged_column(judged, key):
+    """Array counterpart of record.get(key, 0.0)."""
+    if key in judged:
+        return judged[key].astype(np.float64)
+    return np.zeros(judged["diff"].shape)
+
+def _concat_judged(*judged):
+    return {k: np.concatenate([j[k] for j in judged], axis=1) for k in judged[0]}
+
+def _weighted_mean_array(values, weights, mask):
+    """Row-wise _weighted_mean over the masked columns -> (value or nan, weight_sum)."""
+    use = mask & (weights > 0)
+    num = _seqsum(np.where(use, weights * values, 0.0))
+    den = _seqsum(np.where(use, weights, 0.0))
+    ok = den > 0
+    return np.where(ok, num / np.where(ok, den, 1.0), np.nan), np.where(ok, den, 0.0)
+
+def _aggregate_group_score_array(judged, value_key="pos_prob", weight_key="diff"):
+    """Vectorized _aggregate_group_score_all -> (score [N], used [N], weight_sum [N])."""
+    usable = judged["evidence_ok"] & (judged["diff"] > 0.0)
+    val, wsum = _weighted_mean_array(_judged_column(judged, value_key), _judged_column(judged, weight_key), usable)
+    ok = ~np.isnan(val)
+    return np.where(ok, val, 0.0), np.where(ok, usable.sum(axis=1), 0), wsum
+
+def _aggregate_value_from_passed_array(judged, agg="weighted_pos", weight_key="diff"):
     """
-    Build per-pair rows with *pairwise renormalization* so that:
-        pos_prob + neg_prob == 1   (unless both raw scores are 0)
-    This keeps our thresholds meaningful even if upstream used a global softmax.
+    Vectorized _aggregate_value_from_passed.
+    Returns (value [N], nan where the dict helper returns None) and a list of per-row meta dicts.
     """
-    rows = []
-    for i in range(num_pairs):
-        pos_p = prompts[idx_map[(group_name, i, "pos")]]
-        neg_p = prompts[idx_map[(group_name, i, "neg")]]
-
-        raw_pos = float(scores_dict.get(pos_p, 0.0))
-        raw_neg = float(scores_dict.get(neg_p, 0.0))
-
-        denom = raw_pos + raw_neg
-        if denom <= 0.0:
-            pos_prob = 0.0
-            neg_prob = 0.0
+    passed = judged["passed"]
+    pos, diff = judged["pos_prob"], judged["diff"]
+    n_rows = pos.shape[0]
+    votes = passed.sum(axis=1)
+    weights = _judged_column(judged, weight_key)
+
+    best_pos = np.where(passed, pos, -np.inf).argmax(axis=1) if pos.shape[1] else np.zeros(n_rows, dtype=int)
+    best_gap = np.where(passed, diff, -np.inf).argmax(axis=1) if pos.shape[1] else np.zeros(n_rows, dtype=int)
+    rows = np.arange(n_rows)
+    max_pos_val = pos[rows, best_pos] if pos.shape[1] else np.full(n_rows, np.nan)
+
+    wpos, wpos_sum = _weighted_mean_array(pos, weights, passed)
+    wgap, wgap_sum = _weighted_mean_array(diff, weights, passed)
+
+    values = np.full(n_rows, np.nan)
+    metas = []
+    for i in range(n_rows):
+        used = int(votes[i])
+        if used == 0:
+            metas.append({"mode": agg, "used_votes": 0})
+        elif agg == "max_pos":
+            values[i] = max_pos_val[i]
+            metas.append({"mode": "max_pos", "used_votes": used})
+        elif agg == "max_gap":
+            values[i] = pos[i, best_gap[i]]
+            metas.append({"mode": "max_gap", "used_votes": used, "best_gap": float(diff[i, best_gap[i]])})
+        elif agg == "weighted_gap" and not np.isnan(wgap[i]):
+            values[i] = wgap[i]
+            metas.append({"mode": f"weighted_gap[{weight_key}]", "used_votes": used, "weight_sum": float(wgap_sum[i])})
+        elif not np.isnan(wpos[i]):
+            values[i] = wpos[i]
+            metas.append({"mode": f"weighted_pos[{weight_key}]", "used_votes": used, "weight_sum": float(wpos_sum[i])})
         else:
-            pos_prob = raw_pos / denom
-            neg_prob = raw_neg / denom
+            values[i] = max_pos_val[i]
+            metas.append({"mode": "fallback_max_pos", "used_votes": used})
+    return values, metas
+
+def _judged_records(judged, row, pairs):
+    """Rebuild the dict-path record list for one row of an array-judged group."""
+    out = []
+    for j, (pos_txt, neg_txt) in enumerate(pairs):
+        out.append({
+            "pos_prob": float(judged["pos_prob"][row, j]),
+            "neg_prob": float(judged["neg_prob"][row, j]),
+            "diff": float(judged["diff"][row, j]),
+            "evidence_ok": bool(judged["evidence_ok"][row, j]),
+            "margin_ok": bool(judged["margin_ok"][row, j]),
+            "gap_ok": bool(judged["gap_ok"][row, j]),
+            "passed": bool(judged["passed"][row, j]),
+            "confidence": float(judged["confidence"][row, j]),
+            "pos_text": pos_txt,
+            "neg_text": neg_txt,
+        })
+    return out
+
+def _compact_pairs(judged, row):
+    """[[pos_prob, neg_prob, passed], ...] for one row; position = pair index in prompt_set()."""
+    return [[float(p), float(n), bool(ok)]
+            for p, n, ok in zip(judged["pos_prob"][row], judged["neg_prob"][row], judged["passed"][row])]
+
+def _optional_float(v):
+    return None if np.isnan(v) else float(v)
+
+def _thresholds():
+    return {
+        "GATE_THRESHOLD": GATE_THRESHOLD,
+        "MARGIN_THRESHOLD": MARGIN_THRESHOLD,
+        "BORDERLINE_ABS_MARGIN": BORDERLINE_ABS_MARGIN,
+        "DIFF_MIN": DIFF_MIN,
+        "TOTAL_VOTE_REQUIRE": TOTAL_VOTE_REQUIRE,
+        "EXPECTED_TOTAL_PAIRS": EXPECTED_TOTAL_PAIRS,
+    }
 
-        rows.append((pos_prob, neg_prob, pos_p, neg_p))
-    return rows
+def _pair_columns(pairs, offset=0):
+    """Prompt layout used by _pairs_to_prompts_with_index: pos at 2i, neg at 2i+1."""
+    return ([offset + 2 * i for i in range(len(pairs))],
+            [offset + 2 * i + 1 for i in range(len(pairs))])
 
 # ====== Main pipeline: 2-stage ======
 def evaluate_image(image_url, model, preprocess, device, timeout=8,
                    agg="weighted_pos", weight_key="diff",
                    fast=True, k=4):
     """
-    Stage-1: PERSON + FEMALE gate (one forward; Top-K per group; both >= GATE_THRESHOLD)
-    Stage-2: Merge FF + BE (one forward; ALWAYS evaluate all 13 pairs; require votes >= 8)
+    Stage-1: PERSON + FEMALE gate (Top-K per group; both >= GATE_THRESHOLD)
+    Stage-2: Merge FF + BE (ALWAYS evaluate all 13 pairs; require votes >= 8)
              final_prob = clothing_value (aggregated with 'agg', default weighted_pos)
+    Single-URL evaluate_images: same array path, result cache and output.
     """
-    # ---------- Stage-1 (PERSON + FEMALE gate in one forward) ----------
-    def _select_idx(pairs, k):
-        return list(range(min(k, len(pairs)))) if fast else list(range(len(pairs)))
-
-    female_idx = _select_idx(FEMALE_PAIRS, k)
-    person_idx = _select_idx(PERSON_PAIRS, k)  # PERSON currently 1 pair
-
-    f_prompts, f_map = _pairs_to_prompts_with_index("FEMALE", [FEMALE_PAIRS[i] for i in female_idx])
-    p_prompts, p_map = _pairs_to_prompts_with_index("PERSON", [PERSON_PAIRS[i] for i in person_idx])
-
-    stage1_prompts = f_prompts + p_prompts
-
-    # stage1_map with PERSON offset
-    stage1_map = {}
-    stage1_map.update(f_map)
-    offset1 = len(f_prompts)
-    stage1_map.update({k: idx + offset1 for k, idx in p_map.items()})
-
-    res1 = predict_probs_from_url(image_url, model, preprocess, device, stage1_prompts, timeout=timeout)
-    s1 = res1.get("scores", {}) if isinstance(res1, dict) else {}
-    if not s1 or len(s1) < len(stage1_prompts):
-        return {
-            "url": image_url,
-            "final_prob": 0.0,
-            "error": "stage1_scores_incomplete",
-            "thresholds": {
-                "GATE_THRESHOLD": GATE_THRESHOLD,
-                "MARGIN_THRESHOLD": MARGIN_THRESHOLD,
-                "BORDERLINE_ABS_MARGIN": BORDERLINE_ABS_MARGIN,
-                "DIFF_MIN": DIFF_MIN,
-                "TOTAL_VOTE_REQUIRE": TOTAL_VOTE_REQUIRE,
-                "EXPECTED_TOTAL_PAIRS": EXPECTED_TOTAL_PAIRS,
-            }
-        }
+    return evaluate_images([image_url], model, preprocess, device, timeout=timeout,
+                           agg=agg, weight_key=weight_key, fast=fast, k=k)[0]
+
+# ====== Result cache ======
+# Keyed by image content (not URL) + encoder (model, decode path) + prompt/threshold version + aggregation options,
+# so editing prompts or thresholds above naturally invalidates old entries.
+RESULT_CACHE = ResultCache(max_items=config.RESULT_CACHE_SIZE,
+                           ttl_s=config.RESULT_CACHE_TTL_S,
+                           sqlite_path=config.RESULT_CACHE_DB or None)
 
-    def _judge_rows(rows):
-        out = []
-        for pos_prob, neg_prob, pos_txt, neg_txt in rows:
-            rec = _judge_pair_by_thresholds(pos_prob, neg_prob)
-            rec.update({"pos_text": pos_txt, "neg_text": neg_txt})
-            out.append(rec)
+def rules_version() -> str:
+    return prompt_set_hash(ALL_PAIR_PROMPTS + [json.dumps(_thresholds(), sort_keys=True)])
+
+def _result_key(content_hash, model, agg, weight_key, fast, k, detail):
+    return f"{content_hash}|{encoder_id(model)}|{rules_version()}|{agg}|{weight_key}|{int(bool(fast))}:{k}|{detail}"
+
+DETAIL_LEVELS = ("minimal", "scores", "full")
+
+def prompt_set() -> dict:
+    """
+    Prompt pairs and thresholds that detail="scores" results refer to by index
+    (results carry the same id in "prompt_set"; fast mode uses the first k gate pairs).
+    """
+    return {
+        "id": rules_version(),
+        "pairs": {"female": FEMALE_PAIRS, "person": PERSON_PAIRS, "ff": FORM_FIT_PAIRS, "be": BODY_EXPOSURE_PAIRS},
+        "thresholds": _thresholds(),
+    }
+
+def _split_cached(image_urls, fetched, opts):
+    """Fill cache hits; returns (out, miss positions, keys)."""
+    out, misses, keys = [None] * len(image_urls), [], {}
+    for i, f in enumerate(fetched):
+        if isinstance(f, FetchedImage):
+            keys[i] = _result_key(f.content_hash, *opts)
+            hit = RESULT_CACHE.get(keys[i])
+            if hit is not None:
+                hit["url"] = image_urls[i]
+                out[i] = hit
+                continue
+        misses.append(i)
+    return out, misses, keys
+
+def _merge_fresh(out, misses, keys, fresh):
+    for i, r in zip(misses, fresh):
+        out[i] = r
+        if i in keys and "error" not in r:
+            RESULT_CACHE.put(keys[i], {k: v for k, v in r.items() if k != "url"})
+    return out
+
+def evaluate_images(image_urls, model, preprocess, device, timeout=8,
+                    agg="weighted_pos", weight_key="diff",
+                    fast=True, k=4, scheduler=None, detail="full"):
+    """
+    Batched evaluate_image: all URLs go through the image tower together,
+    the gate is computed for the whole batch at once, and Stage-2 only scores rows that pass it.
+    Results keep request order and match evaluate_image row for row; errors stay per URL.
+    Images already scored (same bytes, same rules) come from RESULT_CACHE without a forward.
+    scheduler: optional app.scheduler.EncodeScheduler to share image-tower forwards across requests.
+    detail: "full" (same dicts as evaluate_image), "scores" (numbers only, prompts by index into
+            prompt_set()) or "minimal" (url + final_prob; no breakdowns are built).
+    """
+    fetched = fetch_images(image_urls, timeout=timeout, deadline=time.monotonic() + timeout)
+    return evaluate_fetched(image_urls, fetched, model, preprocess, device, agg=agg, weight_key=weight_key,
+                            fast=fast, k=k, scheduler=scheduler, detail=detail, deadline=encode_deadline())
+
+def evaluate_fetched(image_urls, fetched, model, preprocess, device,
+                     agg="weighted_pos", weight_key="diff",
+                     fast=True, k=4, scheduler=None, detail="full", deadline=None):
+    """
+    The part of evaluate_images after the download: `fetched` is fetch_images(image_urls)'s output,
+    so a caller can fetch the next batch while this one is encoded (see app/bulk.py).
+    """
+    out, misses, keys = _split_cached(image_urls, fetched, (model, agg, weight_key, fast, k, detail))
+    if not misses:
+        return out
+    encoded = encode_fetched([fetched[i] for i in misses], model, preprocess, device,
+                             scheduler=scheduler, deadline=deadline)
+    fresh = _evaluate_batch_from_features([image_urls[i] for i in misses], encoded, model, device,
+                                          agg=agg, weight_key=weight_key, fast=fast, k=k, detail=detail)
+    return _merge_fresh(out, misses, keys, fresh)
+
+async def aevaluate_images(image_urls, model, preprocess, device, timeout=8,
+                           agg="weighted_pos", weight_key="diff",
+                           fast=True, k=4, scheduler=None, detail="full"):
+    """Async evaluate_images: awaits downloads and the encoder, scores on the inference pool."""
+    fetched = await afetch_images(image_urls, timeout=timeout, deadline=time.monotonic() + timeout)
+    out, misses, keys = _split_cached(image_urls, fetched, (model, agg, weight_key, fast, k, detail))
+    if not misses:
+        return out
+    encoded = await aencode_fetched([fetched[i] for i in misses], model, preprocess, device,
+                                    scheduler=scheduler, deadline=encode_deadline())
+    fresh = await run_in_inference_pool(_evaluate_batch_from_features, [image_urls[i] for i in misses], encoded,
+                                        model, device, agg=agg, weight_key=weight_key, fast=fast, k=k,
+                                        detail=detail)
+    return _merge_fresh(out, misses, keys, fresh)
+
+@STAGES.timed("scoring")
+def _evaluate_batch_from_features(image_urls, encoded, model, device,
+                                  agg="weighted_pos", weight_key="diff",
+                                  fast=True, k=4, detail="full"):
+    """Array path of the 2-stage rules; `encoded` holds [1, D] features or an Exception per URL."""
+    if detail not in DETAIL_LEVELS:
+        raise ValueError(f"detail must be one of {DETAIL_LEVELS}, got {detail!r}")
+    out = [None] * len(image_urls)
+    ok = []
+    for i, (u, feats) in enumerate(zip(image_urls, encoded)):
+        if isinstance(feats, Exception) or feats is None:
+            out[i] = {"url": u, "final_prob": 0.0, "error": "stage1_scores_incomplete"}
+            if detail == "full":
+                out[i]["thresholds"] = _thresholds()
+        else:
+            ok.append(i)
+    if not ok:
         return out
 
-    female_rows = _gather_rows(s1, stage1_prompts, stage1_map, "FEMALE", len(female_idx))
-    person_rows = _gather_rows(s1, stage1_prompts, stage1_map, "PERSON", len(person_idx))
-
-    female_judged = _judge_rows(female_rows)
-    person_judged = _judge_rows(person_rows)
-
-    female_score, female_meta2 = _aggregate_group_score_all(female_judged, value_key="pos_prob", weight_key="diff")
-    person_score, person_meta2 = _aggregate_group_score_all(person_judged, value_key="pos_prob", weight_key="diff")
-
-    gate_pass = (female_score >= GATE_THRESHOLD and person_score >= GATE_THRESHOLD)
-    if not gate_pass:
-        return {
-            "url": image_url,
-            "final_prob": 0.0,
-            "clothing_value": None,
-            "clothing_meta": {"skipped": True, "reason": "gate_not_pass"},
-            "ff_breakdown": {"pairs": [], "votes": 0},
-            "be_breakdown": {"pairs": [], "votes": 0},
-            "person_meta": {"pairs": person_judged, "score": person_score, "gate_threshold": GATE_THRESHOLD, **person_meta2},
-            "female_meta": {"pairs": female_judged, "score": female_score, "gate_threshold": GATE_THRESHOLD, **female_meta2},
-            "thresholds": {
-                "GATE_THRESHOLD": GATE_THRESHOLD,
-                "MARGIN_THRESHOLD": MARGIN_THRESHOLD,
-                "BORDERLINE_ABS_MARGIN": BORDERLINE_ABS_MARGIN,
-                "DIFF_MIN": DIFF_MIN,
-                "TOTAL_VOTE_REQUIRE": TOTAL_VOTE_REQUIRE,
-                "EXPECTED_TOTAL_PAIRS": EXPECTED_TOTAL_PAIRS,
+    # ---------- Stage-1: vectorized gate over the whole batch ----------
+    n_sel = lambda pairs: min(k, len(pairs)) if fast else len(pairs)
+    female_pairs = FEMALE_PAIRS[:n_sel(FEMALE_PAIRS)]
+    person_pairs = PERSON_PAIRS[:n_sel(PERSON_PAIRS)]
+    f_prompts, _ = _pairs_to_prompts_with_index("FEMALE", female_pairs)
+    p_prompts, _ = _pairs_to_prompts_with_index("PERSON", person_pairs)
+
+    feats = torch.cat([encoded[i] for i in ok], dim=0)
+    probs1 = np.asarray(predict_probs_matrix(feats, model, device, f_prompts + p_prompts), dtype=np.float64)
+
+    female_j = _judge_pairs_array(*_renormalize_pairs(probs1, *_pair_columns(female_pairs)))
+    person_j = _judge_pairs_array(*_renormalize_pairs(probs1, *_pair_columns(person_pairs, len(f_prompts))))
+    female_score, female_used, female_wsum = _aggregate_group_score_array(female_j)
+    person_score, person_used, person_wsum = _aggregate_group_score_array(person_j)
+    gate_pass = (female_score >= GATE_THRESHOLD) & (person_score >= GATE_THRESHOLD)
+
+    def _gate_meta(judged, pairs, score, used, wsum, r):
+        return {"pairs": _judged_records(judged, r, pairs), "score": float(score[r]),
+                "gate_threshold": GATE_THRESHOLD, "mode": "gate_weighted[pos_prob|diff]",
+                "used": int(used[r]), "weight_sum": float(wsum[r])}
+
+    # ---------- Stage-2: only rows that passed the gate ----------
+    passed_rows = np.flatnonzero(gate_pass)
+    if len(passed_rows):
+        ff_prompts, _ = _pairs_to_prompts_with_index("FF", FORM_FIT_PAIRS)
+        be_prompts, _ = _pairs_to_prompts_with_index("BE", BODY_EXPOSURE_PAIRS)
+        probs2 = np.asarray(predict_probs_matrix(feats[passed_rows.tolist()], model, device, ff_prompts + be_prompts),
+                            dtype=np.float64)
+        ff_j = _judge_pairs_array(*_renormalize_pairs(probs2, *_pair_columns(FORM_FIT_PAIRS)))
+        be_j = _judge_pairs_array(*_renormalize_pairs(probs2, *_pair_columns(BODY_EXPOSURE_PAIRS, len(ff_prompts))))
+        cl_j = _concat_judged(ff_j, be_j)
+        ff_votes = ff_j["passed"].sum(axis=1)
+        be_votes = be_j["passed"].sum(axis=1)
+        cl_value, cl_metas = _aggregate_value_from_passed_array(cl_j, agg=agg, weight_key=weight_key)
+        if detail != "minimal":
+            ff_value, _ = _aggregate_value_from_passed_array(ff_j, agg=agg, weight_key=weight_key)
+            be_value, _ = _aggregate_value_from_passed_array(be_j, agg=agg, weight_key=weight_key)
+    stage2_row = {int(r): j for j, r in enumerate(passed_rows)}
+    clothing_pairs = FORM_FIT_PAIRS + BODY_EXPOSURE_PAIRS
+
+    if detail != "full":
+        set_id = rules_version()
+        for r, i in enumerate(ok):
+            j = stage2_row.get(r)
+            votes = int(ff_votes[j] + be_votes[j]) if j is not None else 0
+            clothing_value = _optional_float(cl_value[j]) if j is not None else None
+            final_prob = float(clothing_value or 0.0) if votes >= TOTAL_VOTE_REQUIRE else 0.0
+            if detail == "minimal":
+                out[i] = {"url": image_urls[i], "final_prob": final_prob}
+                continue
+            pairs = {"female": _compact_pairs(female_j, r), "person": _compact_pairs(person_j, r)}
+            if j is not None:
+                pairs["ff"] = _compact_pairs(ff_j, j)
+                pairs["be"] = _compact_pairs(be_j, j)
+            out[i] = {
+                "url": image_urls[i],
+                "final_prob": final_prob,
+                "clothing_value": clothing_value,
+                "ff_value": _optional_float(ff_value[j]) if j is not None else None,
+                "be_value": _optional_float(be_value[j]) if j is not None else None,
+                "votes": votes,
+                "gate": {"female": float(female_score[r]), "person": float(person_score[r]),
+                         "passed": bool(gate_pass[r])},
+                "pairs": pairs,
+                "prompt_set": set_id,
             }
-        }
+        return out
 
-    # ---------- Stage-2 (ALWAYS full coverage: FF6 + BE7) ----------
-    ff_pairs = FORM_FIT_PAIRS          # 6
-    be_pairs = BODY_EXPOSURE_PAIRS     # 7
-
-    ff_prompts, ff_map = _pairs_to_prompts_with_index("FF", ff_pairs)
-    be_prompts, be_map = _pairs_to_prompts_with_index("BE", be_pairs)
-
-    stage2_prompts = ff_prompts + be_prompts
-
-    # stage2_map with BE offset
-    stage2_map = {}
-    stage2_map.update(ff_map)
-    offset2 = len(ff_prompts)
-    stage2_map.update({k: idx + offset2 for k, idx in be_map.items()})
-
-    res2 = predict_probs_from_url(image_url, model, preprocess, device, stage2_prompts, timeout=timeout)
-    s2 = res2.get("scores", {}) if isinstance(res2, dict) else {}
-    if not s2 or len(s2) < len(stage2_prompts):
-        return {
-            "url": image_url,
-            "final_prob": 0.0,
-            "error": "stage2_scores_incomplete",
-            "person_meta": {"pairs": person_judged, "score": person_score, "gate_threshold": GATE_THRESHOLD, **person_meta2},
-            "female_meta": {"pairs": female_judged, "score": female_score, "gate_threshold": GATE_THRESHOLD, **female_meta2},
-            "thresholds": {
-                "GATE_THRESHOLD": GATE_THRESHOLD,
-                "MARGIN_THRESHOLD": MARGIN_THRESHOLD,
-                "BORDERLINE_ABS_MARGIN": BORDERLINE_ABS_MARGIN,
-                "DIFF_MIN": DIFF_MIN,
-                "TOTAL_VOTE_REQUIRE": TOTAL_VOTE_REQUIRE,
-                "EXPECTED_TOTAL_PAIRS": EXPECTED_TOTAL_PAIRS,
+    for r, i in enumerate(ok):
+        person_meta = _gate_meta(person_j, person_pairs, person_score, person_used, person_wsum, r)
+        female_meta = _gate_meta(female_j, female_pairs, female_score, female_used, female_wsum, r)
+        if r not in stage2_row:
+            out[i] = {
+                "url": image_urls[i],
+                "final_prob": 0.0,
+                "clothing_value": None,
+                "clothing_meta": {"skipped": True, "reason": "gate_not_pass"},
+                "ff_breakdown": {"pairs": [], "votes": 0},
+                "be_breakdown": {"pairs": [], "votes": 0},
+                "person_meta": person_meta,
+                "female_meta": female_meta,
+                "thresholds": _thresholds(),
             }
-        }
-
-    def _judge_and_count(rows):
-        judged, votes = [], 0
-        for pos_prob, neg_prob, pos_txt, neg_txt in rows:
-            rec = _judge_pair_by_thresholds(pos_prob, neg_prob)
-            rec.update({"pos_text": pos_txt, "neg_text": neg_txt})
-            judged.append(rec)
-            if rec["passed"]:
-                votes += 1
-        return judged, votes
-
-    ff_rows = _gather_rows(s2, stage2_prompts, stage2_map, "FF", len(ff_pairs))
-    be_rows = _gather_rows(s2, stage2_prompts, stage2_map, "BE", len(be_pairs))
-
-    ff_judged, ff_votes = _judge_and_count(ff_rows)
-    be_judged, be_votes = _judge_and_count(be_rows)
-
-    # === DEBUG PRINT for pairwise probs ===
-    # print("\n===== [PAIRWISE RESULTS] =====")
-    # for rec in ff_judged + be_judged:
-    #     print(f"[{'FF' if rec in ff_judged else 'BE'}] "
-    #           f"pos={rec['pos_prob']:.3f}, neg={rec['neg_prob']:.3f}, diff={rec['diff']:.3f}, "
-    #           f"passed={rec['passed']}, "
-    #           f"{rec['pos_text']}  |  {rec['neg_text']}")
-    # print("==============================\n")
-
-
-    # Combined pool
-    clothing_judged = ff_judged + be_judged
-    clothing_votes = ff_votes + be_votes
-    clothing_total = len(ff_pairs) + len(be_pairs)  # should be 13
-
-    # Aggregate
-    clothing_value, clothing_meta2 = _aggregate_value_from_passed(clothing_judged, agg=agg, weight_key=weight_key)
-    ff_value, _ = _aggregate_value_from_passed(ff_judged, agg=agg, weight_key=weight_key)
-    be_value, _ = _aggregate_value_from_passed(be_judged, agg=agg, weight_key=weight_key)
-
-    if clothing_votes < TOTAL_VOTE_REQUIRE:
-        return {
-            "url": image_url,
-            "final_prob": 0.0,
+            continue
+
+        j = stage2_row[r]
+        votes = int(ff_votes[j] + be_votes[j])
+        clothing_value = _optional_float(cl_value[j])
+        out[i] = {
+            "url": image_urls[i],
+            "final_prob": float(clothing_value or 0.0) if votes >= TOTAL_VOTE_REQUIRE else 0.0,
             "clothing_value": clothing_value,
-            "clothing_meta": {**clothing_meta2, "votes": clothing_votes, "pairs": clothing_judged, "total_pairs": clothing_total},
-            "ff_breakdown": {"pairs": ff_judged, "votes": ff_votes},
-            "be_breakdown": {"pairs": be_judged, "votes": be_votes},
-            "ff_value": ff_value,
-            "be_value": be_value,
-            "person_meta": {"pairs": person_judged, "score": person_score, "gate_threshold": GATE_THRESHOLD, **person_meta2},
-            "female_meta": {"pairs": female_judged, "score": female_score, "gate_threshold": GATE_THRESHOLD, **female_meta2},
-            "thresholds": {
-                "GATE_THRESHOLD": GATE_THRESHOLD,
-                "MARGIN_THRESHOLD": MARGIN_THRESHOLD,
-                "BORDERLINE_ABS_MARGIN": BORDERLINE_ABS_MARGIN,
-                "DIFF_MIN": DIFF_MIN,
-                "TOTAL_VOTE_REQUIRE": TOTAL_VOTE_REQUIRE,
-                "EXPECTED_TOTAL_PAIRS": EXPECTED_TOTAL_PAIRS,
-            }
+            "clothing_meta": {**cl_metas[j], "votes": votes, "pairs": _judged_records(cl_j, j, clothing_pairs),
+                              "total_pairs": len(clothing_pairs)},
+            "ff_breakdown": {"pairs": _judged_records(ff_j, j, FORM_FIT_PAIRS), "votes": int(ff_votes[j])},
+            "be_breakdown": {"pairs": _judged_records(be_j, j, BODY_EXPOSURE_PAIRS), "votes": int(be_votes[j])},
+            "ff_value": _optional_float(ff_value[j]),
+            "be_value": _optional_float(be_value[j]),
+            "person_meta": person_meta,
+            "female_meta": female_meta,
+            "thresholds": _thresholds(),
         }
-
-    final_prob = float(clothing_value or 0.0)
-
-    return {
-        "url": image_url,
-        "final_prob": final_prob,
-        "clothing_value": clothing_value,
-        "clothing_meta": {**clothing_meta2, "votes": clothing_votes, "pairs": clothing_judged, "total_pairs": clothing_total},
-        "ff_breakdown": {"pairs": ff_judged, "votes": ff_votes},
-        "be_breakdown": {"pairs": be_judged, "votes": be_votes},
-        "ff_value": ff_value,
-        "be_value": be_value,
-        "person_meta": {"pairs": person_judged, "score": person_score, "gate_threshold": GATE_THRESHOLD, **person_meta2},
-        "female_meta": {"pairs": female_judged, "score": female_score, "gate_threshold": GATE_THRESHOLD, **female_meta2},
-        "thresholds": {
-            "GATE_THRESHOLD": GATE_THRESHOLD,
-            "MARGIN_THRESHOLD": MARGIN_THRESHOLD,
-            "BORDERLINE_ABS_MARGIN": BORDERLINE_ABS_MARGIN,
-            "DIFF_MIN": DIFF_MIN,
-            "TOTAL_VOTE_REQUIRE": TOTAL_VOTE_REQUIRE,
-            "EXPECTED_TOTAL_PAIRS": EXPECTED_TOTAL_PAIRS,
-        }
-    }
+    return out
@@ -1,17 +1,34 @@
+import asyncio
+import json
 import logging
+import threading
+import time
 import torch 
+from app import config
 
 torch.backends.cudnn.benchmark = True
 torch.set_float32_matmul_precision("high")
+if config.TORCH_THREADS > 0:
+    torch.set_num_threads(config.TORCH_THREADS)
+if config.TORCH_INTEROP_THREADS > 0:
+    torch.set_num_interop_threads(config.TORCH_INTEROP_THREADS)
 
-from fastapi import FastAPI
+from concurrent.futures import Future
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel
-from typing import List, Optional
-from app.clip_wrapper import load_clip_model, predict_probs_from_url
-from app.logic import evaluate_image
-from app.window import push_and_decide, snapshot, MIN_PROB, THRESHOLD
+from typing import List, Literal, Optional
+from app.clip_wrapper import (load_clip_model, apredict_probs_from_urls, decode_pool_stats, dedup_stats,
+                              feature_cache_stats, image_cache_stats, netguard_stats, singleflight_stats,
+                              warmup_image_encoder)
+from app.logic import RESULT_CACHE, aevaluate_images, prompt_set, warm_text_bank
+from app.window import close_store, get_store, push_and_decide, snapshot, store_stats, MIN_PROB, THRESHOLD
 from app.home import router as home_router
+from app.scheduler import EncodeScheduler
+from app.stages import STAGES
 
 # logger = logging.getLogger("uvicorn.error")
 logging.basicConfig(
@@ -22,7 +39,78 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
-app = FastAPI()
+# ---------- Model lifecycle ----------
+# The model is loaded off the import path: in the lifespan hook (MODEL_LOAD=startup blocks startup,
+# =background loads in a thread while the server already answers) or by the first request (=lazy).
+# Requests that need the model wait for the load; GET /ready reports its progress.
+model = preprocess = device = scheduler = None
+_load_lock = threading.Lock()
+_load_future: Optional[Future] = None
+_load_info = {"status": "idle", "error": None, "load_s": None, "warmup_s": {}}
+
+
+def _load_model() -> None:
+    global model, preprocess, device, scheduler
+    start = time.perf_counter()
+    m, p, d = load_clip_model()
+    warm_text_bank(m, d)
+    _load_info["warmup_s"] = warmup_image_encoder(m, d, config.WARMUP_BATCH_SIZES)
+    sched = (EncodeScheduler(m, d,
+                             max_batch=config.SCHEDULER_MAX_BATCH,
+                             max_wait_ms=config.SCHEDULER_MAX_WAIT_MS)
+             if config.SCHEDULER_ENABLED else None)
+    model, preprocess, device, scheduler = m, p, d, sched
+    _load_info["load_s"] = round(time.perf_counter() - start, 3)
+    logger.info(f"Model ready in {_load_info['load_s']}s (warmup {_load_info['warmup_s']})")
+
+
+def _run_load(fut: Future) -> None:
+    try:
+        _load_model()
+    except BaseException as e:
+        logger.exception("Model load failed")
+        _load_info.update(status="failed", error=str(e))
+        fut.set_exception(e)
+    else:
+        _load_info.update(status="ready", error=None)
+        fut.set_result(None)
+
+
+def start_model_load() -> Future:
+    """Start loading the model in a background thread (once; again after a failure)."""
+    global _load_future
+    with _load_lock:
+        if _load_future is None or (_load_future.done() and _load_future.exception() is not None):
+            _load_future = Future()
+            _load_info.update(status="loading", error=None)
+            threading.Thread(target=_run_load, args=(_load_future,), name="model-load", daemon=True).start()
+        return _load_future
+
+
+async def _get_model():
+    """(model, preprocess, device, scheduler), waiting for the load; 503 if it failed."""
+    fut = start_model_load()
+    try:
+        await asyncio.wrap_future(fut)
+    except Exception as e:
+        raise HTTPException(status_code=503, detail=f"model unavailable: {e}")
+    return model, preprocess, device, scheduler
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    get_store()   # replays the window journal, if any, before the first request
+    if config.MODEL_LOAD == "startup":
+        await asyncio.wrap_future(start_model_load())   # a load failure aborts startup
+    elif config.MODEL_LOAD == "background":
+        start_model_load()
+    yield
+    if scheduler is not None:
+        scheduler.close()
+    close_store()
+
+
+app = FastAPI(lifespan=lifespan)
 
 # CORS
 app.add_middleware(
@@ -34,8 +122,6 @@ app.add_middleware(
 )
 
 
-model, preprocess, device = load_clip_model()
-
 # ---------- Schemas ----------
 class AnalyzeReq(BaseModel):
     urls: List[str]
@@ -46,39 +132,89 @@ class AnalyzeReq(BaseModel):
 class EvalReq(BaseModel):
     user_id: str = "default_user"
     urls: List[str]
-    agg: str = "weighted_pos"      # max_pos | max_gap | weighted_pos | weighted_gap
+    agg: Literal["max_pos", "max_gap", "weighted_pos", "weighted_gap"] = "weighted_pos"
     weight_key: str = "diff"       # weighted
     timeout: int = 8
+    detail: Literal["minimal", "scores", "full"] = "full"
+
+# ---------- JSON ----------
+# Results are plain dicts/floats, so they skip FastAPI's jsonable_encoder pass and go straight
+# to orjson (a declared dependency; stdlib json if it is missing).
+try:
+    import orjson
+
+    def _dumps(content) -> bytes:
+        return orjson.dumps(content, option=orjson.OPT_SERIALIZE_NUMPY)
+except ImportError:
+    def _dumps(content) -> bytes:
+        return json.dumps(content, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def _json_response(content) -> Response:
+    return Response(_dumps(content), media_type="application/json")
 
 # ---------- Endpoints ----------
 app.include_router(home_router)
 
+@app.get("/metrics")
+def metrics():
+    """
+    Inference scheduler metrics (queue depth, batch size histogram, expired jobs),
+    single-flight coalescing counters, result cache hit/miss counters
+    URL canonicalization / content dedup ratios, disk image / pixel / embedding cache usage
+    decode process pool slot usage, negative cache / circuit breaker state
+    cumulative time per pipeline stage (download, decode, preprocess, encode, scoring)
+    and the window store in use.
+    """
+    return {
+        "scheduler": scheduler.stats() if scheduler is not None else None,
+        "singleflight": singleflight_stats(),
+        "result_cache": RESULT_CACHE.stats(),
+        "dedup": dedup_stats(),
+        "image_cache": image_cache_stats(),
+        "feature_cache": feature_cache_stats(),
+        "decode_pool": decode_pool_stats(),
+        "netguard": netguard_stats(),
+        "stages": STAGES.stats(),
+        "window": store_stats(),
+    }
+
+@app.get("/ready")
+def ready():
+    """
+    Readiness probe: 200 once the model is loaded and warmed up, 503 while idle (MODEL_LOAD=lazy
+    before the first request), loading, or after a failed load (the next request retries it).
+    """
+    body = {**_load_info, "mode": config.MODEL_LOAD}
+    return JSONResponse(body, status_code=200 if body["status"] == "ready" else 503)
+
+@app.get("/prompt_set")
+def get_prompt_set():
+    """Prompt pairs + thresholds referenced by index from detail="scores" results (matched by "id")."""
+    return prompt_set()
+
 @app.post("/analyze")
-def analyze(req: AnalyzeReq):
+async def analyze(req: AnalyzeReq):
     """
     Pure CLIP probabilities: Run predict_probs_from_url on each image, returning the softmax probability for each prompt.
     Return format（single entry）：
       { "url": "...", "scores": { "<prompt>": 0.12, ... } }
     """
-    results = []
-    for u in req.urls:
-        try:
-            DEFAULT_PROMPTS = ["a normal woman", "a woman showing her perfect body"]
-            prompts = req.prompts or DEFAULT_PROMPTS
-            res = predict_probs_from_url(
-                u, model, preprocess, device,
-                prompts, timeout=req.timeout
-            )
-            res_out = {"url": u}
-            res_out.update(res)
-            results.append(res_out)
-        except Exception as e:
-            results.append({"url": u, "error": str(e)})
-    return results
+    DEFAULT_PROMPTS = ["a normal woman", "a woman showing her perfect body"]
+    prompts = req.prompts or DEFAULT_PROMPTS
+    model, preprocess, device, scheduler = await _get_model()
+    try:
+        return await apredict_probs_from_urls(
+            req.urls, model, preprocess, device,
+            prompts, timeout=req.timeout,
+            scheduler=scheduler
+        )
+    except Exception as e:
+        return [{"url": u, "error": str(e)} for u in req.urls]
 
 
 @app.post("/evaluate")
-def evaluate(req: EvalReq):
+async def evaluate(req: EvalReq):
     """
     Apply the full rules from logic.py, outputting a single probability final_prob along with the detailed process.
 
@@ -97,60 +233,126 @@ def evaluate(req: EvalReq):
         "thresholds": {...}
       }
     """
-    out = []
-    for u in req.urls:
-        try:
-            r = evaluate_image(
-                u, model, preprocess, device,
-                timeout=req.timeout,
-                agg=req.agg,
-                weight_key=req.weight_key
-            )
-            out.append(r)
-        except Exception as e:
-            out.append({"url": u, "error": str(e)})
-    return out
+    model, preprocess, device, scheduler = await _get_model()
+    try:
+        results = await aevaluate_images(
+            req.urls, model, preprocess, device,
+            timeout=req.timeout,
+            agg=req.agg,
+            weight_key=req.weight_key,
+            scheduler=scheduler,
+            detail=req.detail
+        )
+    except Exception as e:
+        results = [{"url": u, "error": str(e)} for u in req.urls]
+    return _json_response(results)
 
 
 @app.post("/evaluate_with_window")
-def evaluate_with_window(req: EvalReq):
+async def evaluate_with_window(req: EvalReq):
     """
     same as /evaluate, but additionally add:
       - window: latest final_prob
       - cumulative: only add probability > min_prob 
       - intervention: cumulative > threshold
     """
-    out = []
-    for u in req.urls:
-        try:
-            r = evaluate_image(
-                u, model, preprocess, device,
-                timeout=req.timeout,
-                agg=req.agg,
-                weight_key=req.weight_key
-            )
-            fp = r.get("final_prob", None)
-
-            if fp is None:
-                raise ValueError("final_prob missing")
-
-            window_list, cumulative, intervention = push_and_decide(req.user_id, fp)
-
-            r["window"] = window_list
-            r["cumulative"] = cumulative
-            r["intervention"] = intervention
-            out.append(r)
-
-        except Exception as e:
-            # failed fallback
-            window_list = snapshot()
-            cumulative = sum(x for x in window_list if x > MIN_PROB)
-            intervention = cumulative > THRESHOLD
-            out.append({
-                "url": u,
-                "error": str(e),
-                "window": window_list,
-                "cumulative": cumulative,
-                "intervention": intervention
-            })
-    return out
+    model, preprocess, device, scheduler = await _get_model()
+    try:
+        results = await aevaluate_images(
+            req.urls, model, preprocess, device,
+            timeout=req.timeout,
+            agg=req.agg,
+            weight_key=req.weight_key,
+            scheduler=scheduler,
+            detail=req.detail
+        )
+    except Exception as e:
+        results = [{"url": u, "error": str(e)} for u in req.urls]
+
+    # the store may block (SQLite busy timeout, a networked store), so push off the event loop
+    return _json_response(await run_in_threadpool(
+        lambda: [_apply_window(req.user_id, u, r) for u, r in zip(req.urls, results)]))
+
+
+def _apply_window(user_id: str, url: str, r: dict) -> dict:
+    """Push one evaluation into the user's window and attach window / cumulative / intervention."""
+    try:
+        if r.get("error") and "final_prob" not in r:
+            raise ValueError(r["error"])
+        fp = r.get("final_prob", None)
+
+        if fp is None:
+            raise ValueError("final_prob missing")
+
+        window_list, cumulative, intervention = push_and_decide(user_id, fp)
+
+        r["window"] = window_list
+        r["cumulative"] = cumulative
+        r["intervention"] = intervention
+        return r
+
+    except Exception as e:
+        # failed fallback
+        window_list = snapshot(user_id)
+        cumulative = sum(x for x in window_list if x > MIN_PROB)
+        intervention = cumulative > THRESHOLD
+        return {
+            "url": url,
+            "error": str(e),
+            "window": window_list,
+            "cumulative": cumulative,
+            "intervention": intervention
+        }
+
+
+# ---------- Streaming (NDJSON) ----------
+
+async def _evaluate_one(index: int, req: EvalReq):
+    try:
+        results = await aevaluate_images(
+            [req.urls[index]], model, preprocess, device,
+            timeout=req.timeout,
+            agg=req.agg,
+            weight_key=req.weight_key,
+            scheduler=scheduler,
+            detail=req.detail
+        )
+        return index, results[0]
+    except Exception as e:
+        return index, {"url": req.urls[index], "error": str(e)}
+
+
+async def _stream_lines(req: EvalReq, with_window: bool):
+    """
+    One JSON line per URL in completion order (fastest image first), tagged with its request index.
+    URLs are evaluated as independent jobs; the scheduler still batches their encoder forwards.
+    """
+    tasks = [asyncio.ensure_future(_evaluate_one(i, req)) for i in range(len(req.urls))]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            i, r = await next_done
+            if with_window:
+                r = await run_in_threadpool(_apply_window, req.user_id, req.urls[i], r)
+            r["index"] = i
+            yield _dumps(r) + b"\n"
+    finally:
+        for t in tasks:
+            t.cancel()   # client went away: stop the remaining work
+
+
+@app.post("/evaluate/stream")
+async def evaluate_stream(req: EvalReq):
+    """Same results as /evaluate, streamed as NDJSON as soon as each image is scored."""
+    await _get_model()
+    return StreamingResponse(_stream_lines(req, with_window=False), media_type="application/x-ndjson")
+
+
+@app.post("/evaluate_with_window/stream")
+async def evaluate_with_window_stream(req: EvalReq):
+    """
+    Same as /evaluate_with_window, streamed as NDJSON: each line carries the window state right
+    after that image was pushed, so the client can act on the first line with intervention=true.
+    Images enter the window in completion order rather than request order.
+    """
+    await _get_model()
+    return StreamingResponse(_stream_lines(req, with_window=True), media_type="application/x-ndjson")
@@ -0,0 +1,132 @@
+"""
+Fail-fast guards for image downloads.
+
+- NegativeCache: URLs that failed permanently (403/404/410) are remembered for a short TTL,
+  so the extension re-sending an expired Instagram URL costs nothing. Keyed by the raw URL:
+  a 403 for an expired signature says nothing about a freshly signed variant of the same photo.
+- CircuitBreaker: per host; after `threshold` consecutive timeouts / connection errors / 5xx
+  the host is "open" for `cooldown_s` and downloads fail immediately. After the cooldown one
+  trial request is let through (half-open): success closes the circuit, failure re-opens it.
+  A trial that ends without either (e.g. it ran out of request budget) is replaced after another
+  cooldown, so a host can never get stuck half-open.
+"""
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+
+PERMANENT_STATUSES = {403, 404, 410}
+
+
+class PermanentFetchError(Exception):
+    """Download failed with a status that will not fix itself on retry."""
+
+    def __init__(self, status: int, url: str, cached: bool = False):
+        self.status = status
+        self.url = url
+        self.cached = cached
+        super().__init__(f"{status} Client Error for url: {url}" + (" (cached)" if cached else ""))
+
+
+class CircuitOpenError(Exception):
+    """The image host is failing; request rejected without a network call."""
+
+
+class NegativeCache:
+    def __init__(self, ttl_s: float = 600.0, max_items: int = 100_000):
+        self.ttl_s = float(ttl_s)
+        self.max_items = int(max_items)
+        self._items: "OrderedDict[str, tuple]" = OrderedDict()   # key -> (expires_at, status)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.stored = 0
+
+    def get(self, key: str) -> Optional[int]:
+        """Cached failure status for key, or None."""
+        if self.ttl_s <= 0:
+            return None
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            if item[0] <= time.monotonic():
+                del self._items[key]
+                return None
+            self.hits += 1
+            return item[1]
+
+    def put(self, key: str, status: int) -> None:
+        if self.ttl_s <= 0:
+            return
+        with self._lock:
+            self._items[key] = (time.monotonic() + self.ttl_s, status)
+            self._items.move_to_end(key)
+            self.stored += 1
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"items": len(self._items), "ttl_s": self.ttl_s, "hits": self.hits, "stored": self.stored}
+
+
+class _HostState:
+    __slots__ = ("failures", "opened_at", "trial_at")
+
+    def __init__(self):
+        self.failures = 0
+        self.opened_at = None
+        self.trial_at = None
+
+
+class CircuitBreaker:
+    def __init__(self, threshold: int = 5, cooldown_s: float = 30.0):
+        self.threshold = int(threshold)
+        self.cooldown_s = float(cooldown_s)
+        self._hosts: Dict[str, _HostState] = {}
+        self._lock = threading.Lock()
+        self.rejected = 0
+        self.opened = 0
+
+    def before(self, host: str) -> None:
+        """Raise CircuitOpenError if host is open (or half-open with its trial already running)."""
+        if self.threshold <= 0:
+            return
+        with self._lock:
+            st = self._hosts.get(host)
+            if st is None or st.opened_at is None:
+                return
+            now = time.monotonic()
+            if now - st.opened_at >= self.cooldown_s and (st.trial_at is None or now - st.trial_at >= self.cooldown_s):
+                st.trial_at = now   # half-open: this caller is the trial
+                return
+            self.rejected += 1
+        raise CircuitOpenError(f"circuit open for host {host}")
+
+    def success(self, host: str) -> None:
+        with self._lock:
+            self._hosts.pop(host, None)
+
+    def failure(self, host: str) -> None:
+        if self.threshold <= 0:
+            return
+        with self._lock:
+            st = self._hosts.setdefault(host, _HostState())
+            st.failures += 1
+            if st.trial_at is not None or (st.opened_at is None and st.failures >= self.threshold):
+                if st.opened_at is None:
+                    self.opened += 1
+                st.opened_at = time.monotonic()
+            st.trial_at = None
+
+    def stats(self) -> dict:
+        with self._lock:
+            now = time.monotonic()
+            return {
+                "open_hosts": sorted(h for h, st in self._hosts.items()
+                                     if st.opened_at is not None and now - st.opened_at < self.cooldown_s),
+                "opened": self.opened,
+                "rejected": self.rejected,
+                "threshold": self.threshold,
+                "cooldown_s": self.cooldown_s,
+            }
@@ -0,0 +1,324 @@
+"""
+Prompt-pair evaluation against a labeled image corpus that is encoded only once.
+
+    python -m app.prompt_eval encode labels.csv corpus/ --label body_focused
+    python -m app.prompt_eval score corpus/ --candidates candidates.csv --json report.json
+
+encode: every image in a CSV / Parquet / JSONL file (URL or local path + 0/1 label) goes through
+the image tower once. The result is corpus/embeddings.npy (float32 [N, D], L2-normalized,
+memory-mapped when read) and corpus/corpus.json (urls, labels, encoder, skipped rows).
+
+score: the text tower encodes every prompt, i.e. the current pairs of logic.py plus any candidate
+pairs (CSV / JSON / JSONL with pos, neg and optionally group = ff | be). One matrix product then
+scores every image against every prompt. A pair's pos_prob is the softmax over its own two prompts.
+That is what logic._renormalize_pairs reduces the app's softmax to, up to float rounding, so
+pairs do not affect each other and hundreds of them cost one matmul. Report:
+  - per pair: AUC of pos_prob against the label, and precision / recall of the pair's vote
+    (logic's MARGIN / DIFF / evidence thresholds)
+  - aggregate: the logic.py rules (gate, TOTAL_VOTE_REQUIRE votes, agg) on the array helpers, with
+    final_prob > MIN_PROB as the prediction, for the current FF + BE pairs and, if candidates
+    carry a group, with them replacing that group
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import torch
+
+from . import logic
+from .bulk import read_rows
+from .clip_wrapper import build_text_bank, encode_fetched, encode_text, encoder_id, fetch_images, load_clip_model
+from .window import MIN_PROB
+
+logger = logging.getLogger(__name__)
+
+EMBEDDINGS = "embeddings.npy"
+META = "corpus.json"
+SCORE_ROWS = 8192   # images per matmul chunk: [rows, prompts] logits stay small
+
+
+# ---------- corpus ----------
+
+def _label(v) -> bool:
+    if isinstance(v, str):
+        return v.strip().lower() in ("1", "true", "yes", "y", "pos", "positive")
+    return bool(v) and not pd.isna(v)
+
+
+class Corpus:
+    """Embeddings [N, D] (memory-mapped) + labels [N] written by build_corpus."""
+
+    def __init__(self, directory: str):
+        with open(os.path.join(directory, META)) as f:
+            meta = json.load(f)
+        self.directory = directory
+        self.encoder = meta["encoder"]
+        self.urls: List[str] = meta["urls"]
+        self.labels = np.asarray(meta["labels"], dtype=bool)
+        self.skipped = meta.get("skipped", [])
+        self.embeddings = np.load(os.path.join(directory, EMBEDDINGS), mmap_mode="r")
+
+    def __len__(self) -> int:
+        return len(self.urls)
+
+
+def build_corpus(input_path: str, directory: str, model, preprocess, device, column: Optional[str] = None,
+                 label: str = "label", batch_size: int = 64, timeout: int = 30) -> Corpus:
+    """Encode every image of input_path once; rows that fail to download / decode are skipped (listed in the meta)."""
+    urls, labels, rows, skipped = [], [], [], []
+    start = time.monotonic()
+    for batch in read_rows(input_path, column, [label], batch_size):
+        batch_urls = batch["url"].tolist()
+        fetched = fetch_images(batch_urls, timeout=timeout, deadline=time.monotonic() + timeout)
+        encoded = encode_fetched(fetched, model, preprocess, device)
+        for row, url, y, feats in zip(batch["row"], batch_urls, batch[label], encoded):
+            if isinstance(feats, Exception) or feats is None:
+                skipped.append({"row": int(row), "url": url, "error": str(feats)})
+                continue
+            urls.append(url)
+            labels.append(_label(y))
+            rows.append(feats.float().cpu().numpy().reshape(-1))
+        logger.info(f"Encoded {len(urls)} images ({len(skipped)} skipped), "
+                    f"{(len(urls) + len(skipped)) / (time.monotonic() - start):.1f} images/s")
+    if not rows:
+        raise ValueError(f"no image of {input_path} could be encoded")
+
+    os.makedirs(directory, exist_ok=True)
+    emb = np.stack(rows).astype(np.float32)
+    emb /= np.linalg.norm(emb, axis=1, keepdims=True)
+    np.save(os.path.join(directory, EMBEDDINGS), emb)
+    with open(os.path.join(directory, META), "w") as f:
+        json.dump({"encoder": encoder_id(model), "input": os.path.abspath(input_path), "label": label,
+                   "urls": urls, "labels": labels, "skipped": skipped}, f)
+    return Corpus(directory)
+
+
+# ---------- scoring ----------
+
+def pair_probs(embeddings: np.ndarray, pairs: List[Tuple[str, str]], model, device,
+               text_cache_dir: Optional[str] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    (pos, neg) [N, pairs] float64 for every image x pair, from one image @ text product per row chunk.
+    text_cache_dir: persist the prompts' text features there (build_text_bank), so reruns skip the text tower.
+    """
+    if not pairs:
+        return np.empty((len(embeddings), 0)), np.empty((len(embeddings), 0))
+    prompts = list(dict.fromkeys(p for pair in pairs for p in pair))
+    col = {p: i for i, p in enumerate(prompts)}
+    pos_cols = [col[p] for p, _ in pairs]
+    neg_cols = [col[n] for _, n in pairs]
+    if text_cache_dir:
+        build_text_bank(prompts, model, device, cache_dir=text_cache_dir)
+    with torch.no_grad():
+        text = encode_text(prompts, model, device).float().cpu()
+        scale = float(model.logit_scale.exp())
+    pos = np.empty((len(embeddings), len(pairs)))
+    for start in range(0, len(embeddings), SCORE_ROWS):
+        block = torch.from_numpy(np.array(embeddings[start:start + SCORE_ROWS], dtype=np.float32))
+        logits = (scale * block @ text.t()).double().numpy()
+        # softmax over (pos, neg) alone == the app's prompt softmax after _renormalize_pairs
+        pos[start:start + len(block)] = 1.0 / (1.0 + np.exp(logits[:, neg_cols] - logits[:, pos_cols]))
+    return pos, 1.0 - pos
+
+
+def _average_ranks(x: np.ndarray) -> np.ndarray:
+    """1-based ranks of a 1-D array, ties sharing their average rank."""
+    order = np.argsort(x, kind="mergesort")
+    xs = x[order]
+    starts = np.flatnonzero(np.r_[True, xs[1:] != xs[:-1]])
+    ends = np.r_[starts[1:], len(xs)]
+    avg = (starts + ends + 1) / 2.0
+    ranks = np.empty(len(x))
+    ranks[order] = np.repeat(avg, ends - starts)
+    return ranks
+
+
+def auc(scores: np.ndarray, labels: np.ndarray) -> np.ndarray:
+    """ROC AUC of every column of scores [N, P] (Mann-Whitney U, ties count half); nan if one class is missing."""
+    scores = scores.reshape(len(labels), -1)
+    n_pos = int(labels.sum())
+    n_neg = len(labels) - n_pos
+    if n_pos == 0 or n_neg == 0:
+        return np.full(scores.shape[1], np.nan)
+    out = np.empty(scores.shape[1])
+    for j in range(scores.shape[1]):
+        r = _average_ranks(scores[:, j])
+        out[j] = (r[labels].sum() - n_pos * (n_pos + 1) / 2) / (n_pos * n_neg)
+    return out
+
+
+def binary_metrics(pred: np.ndarray, labels: np.ndarray) -> Dict[str, np.ndarray]:
+    """precision / recall / f1 of every column of pred [N, P] (nan where undefined)."""
+    pred = pred.reshape(len(labels), -1)
+    y = labels[:, None]
+    tp = (pred & y).sum(axis=0).astype(np.float64)
+    n_pred = pred.sum(axis=0)
+    n_pos = y.sum()
+    with np.errstate(invalid="ignore", divide="ignore"):
+        precision = tp / n_pred
+        recall = tp / n_pos
+        f1 = 2 * precision * recall / (precision + recall)
+    return {"precision": precision, "recall": recall, "f1": f1, "predicted": n_pred}
+
+
+def rules_final_prob(judged: Dict[str, dict], agg: str = "weighted_pos", weight_key: str = "diff") -> dict:
+    """
+    logic._evaluate_batch_from_features' final_prob for a whole corpus, from judged pair arrays
+    ({"female", "person", "clothing"} -> logic._judge_pairs_array output).
+    """
+    female_score, _, _ = logic._aggregate_group_score_array(judged["female"])
+    person_score, _, _ = logic._aggregate_group_score_array(judged["person"])
+    gate = (female_score >= logic.GATE_THRESHOLD) & (person_score >= logic.GATE_THRESHOLD)
+    votes = judged["clothing"]["passed"].sum(axis=1)
+    value, _ = logic._aggregate_value_from_passed_array(judged["clothing"], agg=agg, weight_key=weight_key)
+    final = np.where(gate & (votes >= logic.TOTAL_VOTE_REQUIRE), np.nan_to_num(value), 0.0)
+    return {"final_prob": final, "gate": gate, "votes": np.where(gate, votes, 0)}
+
+
+def _summary(final: np.ndarray, gate: np.ndarray, labels: np.ndarray) -> dict:
+    m = binary_metrics(final > MIN_PROB, labels)
+    return {"auc": _num(auc(final, labels)[0]), "precision": _num(m["precision"][0]),
+            "recall": _num(m["recall"][0]), "f1": _num(m["f1"][0]), "predicted": int(m["predicted"][0]),
+            "gate_pass_rate": float(gate.mean())}
+
+
+def _num(v) -> Optional[float]:
+    return None if np.isnan(v) else round(float(v), 4)
+
+
+def load_candidates(path: str) -> List[dict]:
+    """Candidate pairs: {"pos", "neg", "group"} rows from CSV / JSON list / JSONL; group defaults to "candidate"."""
+    if path.endswith(".csv"):
+        rows = pd.read_csv(path).to_dict("records")
+    elif path.endswith((".jsonl", ".ndjson")):
+        rows = pd.read_json(path, lines=True).to_dict("records")
+    else:
+        with open(path) as f:
+            rows = json.load(f)
+    out = []
+    for r in rows:
+        if isinstance(r, (list, tuple)):
+            r = {"pos": r[0], "neg": r[1]}
+        group = r.get("group")
+        out.append({"pos": str(r["pos"]), "neg": str(r["neg"]),
+                    "group": "candidate" if group is None or pd.isna(group) else str(group)})
+    return out
+
+
+def evaluate(corpus: Corpus, model, device, candidates: List[dict] = (), agg: str = "weighted_pos",
+             weight_key: str = "diff", fast: bool = True, k: int = 4) -> dict:
+    """Per-pair and aggregate metrics for the current pairs and `candidates` (see module docstring)."""
+    if corpus.encoder.split("+")[0] != encoder_id(model).split("+")[0]:
+        raise ValueError(f"corpus was encoded with {corpus.encoder}, the loaded model is {encoder_id(model)}")
+    n_sel = lambda pairs: min(k, len(pairs)) if fast else len(pairs)
+    current = {"female": logic.FEMALE_PAIRS[:n_sel(logic.FEMALE_PAIRS)],
+               "person": logic.PERSON_PAIRS[:n_sel(logic.PERSON_PAIRS)],
+               "ff": logic.FORM_FIT_PAIRS, "be": logic.BODY_EXPOSURE_PAIRS}
+    entries = [(g, pair) for g, pairs in current.items() for pair in pairs] + \
+              [(c["group"], (c["pos"], c["neg"])) for c in candidates]
+    source = ["current"] * (len(entries) - len(candidates)) + ["candidate"] * len(candidates)
+
+    start = time.perf_counter()
+    pos, neg = pair_probs(corpus.embeddings, [pair for _, pair in entries], model, device,
+                          text_cache_dir=os.path.join(corpus.directory, "text"))
+    judged = logic._judge_pairs_array(pos, neg)
+    score_s = time.perf_counter() - start
+
+    labels = corpus.labels
+    pair_auc = auc(pos, labels)
+    votes = binary_metrics(judged["passed"], labels)
+    pairs = [{"source": src, "group": g, "pos": p, "neg": n, "auc": _num(pair_auc[j]),
+              "vote_precision": _num(votes["precision"][j]), "vote_recall": _num(votes["recall"][j]),
+              "vote_rate": round(float(votes["predicted"][j]) / len(labels), 4)}
+             for j, ((g, (p, n)), src) in enumerate(zip(entries, source))]
+
+    def columns(want):
+        idx = [j for j, (g, _) in enumerate(entries) if want(j, g)]
+        return {key: v[:, idx] for key, v in judged.items()}
+
+    is_current = lambda group: (lambda j, g: source[j] == "current" and g == group)
+    gate = {"female": columns(is_current("female")), "person": columns(is_current("person"))}
+    aggregate = {}
+    base = rules_final_prob({**gate, "clothing": columns(lambda j, g: source[j] == "current" and g in ("ff", "be"))},
+                            agg, weight_key)
+    aggregate["current"] = _summary(base["final_prob"], base["gate"], labels)
+    replaced = {c["group"] for c in candidates} & {"ff", "be"}
+    if replaced:
+        swap = lambda j, g: g in ("ff", "be") and (source[j] == "candidate") == (g in replaced)
+        cand = rules_final_prob({**gate, "clothing": columns(swap)}, agg, weight_key)
+        aggregate["candidates"] = {**_summary(cand["final_prob"], cand["gate"], labels),
+                                   "replaced_groups": sorted(replaced)}
+    return {
+        "images": len(corpus),
+        "positives": int(labels.sum()),
+        "encoder": corpus.encoder,
+        "prompt_set": logic.rules_version(),
+        "min_prob": MIN_PROB,
+        "pairs_scored": len(entries),
+        "score_s": round(score_s, 3),
+        "aggregate": aggregate,
+        "pairs": pairs,
+    }
+
+
+# ---------- CLI ----------
+
+def _print_report(report: dict, top: int) -> None:
+    print(f"{report['images']} images ({report['positives']} positive), {report['pairs_scored']} pairs "
+          f"scored in {report['score_s']}s")
+    for name, s in report["aggregate"].items():
+        print(f"  {name:<10} auc {s['auc']}  precision {s['precision']}  recall {s['recall']}  "
+              f"f1 {s['f1']}  gate pass {s['gate_pass_rate']:.2%}")
+    ranked = sorted(report["pairs"], key=lambda p: -1 if p["auc"] is None else p["auc"], reverse=True)
+    print(f"\ntop {top} pairs by AUC:")
+    for p in ranked[:top]:
+        print(f"  {p['auc']!s:>6}  P {p['vote_precision']!s:>6}  R {p['vote_recall']!s:>6}  "
+              f"[{p['source']}/{p['group']}] {p['pos']!r} vs {p['neg']!r}")
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(prog="python -m app.prompt_eval", description=__doc__.strip().splitlines()[0])
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    enc = sub.add_parser("encode", help="encode a labeled image list into a corpus directory")
+    enc.add_argument("input", help=".csv, .parquet or .jsonl with an image URL / path and a 0/1 label per row")
+    enc.add_argument("corpus", help="output directory")
+    enc.add_argument("--column", help="URL column (default: url / image_url / path)")
+    enc.add_argument("--label", default="label", help="label column")
+    enc.add_argument("--batch-size", type=int, default=64)
+    enc.add_argument("--timeout", type=int, default=30, help="download deadline per batch, seconds")
+    sc = sub.add_parser("score", help="score the current and candidate pairs against a corpus")
+    sc.add_argument("corpus")
+    sc.add_argument("--candidates", help="pairs to try: .csv / .json / .jsonl with pos, neg[, group]")
+    sc.add_argument("--agg", default="weighted_pos", choices=logic.AGG_MODES)
+    sc.add_argument("--weight-key", default="diff")
+    sc.add_argument("--no-fast", dest="fast", action="store_false", help="gate on every pair, not the first k")
+    sc.add_argument("--k", type=int, default=4)
+    sc.add_argument("--top", type=int, default=20, help="pairs listed in the printed report")
+    sc.add_argument("--json", help="write the full report here")
+    args = ap.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="[%(levelname)s] %(asctime)s %(message)s")
+    model, preprocess, device = load_clip_model()
+    if args.cmd == "encode":
+        corpus = build_corpus(args.input, args.corpus, model, preprocess, device, args.column, args.label,
+                              args.batch_size, args.timeout)
+        print(f"{len(corpus)} images ({int(corpus.labels.sum())} positive, {len(corpus.skipped)} skipped) "
+              f"-> {args.corpus}")
+        return 0
+    candidates = load_candidates(args.candidates) if args.candidates else []
+    report = evaluate(Corpus(args.corpus), model, device, candidates, args.agg, args.weight_key, args.fast, args.k)
+    _print_report(report, args.top)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,123 @@
+"""
+Content-addressed cache of per-image evaluation results.
+
+Keys are built by the caller from the image content hash plus everything that changes the
+output (model id, prompt/threshold version, aggregation options). Two tiers:
+  - in-memory LRU with TTL (always on)
+  - optional SQLite file shared by workers / surviving restarts
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+class ResultCache:
+    def __init__(self, max_items: int = 10000, ttl_s: float = 7 * 24 * 3600,
+                 sqlite_path: Optional[str] = None, sqlite_max_rows: int = 1_000_000):
+        self.max_items = max(0, int(max_items))
+        self.ttl_s = float(ttl_s)
+        self.sqlite_max_rows = int(sqlite_max_rows)
+
+        self._mem: "OrderedDict[str, tuple]" = OrderedDict()   # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self._db = None
+        self._db_puts = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        if sqlite_path:
+            try:
+                os.makedirs(os.path.dirname(sqlite_path) or ".", exist_ok=True)
+                self._db = sqlite3.connect(sqlite_path, check_same_thread=False, isolation_level=None)
+                self._db.execute("PRAGMA journal_mode=WAL")
+                self._db.execute("PRAGMA synchronous=NORMAL")
+                self._db.execute("CREATE TABLE IF NOT EXISTS results ("
+                                 "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL NOT NULL)")
+                self._db.execute("CREATE INDEX IF NOT EXISTS results_expires ON results(expires)")
+            except Exception as e:
+                logger.warning(f"Result cache: SQLite tier disabled ({sqlite_path}): {e}")
+                self._db = None
+
+    def get(self, key: str) -> Optional[dict]:
+        """Returns a shallow copy of the cached result, or None."""
+        now = time.time()
+        with self._lock:
+            hit = self._mem.get(key)
+            if hit is not None:
+                if hit[0] > now:
+                    self._mem.move_to_end(key)
+                    self.hits += 1
+                    return dict(hit[1])
+                del self._mem[key]
+
+            if self._db is not None:
+                row = self._db.execute("SELECT value, expires FROM results WHERE key = ?", (key,)).fetchone()
+                if row is not None and row[1] > now:
+                    value = json.loads(row[0])
+                    self._put_mem(key, value, row[1])
+                    self.hits += 1
+                    self.disk_hits += 1
+                    return dict(value)
+
+            self.misses += 1
+            return None
+
+    def put(self, key: str, value: dict) -> None:
+        expires = time.time() + self.ttl_s
+        with self._lock:
+            self._put_mem(key, value, expires)
+            if self._db is not None:
+                try:
+                    self._db.execute("INSERT OR REPLACE INTO results (key, value, expires) VALUES (?, ?, ?)",
+                                     (key, json.dumps(value), expires))
+                    self._db_puts += 1
+                    if self._db_puts % 1000 == 0:
+                        self._prune_db()
+                except Exception as e:
+                    logger.warning(f"Result cache: SQLite write failed: {e}")
+
+    def _put_mem(self, key: str, value: dict, expires: float) -> None:
+        if self.max_items == 0:
+            return
+        self._mem[key] = (expires, value)
+        self._mem.move_to_end(key)
+        while len(self._mem) > self.max_items:
+            self._mem.popitem(last=False)
+            self.evictions += 1
+
+    def _prune_db(self) -> None:
+        self._db.execute("DELETE FROM results WHERE expires <= ?", (time.time(),))
+        n = self._db.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+        if n > self.sqlite_max_rows:
+            self._db.execute("DELETE FROM results WHERE key IN "
+                             "(SELECT key FROM results ORDER BY expires LIMIT ?)", (n - self.sqlite_max_rows,))
+
+    def clear(self) -> None:
+        with self._lock:
+            self._mem.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM results")
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "items": len(self._mem),
+                "max_items": self.max_items,
+                "ttl_s": self.ttl_s,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_ratio": (self.hits / lookups) if lookups else 0.0,
+                "evictions": self.evictions,
+                "sqlite": self._db is not None,
+            }
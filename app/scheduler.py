@@ -0,0 +1,177 @@
+"""
+Cross-request dynamic micro-batching for the CLIP image tower.
+
+Requests submit preprocessed image tensors; a single worker thread groups whatever is queued
+(up to max_batch, or after the oldest job has waited max_wait_ms) into one forward and hands
+each row back through a Future. Jobs whose deadline has passed are failed before the forward.
+"""
+import asyncio
+import logging
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from typing import List, Optional
+
+from .clip_wrapper import encode_images
+
+logger = logging.getLogger(__name__)
+
+
+class _Job:
+    __slots__ = ("image_input", "deadline", "future", "enqueued")
+
+    def __init__(self, image_input, deadline: Optional[float]):
+        self.image_input = image_input
+        self.deadline = deadline
+        self.future: Future = Future()
+        self.enqueued = time.monotonic()
+
+
+class EncodeScheduler:
+    def __init__(self, model, device, max_batch: int = 16, max_wait_ms: float = 10.0):
+        self.model = model
+        self.device = device
+        self.max_batch = max(1, int(max_batch))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+
+        self._queue: deque = deque()
+        self._cond = threading.Condition()
+        self._closed = False
+
+        # metrics
+        self._batch_sizes: Counter = Counter()
+        self._jobs_done = 0
+        self._jobs_expired = 0
+        self._jobs_failed = 0
+        self._max_queue_depth = 0
+        self._queue_wait_total = 0.0
+
+        self._worker = threading.Thread(target=self._run, name="clip-encode-scheduler", daemon=True)
+        self._worker.start()
+
+    # ---------- submit ----------
+    def submit(self, image_input, deadline: Optional[float] = None) -> Future:
+        """Queue one [3, H, W] tensor; the Future resolves to [1, D] normalized features."""
+        job = _Job(image_input, deadline)
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("scheduler is closed")
+            self._queue.append(job)
+            self._max_queue_depth = max(self._max_queue_depth, len(self._queue))
+            self._cond.notify()
+        return job.future
+
+    def encode(self, image_inputs: List, deadline: Optional[float] = None) -> List:
+        """
+        Submit a request's images and wait for them.
+        Returns one entry per input: [1, D] features, or the Exception for that row.
+        """
+        futures = [self.submit(x, deadline) for x in image_inputs]
+        out = []
+        for f in futures:
+            wait = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                out.append(f.result(timeout=wait))
+            except (TimeoutError, FutureTimeoutError):
+                f.cancel()
+                out.append(TimeoutError("image encode deadline exceeded"))
+            except Exception as e:
+                out.append(e)
+        return out
+
+    async def aencode(self, image_inputs: List, deadline: Optional[float] = None) -> List:
+        """Async encode(): awaits the same Futures without holding a thread."""
+        futures = [asyncio.wrap_future(self.submit(x, deadline)) for x in image_inputs]
+        out = []
+        for f in futures:
+            wait = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                out.append(await asyncio.wait_for(f, timeout=wait))
+            except (asyncio.TimeoutError, TimeoutError):
+                out.append(TimeoutError("image encode deadline exceeded"))
+            except Exception as e:
+                out.append(e)
+        return out
+
+    def close(self) -> None:
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._worker.join(timeout=5)
+
+    # ---------- worker ----------
+    def _next_batch(self) -> List[_Job]:
+        with self._cond:
+            while not self._queue and not self._closed:
+                self._cond.wait()
+            if self._closed and not self._queue:
+                return []
+            # give concurrent requests max_wait to join the oldest job
+            flush_at = self._queue[0].enqueued + self.max_wait
+            while len(self._queue) < self.max_batch and not self._closed:
+                remaining = flush_at - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            n = min(self.max_batch, len(self._queue))
+            return [self._queue.popleft() for _ in range(n)]
+
+    def _run(self) -> None:
+        while True:
+            batch = self._next_batch()
+            if not batch:
+                return
+            self._run_batch(batch)
+            # inputs may be views into shared decode buffers: don't keep the last batch alive while idle
+            del batch
+
+    def _run_batch(self, batch: List[_Job]) -> None:
+        now = time.monotonic()
+        live = []
+        for job in batch:
+            if not job.future.set_running_or_notify_cancel():
+                continue
+            if job.deadline is not None and now > job.deadline:
+                self._jobs_expired += 1
+                job.future.set_exception(TimeoutError("image encode deadline exceeded"))
+                continue
+            self._queue_wait_total += now - job.enqueued
+            live.append(job)
+        if not live:
+            return
+
+        self._batch_sizes[len(live)] += 1
+        try:
+            feats = encode_images([j.image_input for j in live], self.model, self.device,
+                                  batch_size=self.max_batch)
+            for i, job in enumerate(live):
+                job.future.set_result(feats[i:i + 1])
+        except Exception:
+            logger.exception("Scheduled batch encode failed, retrying rows one by one")
+            for job in live:
+                try:
+                    job.future.set_result(encode_images([job.image_input], self.model, self.device))
+                except Exception as e:
+                    self._jobs_failed += 1
+                    job.future.set_exception(e)
+        self._jobs_done += len(live)
+
+    # ---------- metrics ----------
+    def stats(self) -> dict:
+        with self._cond:
+            depth = len(self._queue)
+        batches = sum(self._batch_sizes.values())
+        return {
+            "queue_depth": depth,
+            "max_queue_depth": self._max_queue_depth,
+            "batches": batches,
+            "jobs_done": self._jobs_done,
+            "jobs_expired": self._jobs_expired,
+            "jobs_failed": self._jobs_failed,
+            "mean_batch_size": (self._jobs_done / batches) if batches else 0.0,
+            "mean_queue_wait_ms": (1000.0 * self._queue_wait_total / self._jobs_done) if self._jobs_done else 0.0,
+            "batch_size_hist": {str(k): v for k, v in sorted(self._batch_sizes.items())},
+            "max_batch": self.max_batch,
+            "max_wait_ms": self.max_wait * 1000.0,
+        }
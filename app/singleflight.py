@@ -0,0 +1,42 @@
+"""
+In-flight request coalescing ("single-flight").
+
+The first caller for a key becomes the leader and computes; concurrent callers for the same
+key get the leader's Future instead of repeating the download + forward. Keys are removed as
+soon as they resolve, so this is not a cache — it only merges work that overlaps in time.
+"""
+import threading
+from concurrent.futures import Future
+from typing import Dict, Hashable, Tuple
+
+
+class SingleFlight:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[Hashable, Future] = {}
+        self._leaders = 0
+        self._followers = 0
+
+    def claim(self, key: Hashable) -> Tuple[Future, bool]:
+        """Returns (future, is_leader). A leader must call resolve() for the key."""
+        with self._lock:
+            f = self._calls.get(key)
+            if f is not None:
+                self._followers += 1
+                return f, False
+            f = Future()
+            f.set_running_or_notify_cancel()
+            self._calls[key] = f
+            self._leaders += 1
+            return f, True
+
+    def resolve(self, key: Hashable, result) -> None:
+        """Publish the leader's result (an Exception instance is passed through as a value)."""
+        with self._lock:
+            f = self._calls.pop(key, None)
+        if f is not None and not f.done():
+            f.set_result(result)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"in_flight": len(self._calls), "leaders": self._leaders, "coalesced": self._followers}
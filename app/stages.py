@@ -0,0 +1,41 @@
+"""
+Cumulative wall time per pipeline stage: download, decode, preprocess, encode, scoring.
+
+Counters only grow; GET /metrics serves them and bench/pipeline.py diffs two snapshots to split
+request latency by stage. Times are summed over threads, so stages that run in parallel
+(e.g. 16 concurrent downloads) can add up to more than the wall-clock time of a request.
+"""
+import threading
+import time
+from contextlib import contextmanager
+
+STAGE_NAMES = ("download", "decode", "preprocess", "encode", "scoring")
+
+
+class StageTimers:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._count = dict.fromkeys(STAGE_NAMES, 0)
+        self._total = dict.fromkeys(STAGE_NAMES, 0.0)
+
+    def add(self, stage: str, seconds: float, n: int = 1) -> None:
+        with self._lock:
+            self._count[stage] = self._count.get(stage, 0) + n
+            self._total[stage] = self._total.get(stage, 0.0) + seconds
+
+    @contextmanager
+    def timed(self, stage: str, n: int = 1):
+        """Context manager (or decorator) adding the elapsed time to `stage`, also on error."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start, n)
+
+    def stats(self) -> dict:
+        """{stage: {"count": items timed, "total_s": summed seconds}}"""
+        with self._lock:
+            return {s: {"count": c, "total_s": round(self._total[s], 6)} for s, c in self._count.items()}
+
+
+STAGES = StageTimers()
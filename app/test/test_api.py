@@ -0,0 +1,55 @@
+import pytest
+
+pytest.importorskip("httpx")
+from fastapi.testclient import TestClient
+
+from app.main import app
+
+
+@pytest.mark.parametrize("path", ["/evaluate", "/evaluate_with_window", "/evaluate/stream"])
+@pytest.mark.parametrize("field,value", [("detail", "fulll"), ("agg", "mean")])
+def test_bad_enum_values_are_rejected(path, field, value):
+    # no lifespan: validation fails before anything needs the model
+    resp = TestClient(app).post(path, json={"urls": ["https://example.com/a.jpg"], field: value})
+    assert resp.status_code == 422
+    assert resp.json()["detail"][0]["loc"] == ["body", field]
+
+
+def test_slow_window_store_does_not_block_the_event_loop(monkeypatch):
+    import asyncio
+    import time
+
+    import httpx
+
+    from app import main, window
+
+    class SlowStore(window.MemoryWindowStore):
+        def push_and_decide(self, user_id, prob):
+            time.sleep(1.0)   # e.g. SQLite waiting out its busy timeout
+            return super().push_and_decide(user_id, prob)
+
+    async def fake_get_model():
+        return None, None, None, None
+
+    async def fake_evaluate(urls, *args, **kwargs):
+        return [{"url": u, "final_prob": 0.9} for u in urls]
+
+    monkeypatch.setattr(window, "_STORE", SlowStore())
+    monkeypatch.setattr(main, "_get_model", fake_get_model)
+    monkeypatch.setattr(main, "aevaluate_images", fake_evaluate)
+
+    async def run():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            t0 = time.perf_counter()
+            push = asyncio.ensure_future(
+                client.post("/evaluate_with_window", json={"urls": ["https://example.com/a.jpg"]}))
+            await asyncio.sleep(0.1)   # let the push reach the store
+            probe = await client.get("/ready")
+            probe_s = time.perf_counter() - t0
+            return probe, probe_s, await push
+
+    probe, probe_s, resp = asyncio.run(run())
+    assert probe.status_code in (200, 503)
+    assert probe_s < 0.5
+    assert resp.json()[0]["window"] == [0.9]
@@ -0,0 +1,120 @@
+import json
+import os
+
+import pytest
+
+pd = pytest.importorskip("pandas")
+
+from app import bulk, logic
+from app.test.test_logic import fake_clip  # noqa: F401  (fixture)
+
+N_ROWS = 53
+
+
+@pytest.fixture
+def feed(tmp_path, fake_clip, monkeypatch):
+    monkeypatch.setattr(bulk, "fetch_images", logic.fetch_images)   # the fake installed by fake_clip
+    monkeypatch.setattr(bulk, "warm_text_bank", lambda *a: "")
+    urls = [str(i) for i in range(N_ROWS)]
+    urls[7] = "bad"
+    path = tmp_path / "feed.csv"
+    pd.DataFrame({"post_id": [f"p{i}" for i in range(N_ROWS)], "url": urls}).to_csv(path, index=False)
+    return path, urls
+
+
+def _run(src, out, **kw):
+    return bulk.run(str(src), str(out), keep=["post_id"], batch_size=5, report_every_s=0,
+                    model_bundle=(None, None, None), **kw)
+
+
+def _lines(path):
+    return [json.loads(line) for line in open(path)]
+
+
+def test_bulk_matches_evaluate_images(feed, tmp_path):
+    src, urls = feed
+    summary = _run(src, tmp_path / "out.jsonl")
+    rows = _lines(tmp_path / "out.jsonl")
+    expected = logic.evaluate_images(urls, None, None, None, detail="scores")
+    assert summary["rows"] == N_ROWS and summary["errors"] == 1
+    assert [r["row"] for r in rows] == list(range(N_ROWS))
+    assert [r["post_id"] for r in rows] == [f"p{i}" for i in range(N_ROWS)]
+    assert [r["final_prob"] for r in rows] == [e["final_prob"] for e in expected]
+    assert rows[7]["error"].startswith("stage1_scores_incomplete: boom")
+    passed = next(r for r, e in zip(rows, expected) if e.get("gate", {}).get("passed"))
+    assert passed["ff_0_pos"] is not None and isinstance(passed["be_6_passed"], bool)
+    assert len({len(r) for r in rows}) == 1   # one schema, gate failures included
+
+
+def test_bulk_resumes_after_interruption(feed, tmp_path, monkeypatch):
+    src, _ = feed
+    _run(src, tmp_path / "ref.jsonl")
+    calls, real = [0], bulk.evaluate_fetched
+
+    def flaky(*args, **kwargs):
+        calls[0] += 1
+        if calls[0] == 4:
+            raise KeyboardInterrupt
+        return real(*args, **kwargs)
+
+    monkeypatch.setattr(bulk, "evaluate_fetched", flaky)
+    out = tmp_path / "out.jsonl"
+    with pytest.raises(KeyboardInterrupt):
+        _run(src, out)
+    with open(out, "a") as f:
+        f.write('{"row": 15, "half a li')   # torn write after the last checkpoint
+    ckpt = json.load(open(str(out) + ".checkpoint.json"))
+    assert ckpt["rows_done"] == 15
+
+    summary = _run(src, out)
+    assert summary["rows_this_run"] == N_ROWS - 15
+    assert _lines(out) == _lines(tmp_path / "ref.jsonl")
+    with pytest.raises(SystemExit):   # options changed: refuse to mix runs
+        _run(src, out, agg="max_pos")
+
+
+def test_bulk_refuses_to_overwrite_without_checkpoint(feed, tmp_path):
+    src, _ = feed
+    out = tmp_path / "out.jsonl"
+    out.write_text('{"row": 0}\n')
+    with pytest.raises(SystemExit):
+        _run(src, out)
+    assert out.read_text() == '{"row": 0}\n'
+    _run(src, out, restart=True)
+    assert len(_lines(out)) == N_ROWS
+
+
+def test_bulk_refuses_to_resume_a_shortened_output(feed, tmp_path, monkeypatch):
+    src, _ = feed
+    calls, real = [0], bulk.evaluate_fetched
+
+    def flaky(*args, **kwargs):
+        calls[0] += 1
+        if calls[0] == 3:
+            raise KeyboardInterrupt
+        return real(*args, **kwargs)
+
+    monkeypatch.setattr(bulk, "evaluate_fetched", flaky)
+    out = tmp_path / "out.jsonl"
+    with pytest.raises(KeyboardInterrupt):
+        _run(src, out)
+    out.write_bytes(out.read_bytes()[:10])         # replaced / truncated behind the checkpoint's back
+    with pytest.raises(SystemExit, match="truncated or replaced"):
+        _run(src, out)
+    assert b"\0" not in out.read_bytes()           # not padded with NULs
+
+
+def test_bulk_parquet_parts(feed, tmp_path):
+    src, _ = feed
+    out = tmp_path / "out.parquet"
+    out.mkdir()
+    (out / "part-final.parquet").write_bytes(b"not ours")   # not a part name: left alone
+    _run(src, out, part_rows=20)
+    parts = sorted(out.glob("part-[0-9]*.parquet"))
+    assert len(parts) == 3
+    df = pd.concat([pd.read_parquet(p) for p in parts])
+    assert sorted(df["row"]) == list(range(N_ROWS))
+    assert (out / "part-final.parquet").read_bytes() == b"not ours"
+    os.remove(str(out) + ".checkpoint.json")
+    with pytest.raises(SystemExit):   # parts but no checkpoint to resume from
+        _run(src, out, part_rows=20)
@@ -0,0 +1,48 @@
+import gc
+
+import pytest
+
+np = pytest.importorskip("numpy")
+from PIL import Image
+
+from app.decode_pool import DecodePool, clip_crop, decode_pixels
+
+
+def _photo(tmp_path, name, size, seed=0):
+    rng = np.random.RandomState(seed)
+    path = tmp_path / name
+    Image.fromarray(rng.randint(0, 255, (size[1], size[0], 3), dtype=np.uint8)).save(path)
+    return path
+
+
+@pytest.mark.parametrize("size", [(300, 260), (260, 300), (224, 400), (640, 640)])
+def test_clip_crop_matches_torchvision(tmp_path, size):
+    clip_mod = pytest.importorskip("clip.clip")
+    img = Image.open(_photo(tmp_path, "a.png", size)).convert("RGB")
+    head = clip_mod._transform(224).transforms[:-2]
+    expected = img
+    for t in head:
+        expected = t(expected)
+    assert np.array_equal(clip_crop(img, 224), np.asarray(expected))
+
+
+def test_pool_writes_into_shared_slots_and_recycles(tmp_path):
+    path = _photo(tmp_path, "b.png", (320, 280), seed=1)
+    pool = DecodePool(workers=1, slots=1, slot_wait_s=0.2)
+    try:
+        first = pool.decode(str(path), fast=False)
+        assert np.array_equal(first, decode_pixels(str(path), 224, fast=False))
+        assert pool.decode(path.read_bytes(), fast=False) is None    # only slot still referenced
+
+        del first
+        gc.collect()
+        again = pool.decode(path.read_bytes(), fast=True)
+        assert again.shape == (224, 224, 3)
+        del again
+        gc.collect()
+        with pytest.raises(Exception):
+            pool.decode(b"not an image", fast=True)
+        st = pool.stats()
+        assert st["jobs_done"] == 2 and st["jobs_failed"] == 1 and st["slot_timeouts"] == 1
+    finally:
+        pool.close()
@@ -0,0 +1,68 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from app.feature_cache import NpyStore
+
+
+def test_npy_store_roundtrip_and_disabled(tmp_path):
+    store = NpyStore(str(tmp_path / "pixels"), max_bytes=1 << 20)
+    arr = np.arange(224 * 224 * 3, dtype=np.uint8).reshape(224, 224, 3)
+    assert store.get("ab" * 20) is None
+    store.put("ab" * 20, arr)
+    got = store.get("ab" * 20)
+    assert got.dtype == np.uint8 and np.array_equal(got, arr)
+
+    off = NpyStore(str(tmp_path / "off"), max_bytes=0)
+    off.put("ab" * 20, arr)
+    assert off.get("ab" * 20) is None and off.stats() is None
+    assert not (tmp_path / "off").exists()
+
+
+def _photo(tmp_path, name, size):
+    """Smooth synthetic photo (gradients + blobs) so downscaling behaves like a real picture."""
+    from PIL import Image
+    w, h = size
+    y, x = np.mgrid[0:h, 0:w].astype(np.float32)
+    img = np.stack([x / w * 255, y / h * 255, 128 + 100 * np.sin(x / 37.0) * np.cos(y / 53.0)], axis=-1)
+    path = tmp_path / name
+    Image.fromarray(img.clip(0, 255).astype(np.uint8)).save(path, quality=92)
+    return path
+
+
+@pytest.fixture
+def clip_pre(tmp_path, monkeypatch):
+    pytest.importorskip("torch")
+    clip_mod = pytest.importorskip("clip.clip")
+    from app import clip_wrapper as cw
+
+    monkeypatch.setattr(cw, "PIXEL_CACHE_DIR", str(tmp_path / "pixels"))
+    return cw, clip_mod._transform(224)
+
+
+def test_cached_pixels_match_full_preprocess(tmp_path, monkeypatch, clip_pre):
+    from PIL import Image
+    cw, preprocess = clip_pre
+    monkeypatch.setattr(cw, "FAST_DECODE", False)
+    path = _photo(tmp_path, "img.png", (300, 260))
+    fetched = cw.fetch_images([str(path)])[0]
+
+    expected = preprocess(Image.open(path).convert("RGB"))
+    miss = cw._prepare_input(fetched, preprocess)
+    hit = cw._prepare_input(fetched, preprocess)
+    assert miss.dtype == hit.dtype == cw.torch.uint8
+    assert cw._stack_inputs([miss, hit]).equal(cw.torch.stack([expected, expected]))
+
+
+def test_reduced_decode_stays_close(tmp_path, monkeypatch, clip_pre):
+    from PIL import Image
+    cw, preprocess = clip_pre
+    monkeypatch.setattr(cw, "FAST_DECODE", True)
+    for name in ("big.jpg", "big.webp"):
+        path = _photo(tmp_path, name, (1080, 1350))
+        fetched = cw.fetch_images([str(path)])[0]
+        assert max(cw._open_reduced(fetched.data, 224).size) < 1080
+
+        expected = preprocess(Image.open(path).convert("RGB"))
+        fast = cw._stack_inputs([cw._prepare_input(fetched, preprocess)])[0]
+        assert (fast - expected).abs().mean() < 0.02
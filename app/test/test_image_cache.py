@@ -0,0 +1,79 @@
+import hashlib
+import os
+
+from app.image_cache import DiskImageCache
+
+
+def _h(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+def _files(root):
+    return sorted(os.path.relpath(os.path.join(d, f), root) for d, _, fs in os.walk(root) for f in fs)
+
+
+def test_put_get_sharded_and_dedup(tmp_path):
+    cache = DiskImageCache(str(tmp_path), max_bytes=10_000)
+    data = b"x" * 100
+    assert cache.put("ig:a", data, _h(data)) is False
+    assert cache.put("ig:b", data, _h(data)) is True     # same content under another key
+
+    hit = cache.get("ig:b")
+    assert hit.content_hash == _h(data) and hit.data[:] == data
+    assert cache.get("ig:missing") is None
+    blobs = [f for f in _files(str(tmp_path)) if f.startswith("blobs")]
+    assert blobs == [os.path.join("blobs", _h(data)[:2], _h(data)[2:4], _h(data) + ".img")]
+    assert not any(f.endswith(".tmp") for f in _files(str(tmp_path)))
+
+
+def test_lru_eviction_keeps_budget(tmp_path):
+    cache = DiskImageCache(str(tmp_path), max_bytes=250)
+    blobs = [bytes([i]) * 100 for i in range(3)]
+    cache.put("k0", blobs[0], _h(blobs[0]))
+    cache.put("k1", blobs[1], _h(blobs[1]))
+    assert cache.get("k0") is not None                    # k1 is now least recently used
+    cache.put("k2", blobs[2], _h(blobs[2]))
+
+    assert cache.get("k1") is None
+    assert cache.get("k0") is not None and cache.get("k2") is not None
+    st = cache.stats()
+    assert st["bytes"] <= 250 and st["evictions"] == 1 and st["blobs"] == 2
+
+
+def test_index_survives_restart(tmp_path):
+    data = b"y" * 64
+    DiskImageCache(str(tmp_path)).put("ig:a", data, _h(data))
+
+    reopened = DiskImageCache(str(tmp_path))
+    assert reopened.get("ig:a").data[:] == data
+    assert reopened.stats()["bytes"] == 64
+
+
+def test_workers_share_one_budget(tmp_path):
+    a = DiskImageCache(str(tmp_path), max_bytes=1600)
+    b = DiskImageCache(str(tmp_path), max_bytes=1600)   # a second worker on the same directory
+    for i in range(10):
+        data = bytes([i]) * 100
+        a.put(f"a{i}", data, _h(data))
+    for i in range(10):
+        data = bytes([100 + i]) * 100
+        b.put(f"b{i}", data, _h(data))
+
+    on_disk = sum(os.path.getsize(os.path.join(tmp_path, f)) for f in _files(str(tmp_path)) if f.startswith("blobs"))
+    assert on_disk <= 1600
+    assert b.stats()["bytes"] == on_disk
+    assert b.get("b9") is not None and a.get("a0") is None   # a's oldest went first
+
+
+def test_compaction_keeps_other_workers_keys(tmp_path):
+    a = DiskImageCache(str(tmp_path))
+    b = DiskImageCache(str(tmp_path))
+    da, db = b"a" * 10, b"b" * 10
+    a.put("ka", da, _h(da))
+    b.put("kb", db, _h(db))
+    with b._lock, b._dir_lock():
+        b._resync_locked()
+        b._compact_index_locked()
+
+    reopened = DiskImageCache(str(tmp_path))
+    assert reopened.get("ka").data[:] == da and reopened.get("kb").data[:] == db
@@ -0,0 +1,153 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+torch = pytest.importorskip("torch")
+pytest.importorskip("clip")
+
+from app import logic
+
+N_IMAGES = 40
+
+
+def _fake_probs(seed, prompts):
+    """Deterministic softmax per image; positive prompts get a per-image bias so every branch is hit."""
+    rng = np.random.RandomState(seed)
+    logits = rng.normal(0.0, 1.5, size=len(prompts))
+    logits[0::2] += (seed % 5) * 0.6
+    e = np.exp(logits - logits.max())
+    return (e / e.sum()).astype(np.float32).tolist()
+
+
+@pytest.fixture
+def fake_clip(monkeypatch):
+    def features(key):
+        return ValueError("boom") if key == "bad" else torch.tensor([[float(key)]])
+
+    def fetch(urls, *args, **kwargs):
+        return [ValueError("boom") if u == "bad" else logic.FetchedImage(u, b"", u) for u in urls]
+
+    def encode_fetched(fetched, *args, **kwargs):
+        return [f if isinstance(f, Exception) else features(f.content_hash) for f in fetched]
+
+    def probs_matrix(features, model, device, prompts):
+        return [_fake_probs(int(f[0]), prompts) for f in features]
+
+    monkeypatch.setattr(logic, "fetch_images", fetch)
+    monkeypatch.setattr(logic, "encode_fetched", encode_fetched)
+    monkeypatch.setattr(logic, "predict_probs_matrix", probs_matrix)
+    logic.RESULT_CACHE.clear()
+    yield
+    logic.RESULT_CACHE.clear()
+
+
+# (final_prob, clothing_value, votes, female gate score, person gate score) of the baseline
+# dict-based evaluate_image for _fake_probs(seed): image 0 fails the gate, 5 fails the vote count.
+GOLDEN = {
+    "weighted_pos": {
+        0: (0.0, None, None, 0.8855268744132115, 0.0),
+        1: (0.9205515852788189, 0.9205515852788189, 11, 0.9811858508426549, 0.804898349873664),
+        5: (0.0, 0.8349220598019405, 4, 0.7609957539003623, 0.9824379177567215),
+        8: (0.859301237518831, 0.859301237518831, 10, 0.5744139103611826, 0.7229353253169137),
+        20: (0.8903049521426324, 0.8903049521426324, 7, 0.7373116182457397, 0.9828961126494374),
+    },
+    "weighted_gap": {
+        0: (0.0, None, None, 0.8855268744132115, 0.0),
+        1: (0.8411031705576375, 0.8411031705576375, 11, 0.9811858508426549, 0.804898349873664),
+        5: (0.0, 0.6698441196038809, 4, 0.7609957539003623, 0.9824379177567215),
+        8: (0.7186024750376617, 0.7186024750376617, 10, 0.5744139103611826, 0.7229353253169137),
+        20: (0.7806099042852648, 0.7806099042852648, 7, 0.7373116182457397, 0.9828961126494374),
+    },
+    "max_pos": {
+        0: (0.0, None, None, 0.8855268744132115, 0.0),
+        1: (0.997222362389986, 0.997222362389986, 11, 0.9811858508426549, 0.804898349873664),
+        5: (0.0, 0.9824379172233731, 4, 0.7609957539003623, 0.9824379177567215),
+        8: (0.9912571000605037, 0.9912571000605037, 10, 0.5744139103611826, 0.7229353253169137),
+        20: (0.989351019471138, 0.989351019471138, 7, 0.7373116182457397, 0.9828961126494374),
+    },
+}
+GOLDEN["max_gap"] = GOLDEN["max_pos"]   # the best-gap pair is also the highest pos_prob for these images
+
+
+@pytest.mark.parametrize("fast", [True, False])
+@pytest.mark.parametrize("agg", sorted(GOLDEN))
+def test_matches_baseline_golden_values(fake_clip, agg, fast):
+    for seed, expected in GOLDEN[agg].items():
+        r = logic.evaluate_image(str(seed), None, None, None, agg=agg, fast=fast)
+        got = (r["final_prob"], r["clothing_value"], r["clothing_meta"].get("votes"),
+               r["female_meta"]["score"], r["person_meta"]["score"])
+        assert got == pytest.approx(expected, rel=1e-12), seed
+    assert logic.evaluate_image("bad", None, None, None)["error"] == "stage1_scores_incomplete"
+
+
+def test_result_cache_serves_repeat_images(fake_clip, monkeypatch):
+    urls = [str(i) for i in range(10)] + ["bad"]
+    first = logic.evaluate_images(urls, None, None, None)
+
+    def no_encode(*args, **kwargs):
+        raise AssertionError("cached images must not be re-encoded")
+
+    monkeypatch.setattr(logic, "encode_fetched", no_encode)
+    hits = logic.RESULT_CACHE.hits
+    again = logic.evaluate_images(urls[:-1], None, None, None)
+
+    assert again == first[:-1]
+    assert logic.RESULT_CACHE.hits - hits == len(urls) - 1
+
+
+def test_detail_levels_agree_with_full(fake_clip):
+    urls = [str(i) for i in range(N_IMAGES)] + ["bad"]
+    full = logic.evaluate_images(urls, None, None, None)
+    scores = logic.evaluate_images(urls, None, None, None, detail="scores")
+    minimal = logic.evaluate_images(urls, None, None, None, detail="minimal")
+
+    assert [r["final_prob"] for r in scores] == [r["final_prob"] for r in full]
+    assert [r["final_prob"] for r in minimal] == [r["final_prob"] for r in full]
+    assert all(set(r) == {"url", "final_prob"} for r in minimal[:-1])
+    assert minimal[-1]["error"] == "stage1_scores_incomplete"
+
+    ps = logic.prompt_set()
+    for f, s in zip(full[:-1], scores[:-1]):
+        assert s["prompt_set"] == ps["id"]
+        for group, key in (("female", "female_meta"), ("person", "person_meta"),
+                           ("ff", "ff_breakdown"), ("be", "be_breakdown")):
+            expected = [[p["pos_prob"], p["neg_prob"], p["passed"]] for p in f[key]["pairs"]]
+            assert s["pairs"].get(group, []) == expected
+            assert len(expected) in (0, len(ps["pairs"][group]))
+
+
+def test_downloads_and_encode_have_separate_deadlines(fake_clip, monkeypatch):
+    import time
+    seen = {}
+    fetch, encode = logic.fetch_images, logic.encode_fetched
+    monkeypatch.setattr(logic, "fetch_images", lambda urls, **kw: seen.update(fetch=kw["deadline"]) or fetch(urls))
+    monkeypatch.setattr(logic, "encode_fetched",
+                        lambda fetched, *a, **kw: seen.update(encode=kw["deadline"]) or encode(fetched))
+    monkeypatch.setattr(logic, "encode_deadline", lambda: "encode deadline")
+
+    start = time.monotonic()
+    logic.evaluate_images(["1"], None, None, None, timeout=3)
+    assert start + 3 <= seen["fetch"] <= time.monotonic() + 3
+    assert seen["encode"] == "encode deadline"
+
+
+@pytest.mark.parametrize("n_pairs", [13, 4], ids=["full", "fast"])
+@pytest.mark.parametrize("weight_key", ["diff", "confidence", "pos_prob", "nope"])
+@pytest.mark.parametrize("agg", logic.AGG_MODES)
+def test_array_helpers_match_dict_helpers(agg, weight_key, n_pairs):
+    # fast mode judges only the first k pairs of a group, so the helpers also see narrow arrays
+    rng = np.random.RandomState(7)
+    pos = rng.uniform(0, 1, size=(64, n_pairs))
+    neg = rng.uniform(0, 1, size=(64, n_pairs)) * (1.0 - pos)
+    judged = logic._judge_pairs_array(pos, neg)
+    values, metas = logic._aggregate_value_from_passed_array(judged, agg=agg, weight_key=weight_key)
+    score, used, wsum = logic._aggregate_group_score_array(judged, weight_key=weight_key)
+
+    for i in range(pos.shape[0]):
+        records = [logic._judge_pair_by_thresholds(p, n) for p, n in zip(pos[i], neg[i])]
+        val, meta = logic._aggregate_value_from_passed(records, agg=agg, weight_key=weight_key)
+        gate, gate_meta = logic._aggregate_group_score_all(records, weight_key=weight_key)
+        assert (val is None and np.isnan(values[i])) or val == values[i]
+        assert meta == metas[i]
+        assert gate == score[i]
+        assert gate_meta["used"] == used[i]
+        assert gate_meta["weight_sum"] == wsum[i]
@@ -0,0 +1,92 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+
+def test_light_modules_do_not_import_torch():
+    code = ("import sys, app.config, app.home, app.window; "
+            "print(sorted(m for m in ('torch', 'clip', 'numpy') if m in sys.modules))")
+    out = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True)
+    assert out.stdout.strip() == "[]"
+
+
+def test_model_load_is_validated():
+    env = {**os.environ, "MODEL_LOAD": "eager"}
+    out = subprocess.run([sys.executable, "-c", "import app.config"], capture_output=True, text=True, env=env)
+    assert out.returncode != 0 and "MODEL_LOAD must be one of" in out.stderr
+
+
+def _tiny_clip():
+    import torch
+    from clip.model import CLIP
+    torch.manual_seed(0)
+    return CLIP(embed_dim=64, image_resolution=224, vision_layers=2, vision_width=64, vision_patch_size=32,
+                context_length=77, vocab_size=49408, transformer_width=64, transformer_heads=1,
+                transformer_layers=2).eval()
+
+
+def test_load_from_local_state_dict(tmp_path):
+    torch = pytest.importorskip("torch")
+    pytest.importorskip("clip")
+    from app.clip_wrapper import load_clip_model, warmup_image_encoder
+
+    ref = _tiny_clip()
+    path = tmp_path / "snapshot.pt"
+    torch.save(ref.state_dict(), path)
+
+    model, preprocess, device = load_clip_model(device="cpu", weights_path=str(path))
+    x = torch.rand(2, 3, 224, 224)
+    with torch.no_grad():
+        # clip's build_model round-trips the weights through fp16
+        assert torch.allclose(model.encode_image(x), ref.encode_image(x), atol=5e-2)
+    assert set(warmup_image_encoder(model, device, [1, 3, 0])) == {1, 3}
+
+    with pytest.raises(FileNotFoundError):
+        load_clip_model(device="cpu", weights_path=str(tmp_path / "missing.pt"))
+
+
+@pytest.mark.parametrize("backend", ["int8", "bf16", "traced"])
+def test_cpu_backends_stay_close_to_fp32(backend):
+    torch = pytest.importorskip("torch")
+    pytest.importorskip("clip")
+    from app import clip_wrapper as cw
+
+    x = [torch.randint(0, 256, (3, 224, 224), dtype=torch.uint8) for _ in range(5)]
+    ref = cw.encode_images(x, _tiny_clip(), "cpu")
+    model = _tiny_clip()
+    model.cpu_backend = cw.apply_cpu_backend(model, backend)
+    out = cw.encode_images(x, model, "cpu", batch_size=3)   # traced graph must take other batch sizes
+
+    assert out.dtype == torch.float32 and out.shape == ref.shape
+    assert (out * ref).sum(dim=-1).min() > 0.99
+    assert cw.encoder_id(model).endswith("" if model.cpu_backend == "fp32" else f"+{backend}")
+    with pytest.raises(ValueError):
+        cw.apply_cpu_backend(_tiny_clip(), "fp8")
+
+
+def test_text_bank_is_keyed_by_weights(tmp_path, monkeypatch):
+    torch = pytest.importorskip("torch")
+    pytest.importorskip("clip")
+    from collections import OrderedDict
+    from app import clip_wrapper as cw
+    from app.clip_wrapper import build_text_bank, load_clip_model
+
+    monkeypatch.setattr(cw, "_TEXT_BANK", {})
+    monkeypatch.setattr(cw, "_TEXT_LRU", OrderedDict())
+
+    path = tmp_path / "snapshot.pt"
+    torch.save(_tiny_clip().state_dict(), path)
+    model, _, device = load_clip_model(device="cpu", weights_path=str(path))
+    bank = build_text_bank(["a photo"], model, device, cache_dir=str(tmp_path / "text"))
+    assert model.weights_id.startswith("ViT-B/32@") and model.weights_id[-12:] in bank
+    assert torch.load(bank)["model"] == model.weights_id
+
+    torch.save(_tiny_clip().half().state_dict(), path)   # other weights, same path
+    other, _, _ = load_clip_model(device="cpu", weights_path=str(path))
+    assert other.weights_id != model.weights_id
+    assert build_text_bank(["a photo"], other, device, cache_dir=str(tmp_path / "text")) != bank
+    # in memory too: both banks stay loaded and each model gets its own features
+    for m in (model, other):
+        assert torch.equal(cw.encode_text(["a photo"], m, device), cw._encode_text_uncached(["a photo"], m, device))
@@ -0,0 +1,134 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from app.netguard import CircuitBreaker, CircuitOpenError, NegativeCache
+
+
+def test_negative_cache_ttl():
+    neg = NegativeCache(ttl_s=0.05)
+    neg.put("u", 404)
+    assert neg.get("u") == 404
+    time.sleep(0.06)
+    assert neg.get("u") is None
+    assert NegativeCache(ttl_s=0).get("u") is None
+
+
+def test_breaker_opens_then_half_opens():
+    cb = CircuitBreaker(threshold=2, cooldown_s=0.05)
+    cb.failure("h")
+    cb.before("h")                       # still closed
+    cb.failure("h")
+    with pytest.raises(CircuitOpenError):
+        cb.before("h")
+    time.sleep(0.06)
+    cb.before("h")                       # the trial
+    with pytest.raises(CircuitOpenError):
+        cb.before("h")                   # only one trial at a time
+    cb.failure("h")                      # trial failed: open again
+    with pytest.raises(CircuitOpenError):
+        cb.before("h")
+    time.sleep(0.06)
+    cb.before("h")
+    cb.success("h")
+    cb.before("h")
+    assert cb.stats()["open_hosts"] == [] and cb.stats()["opened"] == 1
+
+
+class _Handler(BaseHTTPRequestHandler):
+    hits = 0
+    busy = set()
+
+    def do_GET(self):
+        type(self).hits += 1
+        if self.path.startswith("/busy") and self.path not in self.busy:
+            self.busy.add(self.path)   # 503 once, then serve
+            self.send_response(503)
+            self.send_header("Retry-After", self.path.split("=")[1])
+            self.end_headers()
+            return
+        if self.path.startswith("/gone") or "expired" in self.path:
+            self.send_response(404)
+            self.end_headers()
+            return
+        if self.path.startswith(("/img", "/busy")):
+            self.send_response(200)
+            self.end_headers()
+            self.wfile.write(b"fresh")
+            return
+        time.sleep(2)   # /slow
+        self.send_response(200)
+        self.end_headers()
+        self.wfile.write(b"late")
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    srv = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    _Handler.hits = 0
+    _Handler.busy.clear()
+    yield f"http://127.0.0.1:{srv.server_address[1]}"
+    srv.shutdown()
+
+
+def test_download_negative_cache_and_deadline(server, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)   # image cache lives under ./.cache
+    pytest.importorskip("torch")
+    pytest.importorskip("clip")
+    from app import clip_wrapper as cw
+    from app.netguard import PermanentFetchError
+
+    with pytest.raises(PermanentFetchError):
+        cw._download(f"{server}/gone.jpg", 8)
+    with pytest.raises(PermanentFetchError) as e:
+        cw._download(f"{server}/gone.jpg", 8)
+    assert e.value.cached and _Handler.hits == 1
+
+    start = time.monotonic()
+    got = cw.fetch_images([f"{server}/slow.jpg"], timeout=8, deadline=time.monotonic() + 0.5)
+    assert isinstance(got[0], Exception)
+    assert time.monotonic() - start < 1.5
+
+
+def test_follower_retries_own_url_after_leaders_permanent_failure(server, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    pytest.importorskip("torch")
+    pytest.importorskip("clip")
+    from app import clip_wrapper as cw
+    from app.netguard import PermanentFetchError
+
+    expired, fresh = f"{server}/img.jpg?utm_source=expired", f"{server}/img.jpg?utm_source=fresh"
+    assert cw.image_key(expired) == cw.image_key(fresh)   # one flight for both
+    got = cw.fetch_images([expired, fresh], timeout=8)
+    assert isinstance(got[0], PermanentFetchError)
+    assert bytes(got[1].data) == b"fresh"
+
+
+def test_download_honors_retry_after(server, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    pytest.importorskip("torch")
+    pytest.importorskip("clip")
+    import email.utils
+    import requests
+    from app import clip_wrapper as cw
+
+    start = time.monotonic()
+    assert cw._download(f"{server}/busy.jpg?wait=1", 8) == b"fresh"
+    assert time.monotonic() - start >= 1.0   # not the 0.6 s first backoff
+
+    start = time.monotonic()
+    with pytest.raises(requests.HTTPError):   # waiting would pass the deadline: fail now
+        cw._download(f"{server}/busy.jpg?wait=30", 8, deadline=time.monotonic() + 2)
+    assert time.monotonic() - start < 1.0
+
+    resp = requests.Response()
+    resp.headers["Retry-After"] = email.utils.formatdate(time.time() + 5, usegmt=True)
+    assert 3.0 < cw._retry_after(resp) <= 5.0
+    resp.headers["Retry-After"] = "soon"
+    assert cw._retry_after(resp) is None
@@ -0,0 +1,85 @@
+import json
+
+import pytest
+
+np = pytest.importorskip("numpy")
+torch = pytest.importorskip("torch")
+clip_mod = pytest.importorskip("clip.clip")
+
+from collections import OrderedDict
+
+from app import clip_wrapper as cw, logic, prompt_eval
+from app.test.test_model_load import _tiny_clip
+
+N_IMAGES = 24
+
+
+@pytest.fixture
+def corpus(tmp_path, monkeypatch):
+    from PIL import Image
+    for name in ("PIXEL_CACHE_DIR", "EMBED_CACHE_DIR"):
+        monkeypatch.setattr(cw, name, str(tmp_path / name))
+    monkeypatch.setattr(cw, "_TEXT_BANK", {})            # text features of the tiny model only
+    monkeypatch.setattr(cw, "_TEXT_LRU", OrderedDict())
+    logic.RESULT_CACHE.clear()
+    rng = np.random.RandomState(0)
+    paths = []
+    for i in range(N_IMAGES):
+        path = tmp_path / f"img{i}.png"
+        Image.fromarray(rng.randint(0, 255, size=(64 + i, 80, 3), dtype=np.uint8)).save(path)
+        paths.append(str(path))
+    listing = tmp_path / "labels.jsonl"
+    listing.write_text("".join(json.dumps({"path": p, "label": i % 3 == 0}) + "\n" for i, p in enumerate(paths)))
+    model, preprocess = _tiny_clip(), clip_mod._transform(224)
+    built = prompt_eval.build_corpus(str(listing), str(tmp_path / "corpus"), model, preprocess, "cpu",
+                                     batch_size=10)
+    yield built, model, preprocess, paths
+    logic.RESULT_CACHE.clear()
+
+
+def test_corpus_scores_match_the_app(corpus):
+    built, model, preprocess, paths = corpus
+    assert len(built) == N_IMAGES and built.labels.sum() == N_IMAGES // 3
+    again = prompt_eval.Corpus(built.directory)
+    assert np.array_equal(np.asarray(again.embeddings), np.asarray(built.embeddings))
+
+    app = logic.evaluate_images(paths, model, preprocess, "cpu", detail="scores")
+    female, person = logic.FEMALE_PAIRS[:4], logic.PERSON_PAIRS[:4]   # fast mode, k=4
+    pairs = female + person
+    pos, _ = prompt_eval.pair_probs(built.embeddings, pairs, model, "cpu")
+    expected = np.array([[p for p, _, _ in r["pairs"]["female"] + r["pairs"]["person"]] for r in app])
+    assert np.allclose(pos, expected, atol=1e-5)
+
+    report = prompt_eval.evaluate(built, model, "cpu")
+    assert report["pairs_scored"] == len(pairs) + len(logic.FORM_FIT_PAIRS) + len(logic.BODY_EXPOSURE_PAIRS)
+    assert set(report["aggregate"]) == {"current"}
+    final = prompt_eval.rules_final_prob({
+        "female": logic._judge_pairs_array(*prompt_eval.pair_probs(built.embeddings, female, model, "cpu")),
+        "person": logic._judge_pairs_array(*prompt_eval.pair_probs(built.embeddings, person, model, "cpu")),
+        "clothing": logic._judge_pairs_array(*prompt_eval.pair_probs(
+            built.embeddings, logic.FORM_FIT_PAIRS + logic.BODY_EXPOSURE_PAIRS, model, "cpu")),
+    })["final_prob"]
+    assert np.allclose(final, [r["final_prob"] for r in app], atol=1e-5)
+
+
+def test_candidates_replace_their_group(corpus):
+    built, model, _, _ = corpus
+    candidates = [{"pos": f"a photo of {w}", "neg": "a photo of a landscape", "group": "be"}
+                  for w in ("skin", "a swimsuit", "a crop top")] + \
+                 [{"pos": "a selfie", "neg": "a document", "group": "candidate"}]
+    report = prompt_eval.evaluate(built, model, "cpu", candidates)
+    assert report["aggregate"]["candidates"]["replaced_groups"] == ["be"]
+    assert [p["group"] for p in report["pairs"] if p["source"] == "candidate"] == ["be"] * 3 + ["candidate"]
+    assert all(p["auc"] is None or 0 <= p["auc"] <= 1 for p in report["pairs"])
+
+
+def test_auc_and_binary_metrics():
+    rng = np.random.RandomState(1)
+    labels = rng.rand(200) < 0.3
+    scores = np.c_[rng.rand(200), np.round(rng.rand(200), 1), labels.astype(float)]
+    pos, neg = scores[labels], scores[~labels]
+    brute = [((p[:, None] > n[None, :]).mean() + 0.5 * (p[:, None] == n[None, :]).mean())
+             for p, n in zip(pos.T, neg.T)]
+    assert np.allclose(prompt_eval.auc(scores, labels), brute)
+    m = prompt_eval.binary_metrics(scores > 0.5, labels)
+    assert m["precision"][2] == 1.0 and m["recall"][2] == 1.0
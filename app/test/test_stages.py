@@ -0,0 +1,26 @@
+import pytest
+
+from app.stages import STAGE_NAMES, StageTimers
+
+
+def test_stage_timers_count_items_and_errors():
+    t = StageTimers()
+
+    @t.timed("scoring")
+    def score():
+        return 1
+
+    assert score() + score() == 2
+    with t.timed("encode", n=8):
+        pass
+    with pytest.raises(RuntimeError):
+        with t.timed("download"):
+            raise RuntimeError("boom")
+
+    stats = t.stats()
+    assert set(STAGE_NAMES) <= set(stats)
+    assert stats["scoring"]["count"] == 2
+    assert stats["encode"]["count"] == 8
+    assert stats["download"]["count"] == 1
+    assert stats["decode"] == {"count": 0, "total_s": 0.0}
+    assert all(s["total_s"] >= 0 for s in stats.values())
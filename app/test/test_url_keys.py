@@ -0,0 +1,46 @@
+from app.url_keys import DedupStats, canonical_key
+
+IG_A = ("https://scontent-tpe1-1.cdninstagram.com/v/t51.29350-15/"
+        "461234567_1234567890123456_1234567890123456789_n.jpg"
+        "?stp=dst-jpg_e35_p1080x1080&_nc_ht=scontent-tpe1-1.cdninstagram.com&_nc_cat=1"
+        "&_nc_ohc=abc&edm=ABC&ccb=7-5&oh=00_AaA&oe=67000000&_nc_sid=10d13b")
+IG_B = ("https://instagram.ftpe7-2.fna.fbcdn.net/v/t51.29350-15/s640x640/"
+        "461234567_1234567890123456_1234567890123456789_n.webp"
+        "?stp=dst-webp_s640x640&_nc_ht=instagram.ftpe7-2.fna.fbcdn.net&oh=00_BbB&oe=68000000")
+
+
+def test_instagram_variants_share_one_key():
+    assert canonical_key(IG_A) == canonical_key(IG_B)
+    assert canonical_key(IG_A) == "ig:461234567_1234567890123456_1234567890123456789_n"
+
+
+def test_other_urls_drop_only_tracking_params():
+    a = canonical_key("https://Example.com/img/1.jpg?b=2&utm_source=x&a=1&UTM_medium=y")
+    b = canonical_key("https://example.com/img/1.jpg?a=1&b=2&utm_campaign=z")
+    assert a == b == "https://example.com/img/1.jpg?a=1&b=2"
+    assert canonical_key("https://example.com/img/1.jpg?a=2") != a
+    # CDN-looking params mean something else on other hosts
+    assert canonical_key("https://example.com/get?id=1&dl=1&stp=2") == "https://example.com/get?dl=1&id=1&stp=2"
+
+
+def test_cdn_urls_without_asset_id_drop_cdn_params():
+    a = canonical_key("https://scontent.cdninstagram.com/v/profile.jpg?x=1&oh=a&oe=b&stp=s150&_nc_cat=3")
+    b = canonical_key("https://scontent.cdninstagram.com/v/profile.jpg?x=1&oh=c&dl=1&utm_source=y")
+    assert a == b == "https://scontent.cdninstagram.com/v/profile.jpg?x=1"
+
+
+def test_local_paths_unchanged():
+    assert canonical_key("/tmp/x.jpg") == "/tmp/x.jpg"
+    assert canonical_key("file:///tmp/x.jpg") == "file:///tmp/x.jpg"
+
+
+def test_dedup_stats():
+    s = DedupStats()
+    s.seen_url(IG_A, canonical_key(IG_A))
+    s.downloaded(100, duplicate=False)
+    s.seen_url(IG_B, canonical_key(IG_B))
+    s.cache_hit(100)
+    st = s.stats()
+    assert st["url_variants_collapsed"] == 1
+    assert st["dedup_ratio"] == 0.5
+    assert st["bytes_saved"] == 100
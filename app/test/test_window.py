@@ -6,8 +6,7 @@ def setup_function():
     """每個測試前都清空測試用戶的 window"""
     test_users = [f"u{i}" for i in range(5)]
     for uid in test_users:
-        if uid in window._locks:
-            window.reset(uid)
+        window.reset(uid)
 
 def test_push_and_decide_basic():
     user = "u1"
@@ -97,3 +96,160 @@ def test_threaded_multi_user():
         assert len(w) == 5, f"{uid} window length error: {w}"
         assert all(isinstance(x, float) for x in w)
         assert w[-1] > w[0], f"{uid} window not increasing: {w}"
+
+
+def _push_many(args):
+    path, worker, n = args
+    store = window.SQLiteWindowStore(path)
+    return [(p, store.push_and_decide("shared", p)[0]) for p in (worker + i / 1000 for i in range(n))]
+
+def test_sqlite_store_matches_memory(tmp_path):
+    sqlite_store = window.SQLiteWindowStore(str(tmp_path / "w.sqlite"))
+    memory_store = window.MemoryWindowStore()
+    memory_store.reset("sq")
+    for p in [0.4, 0.7, 0.6, None, 0.3, 0.8, 0.2, 0.4, 0.9]:
+        assert sqlite_store.push_and_decide("sq", p) == memory_store.push_and_decide("sq", p)
+    assert sqlite_store.snapshot("sq") == memory_store.snapshot("sq")
+
+    sqlite_store.reset("sq")
+    assert sqlite_store.snapshot("sq") == []
+    # a second connection (another worker) sees the same windows
+    sqlite_store.push_and_decide("sq", 0.9)
+    assert window.SQLiteWindowStore(str(tmp_path / "w.sqlite")).snapshot("sq") == [0.9]
+
+def test_sqlite_store_shared_across_processes(tmp_path):
+    """Concurrent pushes from several processes for one user: none is lost."""
+    import multiprocessing as mp
+    path = str(tmp_path / "w.sqlite")
+    window.SQLiteWindowStore(path)   # create the schema before the workers race for it
+    workers, n = 4, 25
+    with mp.get_context("spawn").Pool(workers) as pool:
+        results = [r for chunk in pool.map(_push_many, [(path, w, n) for w in range(workers)]) for r in chunk]
+
+    assert len(results) == workers * n
+    assert all(w[-1] == p for p, w in results)
+    # every push saw a different history: lengths 1..4 exactly once, the rest full
+    lengths = sorted(len(w) for _, w in results)
+    assert lengths[:window.WINDOW_SIZE - 1] == list(range(1, window.WINDOW_SIZE))
+    assert set(lengths[window.WINDOW_SIZE - 1:]) == {window.WINDOW_SIZE}
+
+def test_make_store():
+    assert isinstance(window.make_store("memory"), window.MemoryWindowStore)
+    assert isinstance(window.make_store("app.window:MemoryWindowStore"), window.MemoryWindowStore)
+    with pytest.raises(ValueError):
+        window.make_store("redis")
+
+def test_ring_buffer_decisions_match_resumming():
+    """Running cumulative gives exactly what sum() over the window gives (same float rounding)."""
+    import random
+    from collections import deque
+    rng = random.Random(0)
+    store = window.MemoryWindowStore(max_users=0, idle_ttl_s=0)
+    ref = deque(maxlen=window.WINDOW_SIZE)
+    for _ in range(5000):
+        p = rng.choice([rng.random(), 0.5, 0.6, 0.1 * rng.randrange(11), 1 / 3])
+        ref.append(p)
+        w, cumulative, intervention = store.push_and_decide("ring", p)
+        assert w == list(ref)
+        assert (cumulative, intervention) == window.decide(list(ref))
+
+def test_idle_users_are_evicted():
+    now = [0.0]
+    store = window.MemoryWindowStore(max_users=0, idle_ttl_s=60, stripes=1, clock=lambda: now[0])
+    store.push_and_decide("idle", 0.9)
+    store.push_and_decide("idle", 0.9)
+    now[0] = 30
+    store.push_and_decide("active", 0.9)
+    assert store.snapshot("idle") == [0.9, 0.9]
+
+    now[0] = 61
+    assert store.snapshot("idle") == []          # expired, even before it is pruned
+    assert store.push_and_decide("idle", 0.7)[0] == [0.7]   # starts a fresh window
+    now[0] = 200
+    store.push_and_decide("late", 0.1)
+    assert store.stats()["evicted_idle"] >= 2
+    assert len(store) == 1
+
+def test_reads_do_not_create_users_and_lru_is_bounded():
+    store = window.MemoryWindowStore(max_users=100, idle_ttl_s=0, stripes=4)
+    assert store.snapshot("nobody") == []
+    assert store.push_and_decide("nobody", None) == ([], 0, False)
+    assert len(store) == 0
+    for i in range(1000):
+        store.push_and_decide(f"anon-{i}", 0.6)
+    assert len(store) <= 100
+    assert store.stats()["evicted_lru"] >= 900
+    assert store.snapshot("anon-999") == [0.6]   # the most recent users survive
+
+def test_contended_pushes_stay_consistent_and_bounded():
+    """Small contended run of bench/window_stress.py; throughput at scale is measured there."""
+    from bench.window_stress import run
+    report = run("memory", users=5_000, pushes=20_000, threads=8, max_users=1_000, stripes=8)
+    assert report["inconsistent_results"] == 0
+    assert report["resident_users"] <= 1_000
+    assert report["stats"]["evicted_lru"] > 0
+
+def _journaled(path, **kw):
+    from app.window_journal import WindowJournal
+    journal = WindowJournal(str(path), fsync_ms=kw.pop("fsync_ms", 10_000), snapshot_interval_s=0)
+    return window.MemoryWindowStore(max_users=0, idle_ttl_s=kw.pop("idle_ttl_s", 0), journal=journal, **kw)
+
+def test_journal_restores_windows_after_restart(tmp_path):
+    import random
+    rng = random.Random(1)
+    store = _journaled(tmp_path)
+    for _ in range(3000):
+        store.push_and_decide(f"j{rng.randrange(200)}", rng.random())
+    store.push_and_decide("gone", 0.9)
+    store.reset("gone")
+    before = {u: store.snapshot(u) for u in (f"j{i}" for i in range(200))}
+    store.close()
+
+    restored = _journaled(tmp_path)
+    assert restored.journal.replayed == 3002
+    assert {u: restored.snapshot(u) for u in before} == before
+    assert restored.snapshot("gone") == []
+    for u, w in before.items():   # decisions carry on from the same windows
+        assert restored.push_and_decide(u, 0.7) == store.push_and_decide(u, 0.7)
+    restored.close()
+
+def test_journal_snapshot_then_tail_and_torn_write(tmp_path):
+    import os
+    store = _journaled(tmp_path)
+    for i in range(50):
+        store.push_and_decide(f"s{i % 10}", 0.6 + i / 1000)
+    store.journal.snapshot()                       # snapshot + truncation of older segments
+    store.push_and_decide("s1", 0.99)
+    store.push_and_decide("tail", 0.8)
+    store.journal.flush()                          # what the background thread does every fsync_ms
+    expected = {u: store.snapshot(u) for u in [f"s{i}" for i in range(10)] + ["tail"]}
+    names = sorted(n for n in os.listdir(tmp_path) if n != ".lock")
+    assert names[0].startswith("journal-") and names[-1].startswith("snapshot-") and len(names) == 2
+    with open(tmp_path / names[0], "ab") as f:     # crash mid-write: half a record at the end
+        f.write(b'[1700000000.0,"s1",[0.')
+    # no close(): the process "crashed" and its directory lock went with it; a new store
+    # replays snapshot + tail segment
+    os.close(store.journal._lock_fd)
+    store.journal._lock_fd = None
+    restored = _journaled(tmp_path)
+    assert {u: restored.snapshot(u) for u in expected} == expected
+    restored.close()
+    store.close()
+
+def test_journal_replay_respects_idle_ttl(tmp_path):
+    import json, time
+    tmp_path.joinpath("journal-000001.jsonl").write_text(
+        json.dumps([time.time() - 7200, "old", [0.9]]) + "\n" + json.dumps([time.time(), "new", [0.9]]) + "\n")
+    store = _journaled(tmp_path, idle_ttl_s=3600)
+    assert store.snapshot("old") == [] and store.snapshot("new") == [0.9]
+    assert len(store) == 1
+    store.close()
+
+def test_journal_directory_serves_one_process(tmp_path):
+    import os
+    from app.window_journal import JournalLockedError
+    store = _journaled(tmp_path)
+    with pytest.raises(JournalLockedError, match=str(os.getpid())):
+        _journaled(tmp_path)                       # e.g. a second uvicorn worker
+    store.close()
+    _journaled(tmp_path).close()                   # free again once the owner closed it
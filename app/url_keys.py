@@ -0,0 +1,114 @@
+"""
+Canonical keys for image URLs.
+
+Instagram/Facebook CDN URLs carry rotating signature/expiry params (oh=, oe=, _nc_*) and
+size/format variants (stp=, /s640x640/ path segments), and the same photo is served from many
+edge hosts. Hashing the raw URL therefore never hits the cache twice. canonical_key() maps
+every variant of one CDN asset to a stable id. Other URLs only lose utm_* tracking params:
+on an arbitrary host, a param named like a CDN one (dl=, se=, stp=) may well select the image.
+
+DedupStats counts how much that (plus the content-hash index kept by the image cache) saves.
+"""
+import re
+import threading
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+# hosts whose file name is a stable asset id
+_CDN_HOST_SUFFIXES = ("cdninstagram.com", "fbcdn.net")
+# e.g. 461234567_1234567890123456_1234567890123456789_n.jpg
+_CDN_ASSET_RE = re.compile(r"^(\d+_\d+_\d+_[a-z])\.(?:jpe?g|png|webp|heic|avif)$", re.IGNORECASE)
+
+# signature / expiry / variant params the Instagram/FB CDN adds; only volatile on CDN hosts
+_CDN_PARAMS = {"oh", "oe", "efg", "ccb", "edm", "stp", "se", "ig_cache_key", "dl"}
+_CDN_PREFIXES = ("_nc_",)
+# campaign tracking, dropped for every host
+_TRACKING_PREFIXES = ("utm_",)
+
+
+def _is_volatile(param: str, cdn: bool) -> bool:
+    p = param.lower()
+    if p.startswith(_TRACKING_PREFIXES):
+        return True
+    return cdn and (p in _CDN_PARAMS or p.startswith(_CDN_PREFIXES))
+
+
+def canonical_key(url: str) -> str:
+    """
+    Stable identity for an image URL.
+      - Instagram/FB CDN asset  -> "ig:<asset id>" (host, size variant and signature ignored)
+      - other http(s) URLs      -> scheme://host/path?<sorted params>, without utm_* (and, on CDN
+                                   hosts, without the CDN signature / variant params)
+      - local paths / file://   -> unchanged
+    """
+    if not url.startswith(("http://", "https://")):
+        return url
+    try:
+        parts = urlsplit(url)
+    except ValueError:
+        return url
+
+    host = (parts.hostname or "").lower()
+    cdn = host.endswith(_CDN_HOST_SUFFIXES)
+    if cdn:
+        m = _CDN_ASSET_RE.match(parts.path.rsplit("/", 1)[-1])
+        if m:
+            return f"ig:{m.group(1).lower()}"
+
+    query = sorted((k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if not _is_volatile(k, cdn))
+    netloc = host if parts.port is None else f"{host}:{parts.port}"
+    key = f"{parts.scheme.lower()}://{netloc}{parts.path}"
+    return f"{key}?{urlencode(query)}" if query else key
+
+
+class DedupStats:
+    """Counters for how often canonicalization / content hashing collapsed work."""
+
+    def __init__(self, max_tracked: int = 200_000):
+        self.max_tracked = max_tracked
+        self._lock = threading.Lock()
+        self._raw_by_key = {}          # canonical key -> first raw URL seen
+        self.requests = 0              # image fetch requests
+        self.url_variants = 0          # raw URL differs from the first one seen for its canonical key
+        self.cache_hits = 0            # served from disk cache (no download)
+        self.downloads = 0
+        self.content_duplicates = 0    # new canonical key, but bytes already cached under another key
+        self.bytes_downloaded = 0
+        self.bytes_saved = 0           # bytes served from cache or not stored twice
+
+    def seen_url(self, raw_url: str, key: str) -> None:
+        with self._lock:
+            self.requests += 1
+            first = self._raw_by_key.get(key)
+            if first is None:
+                if len(self._raw_by_key) >= self.max_tracked:
+                    self._raw_by_key.clear()
+                self._raw_by_key[key] = raw_url
+            elif first != raw_url:
+                self.url_variants += 1
+
+    def cache_hit(self, nbytes: int) -> None:
+        with self._lock:
+            self.cache_hits += 1
+            self.bytes_saved += nbytes
+
+    def downloaded(self, nbytes: int, duplicate: bool) -> None:
+        with self._lock:
+            self.downloads += 1
+            self.bytes_downloaded += nbytes
+            if duplicate:
+                self.content_duplicates += 1
+                self.bytes_saved += nbytes
+
+    def stats(self) -> dict:
+        with self._lock:
+            fetched = self.cache_hits + self.downloads
+            return {
+                "requests": self.requests,
+                "url_variants_collapsed": self.url_variants,
+                "cache_hits": self.cache_hits,
+                "downloads": self.downloads,
+                "content_duplicates": self.content_duplicates,
+                "dedup_ratio": ((self.cache_hits + self.content_duplicates) / fetched) if fetched else 0.0,
+                "bytes_downloaded": self.bytes_downloaded,
+                "bytes_saved": self.bytes_saved,
+            }
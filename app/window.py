@@ -1,28 +1,376 @@
-from collections import defaultdict, deque
+"""
+Per-user sliding window of final_prob values and the intervention decision.
+
+The window lives in a pluggable WindowStore (see get_store), so several uvicorn workers or
+hosts can share it:
+  - MemoryWindowStore (default): this process only, bounded by idle TTL + LRU; with
+    WINDOW_JOURNAL_DIR set it survives restarts through a journal (app/window_journal.py).
+    A journal directory is owned by one process (flock, checked at startup), so use the
+    SQLite store with --workers N
+  - SQLiteWindowStore: one file shared by every process on the box (WAL, atomic push-and-decide)
+  - any WindowStore subclass given as "package.module:ClassName", e.g. a networked store
+"""
+from array import array
+from collections import OrderedDict
+import importlib
+import json
+import logging
+import os
+import sqlite3
 import threading
-from typing import List, Tuple, Optional
+import time
+from typing import Callable, List, Tuple, Optional
+
+from .config import (WINDOW_DB, WINDOW_IDLE_TTL_S, WINDOW_JOURNAL_DIR, WINDOW_JOURNAL_FSYNC_MS,
+                     WINDOW_LOCK_STRIPES, WINDOW_MAX_USERS, WINDOW_SNAPSHOT_INTERVAL_S, WINDOW_STORE)
+from .window_journal import WindowJournal
+
+logger = logging.getLogger(__name__)
 
 WINDOW_SIZE = 5
 MIN_PROB = 0.5
 THRESHOLD = 1.8
 
-_locks = defaultdict(lambda: threading.Lock())
-_windows = defaultdict(lambda: deque(maxlen=WINDOW_SIZE))
+
+def decide(window_list: List[float]) -> Tuple[float, bool]:
+    """(cumulative, intervention) for a window: only probabilities > MIN_PROB count."""
+    cumulative = sum(x for x in window_list if x > MIN_PROB)
+    return cumulative, cumulative > THRESHOLD
+
+
+# ---------- stores ----------
+
+class WindowStore:
+    """
+    Storage for user windows. push_and_decide must be atomic per user: appending, trimming to
+    WINDOW_SIZE and deciding happen as one step even with concurrent pushes from other threads,
+    processes or hosts (a networked store would do it in one transaction or server-side script),
+    otherwise pushes get lost and the cumulative score never reaches THRESHOLD.
+    """
+
+    def push_and_decide(self, user_id: str, prob: Optional[float]) -> Tuple[List[float], float, bool]:
+        """Append prob (None: append nothing) and return (window, cumulative, intervention)."""
+        raise NotImplementedError
+
+    def snapshot(self, user_id: str) -> List[float]:
+        raise NotImplementedError
+
+    def reset(self, user_id: str) -> None:
+        raise NotImplementedError
+
+    def stats(self) -> dict:
+        return {"store": type(self).__name__}
+
+    def close(self) -> None:
+        """Release files / connections at shutdown."""
+
+
+class _Ring:
+    """
+    The latest WINDOW_SIZE probabilities in a fixed array (ring buffer) plus their cumulative.
+    The cumulative is kept running while the window fills (adding newest-last is the same
+    left-to-right sum as decide()) and re-summed only when a counted value falls out, so
+    decisions are bit-identical to re-summing the list on every push.
+    """
+    __slots__ = ("probs", "start", "count", "cumulative", "seen")
+
+    def __init__(self, now: float):
+        self.probs = array("d", bytes(8 * WINDOW_SIZE))
+        self.start = 0
+        self.count = 0
+        self.cumulative = 0   # int 0 until something counts, like sum() over an empty window
+        self.seen = now
+
+    def push(self, p: float) -> None:
+        if self.count < WINDOW_SIZE:
+            self.probs[(self.start + self.count) % WINDOW_SIZE] = p
+            self.count += 1
+            if p > MIN_PROB:
+                self.cumulative += p
+            return
+        dropped = self.probs[self.start]
+        self.probs[self.start] = p
+        self.start = (self.start + 1) % WINDOW_SIZE
+        if dropped > MIN_PROB:
+            self.cumulative = decide(self.values())[0]
+        elif p > MIN_PROB:
+            self.cumulative += p
+
+    def values(self) -> List[float]:
+        if self.count < WINDOW_SIZE:
+            return self.probs[:self.count].tolist()
+        return (self.probs[self.start:] + self.probs[:self.start]).tolist()
+
+
+class _Shard:
+    __slots__ = ("lock", "users", "evicted_idle", "evicted_lru")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.users: "OrderedDict[str, _Ring]" = OrderedDict()   # least recently pushed first
+        self.evicted_idle = 0
+        self.evicted_lru = 0
+
+
+class MemoryWindowStore(WindowStore):
+    """
+    Process-local windows, bounded: users are split over `stripes` shards, each with one lock
+    and an LRU dict of ring buffers. A user idle for idle_ttl_s, or the least recently pushed
+    user of a shard over its share of max_users, is dropped (0 disables either bound).
+    Reads never create entries. With a journal, every push and reset is recorded and the
+    journal is replayed into the store on construction.
+    """
+
+    def __init__(self, max_users: int = WINDOW_MAX_USERS, idle_ttl_s: float = WINDOW_IDLE_TTL_S,
+                 stripes: int = WINDOW_LOCK_STRIPES, clock: Callable[[], float] = time.monotonic,
+                 journal: Optional[WindowJournal] = None):
+        self._shards = [_Shard() for _ in range(max(1, int(stripes)))]
+        self.max_users = int(max_users)
+        self.idle_ttl_s = float(idle_ttl_s)
+        self._per_shard = -(-self.max_users // len(self._shards)) if self.max_users > 0 else 0
+        self._clock = clock
+        self.journal = journal
+        if journal is not None:
+            journal.open(self.restore, self.dump)
+
+    def _shard(self, user_id: str) -> _Shard:
+        return self._shards[hash(user_id) % len(self._shards)]
+
+    def _idle(self, ring: _Ring, now: float) -> bool:
+        return self.idle_ttl_s > 0 and now - ring.seen > self.idle_ttl_s
+
+    def _evict(self, shard: _Shard, now: float) -> None:
+        users = shard.users
+        if self.idle_ttl_s <= 0 and (not self._per_shard or len(users) <= self._per_shard):
+            return
+        while users:
+            ring = users[next(iter(users))]
+            if self._idle(ring, now):
+                shard.evicted_idle += 1
+            elif self._per_shard and len(users) > self._per_shard:
+                shard.evicted_lru += 1
+            else:
+                return
+            users.popitem(last=False)
+
+    def push_and_decide(self, user_id, prob):
+        now = self._clock()
+        shard = self._shard(user_id)
+        with shard.lock:
+            ring = shard.users.get(user_id)
+            if ring is not None and self._idle(ring, now):
+                del shard.users[user_id]
+                shard.evicted_idle += 1
+                ring = None
+            if ring is None:
+                if prob is None:
+                    return [], 0, False
+                ring = shard.users[user_id] = _Ring(now)
+            else:
+                shard.users.move_to_end(user_id)
+            if prob is not None:
+                ring.push(float(prob))
+                ring.seen = now
+            window_list, cumulative = ring.values(), ring.cumulative
+            if prob is not None and self.journal is not None:
+                self.journal.record(user_id, window_list)
+            self._evict(shard, now)
+        return window_list, cumulative, cumulative > THRESHOLD
+
+    def snapshot(self, user_id):
+        shard = self._shard(user_id)
+        with shard.lock:
+            ring = shard.users.get(user_id)
+            if ring is None or self._idle(ring, self._clock()):
+                return []
+            return ring.values()
+
+    def reset(self, user_id):
+        shard = self._shard(user_id)
+        with shard.lock:
+            if shard.users.pop(user_id, None) is not None and self.journal is not None:
+                self.journal.record(user_id, [])
+
+    def restore(self, ts: float, user_id: str, window_list: List[float]) -> None:
+        """Set a user's window as of wall-clock time ts (journal replay); an empty window removes the user."""
+        now = self._clock()
+        shard = self._shard(user_id)
+        ring = None
+        if window_list:
+            ring = _Ring(now - max(0.0, time.time() - ts))
+            for p in window_list[-WINDOW_SIZE:]:
+                ring.push(float(p))
+        with shard.lock:
+            shard.users.pop(user_id, None)
+            if ring is not None and not self._idle(ring, now):
+                shard.users[user_id] = ring
+                self._evict(shard, now)
+
+    def dump(self):
+        """(wall-clock ts, user_id, window) for every resident user, least recently pushed first per shard."""
+        for shard in self._shards:
+            with shard.lock:
+                now, wall = self._clock(), time.time()
+                rows = [(wall - (now - ring.seen), user_id, ring.values())
+                        for user_id, ring in shard.users.items() if not self._idle(ring, now)]
+            yield from rows
+
+    def close(self):
+        if self.journal is not None:
+            self.journal.close()
+
+    def __len__(self) -> int:
+        return sum(len(s.users) for s in self._shards)
+
+    def stats(self):
+        return {
+            "store": "memory",
+            "users": len(self),
+            "max_users": self.max_users,
+            "idle_ttl_s": self.idle_ttl_s,
+            "stripes": len(self._shards),
+            "evicted_idle": sum(s.evicted_idle for s in self._shards),
+            "evicted_lru": sum(s.evicted_lru for s in self._shards),
+            "journal": self.journal.stats() if self.journal is not None else None,
+        }
+
+
+class SQLiteWindowStore(WindowStore):
+    """
+    Windows in one SQLite file (WAL) shared by all workers on a host. push_and_decide runs in a
+    BEGIN IMMEDIATE transaction, which takes the database write lock before reading the window,
+    so concurrent pushes for a user from any process are serialized and none is lost.
+    Windows idle for idle_ttl_s read as empty and are deleted every `prune_every` pushes.
+    """
+
+    def __init__(self, path: str, busy_timeout_ms: int = 5000, idle_ttl_s: float = WINDOW_IDLE_TTL_S,
+                 prune_every: int = 1024):
+        self.path = path
+        self.idle_ttl_s = float(idle_ttl_s)
+        self.prune_every = int(prune_every)
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None,
+                                   timeout=busy_timeout_ms / 1000)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS windows ("
+                         "user_id TEXT PRIMARY KEY, probs TEXT NOT NULL, updated REAL NOT NULL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS windows_updated ON windows(updated)")
+        self._lock = threading.Lock()
+        self.pushes = 0
+        self.pruned = 0
+
+    def _cutoff(self) -> float:
+        return time.time() - self.idle_ttl_s if self.idle_ttl_s > 0 else float("-inf")
+
+    def _read(self, user_id: str) -> List[float]:
+        row = self._db.execute("SELECT probs FROM windows WHERE user_id = ? AND updated >= ?",
+                               (user_id, self._cutoff())).fetchone()
+        return json.loads(row[0]) if row else []
+
+    def push_and_decide(self, user_id, prob):
+        with self._lock:
+            if prob is None:
+                window_list = self._read(user_id)
+            else:
+                self._db.execute("BEGIN IMMEDIATE")
+                try:
+                    window_list = (self._read(user_id) + [float(prob)])[-WINDOW_SIZE:]
+                    self._db.execute("INSERT OR REPLACE INTO windows (user_id, probs, updated) VALUES (?, ?, ?)",
+                                     (user_id, json.dumps(window_list), time.time()))
+                    self._db.execute("COMMIT")
+                except BaseException:
+                    self._db.execute("ROLLBACK")
+                    raise
+                self.pushes += 1
+                if self.idle_ttl_s > 0 and self.pushes % self.prune_every == 0:
+                    self.pruned += self._db.execute("DELETE FROM windows WHERE updated < ?",
+                                                    (self._cutoff(),)).rowcount
+        cumulative, intervention = decide(window_list)
+        return window_list, cumulative, intervention
+
+    def snapshot(self, user_id):
+        with self._lock:
+            return self._read(user_id)
+
+    def reset(self, user_id):
+        with self._lock:
+            self._db.execute("DELETE FROM windows WHERE user_id = ?", (user_id,))
+
+    def stats(self):
+        with self._lock:
+            users = self._db.execute("SELECT COUNT(*) FROM windows").fetchone()[0]
+        return {"store": "sqlite", "path": self.path, "users": users, "pushes": self.pushes,
+                "pruned": self.pruned, "idle_ttl_s": self.idle_ttl_s}
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def make_store(spec: str, db_path: str = WINDOW_DB, journal_dir: str = WINDOW_JOURNAL_DIR) -> WindowStore:
+    """
+    "memory" (journaled to journal_dir if set), "sqlite" (file at db_path) or
+    "package.module:ClassName" (a WindowStore built with no args).
+    """
+    if spec in ("", "memory"):
+        journal = None
+        if journal_dir:
+            journal = WindowJournal(journal_dir, WINDOW_JOURNAL_FSYNC_MS, WINDOW_SNAPSHOT_INTERVAL_S)
+        return MemoryWindowStore(journal=journal)
+    if spec == "sqlite":
+        return SQLiteWindowStore(db_path)
+    module, _, name = spec.partition(":")
+    if not name:
+        raise ValueError(f"WINDOW_STORE must be memory, sqlite or module:Class, got {spec!r}")
+    store = getattr(importlib.import_module(module), name)()
+    if not isinstance(store, WindowStore):
+        raise TypeError(f"{spec} is not a WindowStore")
+    return store
+
+
+_STORE: Optional[WindowStore] = None
+_STORE_LOCK = threading.Lock()
+
+
+def get_store() -> WindowStore:
+    """The store selected by WINDOW_STORE, created on first use."""
+    global _STORE
+    if _STORE is None:
+        with _STORE_LOCK:
+            if _STORE is None:
+                _STORE = make_store(WINDOW_STORE)
+                logger.info(f"Window store: {type(_STORE).__name__}")
+    return _STORE
+
+
+def set_store(store: WindowStore) -> None:
+    global _STORE
+    _STORE = store
+
+
+def close_store() -> None:
+    """Close the store if one was created (flushes the journal), so the next get_store() reopens it."""
+    global _STORE
+    with _STORE_LOCK:
+        if _STORE is not None:
+            _STORE.close()
+            _STORE = None
+
+
+# ---------- API ----------
 
 def reset(user_id: str) -> None:
     """
     clear user's window。
     """
-    if user_id in _locks:
-        with _locks[user_id]:
-            _windows.pop(user_id, None)
+    get_store().reset(user_id)
 
 def snapshot(user_id: str) -> List[float]:
     """
     return window
     """
-    with _locks[user_id]:
-        return list(_windows.get(user_id, []))
+    return get_store().snapshot(user_id)
 
 def _safe_to_float(x) -> Optional[float]:
     try:
@@ -40,13 +388,7 @@ def push_and_decide(user_id: str, prob: float) -> Tuple[List[float], float, bool
     - cumulative: float (only add probability > 0.5)
     - intervention: bool (cumulative > 1.8)
     """
-    with _locks[user_id]:
-        w = _windows[user_id]
-        prob = _safe_to_float(prob)
-        if prob is not None:
-            w.append(float(prob))
+    return get_store().push_and_decide(user_id, _safe_to_float(prob))
 
-        window_list = list(w)
-        cumulative = sum(x for x in window_list if x > MIN_PROB)
-        intervention = cumulative > THRESHOLD
-        return window_list, cumulative, intervention
+def store_stats() -> dict:
+    return get_store().stats()
@@ -0,0 +1,273 @@
+"""
+Append-only journal of per-user windows, so a deploy or crash does not reset intervention progress.
+
+Each push records the user's window *after* the push ([wall_ts, user_id, window] as one JSON line;
+an empty window is a reset). Records describe state rather than deltas, so replay is
+last-writer-wins and replaying a record twice is harmless.
+
+Disk I/O stays off the request path. push_and_decide only encodes the record (bytes, so queued
+records add no work for the garbage collector) and appends it to a deque. A background thread
+writes the deque to the current segment and fsyncs it every fsync_ms, so a crash loses at most
+that interval. Every snapshot_interval_s the journal moves to a new segment, the full
+state is written to snapshot-<n>.jsonl (tmp file + fsync + rename), and older segments and
+snapshots are deleted. Startup loads the newest snapshot and replays the segments from its
+number on, keeping only the last record per user. A torn last line from a crash is skipped.
+Records are encoded with orjson when it is installed (stdlib json otherwise).
+
+A journal directory belongs to one process: open() takes an exclusive, non-blocking flock on
+<directory>/.lock and raises JournalLockedError if another process (e.g. a second uvicorn
+worker) holds it, instead of letting two writers interleave segments and delete each other's
+files. The lock is released by close() or when the process exits.
+"""
+import gc
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import deque
+from typing import Callable, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+try:
+    import fcntl
+except ImportError:   # no flock (Windows): the single-process rule is not enforced
+    fcntl = None
+
+try:
+    import orjson
+
+    _dumps, _loads = orjson.dumps, orjson.loads
+except ImportError:
+    def _dumps(rec) -> bytes:
+        return json.dumps(rec, separators=(",", ":")).encode("utf-8")
+
+    _loads = json.loads
+
+Record = Tuple[float, str, List[float]]   # (wall-clock ts, user_id, window after the push)
+
+_SEGMENT_RE = re.compile(r"^journal-(\d+)\.jsonl$")
+_SNAPSHOT_RE = re.compile(r"^snapshot-(\d+)\.jsonl$")
+
+
+class JournalLockedError(RuntimeError):
+    """The journal directory is in use by another process."""
+
+
+def _lock_directory(directory: str) -> Optional[int]:
+    """Exclusive flock on <directory>/.lock (fd, or None without fcntl); fails fast if it is held."""
+    if fcntl is None:
+        return None
+    fd = os.open(os.path.join(directory, ".lock"), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        holder = os.read(fd, 32).decode("ascii", "replace").strip() or "?"
+        os.close(fd)
+        raise JournalLockedError(
+            f"window journal {directory} is in use by process {holder}; a journal directory serves one "
+            f"process (use WINDOW_STORE=sqlite for several workers)") from None
+    os.ftruncate(fd, 0)
+    os.write(fd, str(os.getpid()).encode("ascii"))
+    return fd
+
+
+def _numbered(directory: str, pattern) -> List[Tuple[int, str]]:
+    out = []
+    for name in os.listdir(directory):
+        m = pattern.match(name)
+        if m:
+            out.append((int(m.group(1)), os.path.join(directory, name)))
+    return sorted(out)
+
+
+def _read_lines(path: str) -> Iterable[Record]:
+    with open(path, "rb") as f:
+        for line in f:
+            try:
+                ts, user_id, window = _loads(line)
+            except ValueError:
+                continue   # torn write at the tail of a crashed segment
+            yield ts, user_id, window
+
+
+def _fsync_dir(directory: str) -> None:
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class WindowJournal:
+    def __init__(self, directory: str, fsync_ms: float = 200.0, snapshot_interval_s: float = 300.0):
+        self.directory = directory
+        self.fsync_s = max(0.001, fsync_ms / 1000)
+        self.snapshot_interval_s = float(snapshot_interval_s)
+        self._pending: "deque[bytes]" = deque()   # encoded records not yet written
+        self._io_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._file = None
+        self._lock_fd: Optional[int] = None
+        self._segment = 0
+        self._dump: Optional[Callable[[], Iterable[Record]]] = None
+        self._last_snapshot = time.monotonic()
+        self.records = 0
+        self.bytes_written = 0
+        self.flushes = 0
+        self.fsync_s_total = 0.0
+        self.snapshots = 0
+        self.snapshot_users = 0
+        self.snapshot_s = 0.0
+        self.replayed = 0
+        self.replay_s = 0.0
+
+    # ---------- lifecycle ----------
+
+    def open(self, apply: Callable[[float, str, List[float]], None],
+             dump: Callable[[], Iterable[Record]]) -> None:
+        """Replay the directory into `apply`, then start a new segment and the background flusher."""
+        os.makedirs(self.directory, exist_ok=True)
+        self._lock_fd = _lock_directory(self.directory)
+        start = time.perf_counter()
+        snapshots = _numbered(self.directory, _SNAPSHOT_RE)
+        base = snapshots[-1][0] if snapshots else 0
+        sources = ([snapshots[-1][1]] if snapshots else []) + \
+                  [path for n, path in _numbered(self.directory, _SEGMENT_RE) if n >= base]
+        latest = {}   # user_id -> (ts, window) of the last record, in order of that record
+        gc_was_enabled = gc.isenabled()
+        gc.disable()   # replay only allocates long-lived objects; collections would rescan them over and over
+        try:
+            for path in sources:
+                for ts, user_id, window in _read_lines(path):
+                    latest.pop(user_id, None)
+                    latest[user_id] = (ts, window)
+                    self.replayed += 1
+            for user_id, (ts, window) in latest.items():
+                apply(ts, user_id, window)
+        finally:
+            if gc_was_enabled:
+                gc.enable()
+        del latest
+        self.replay_s = time.perf_counter() - start
+        if sources:
+            logger.info(f"Window journal: replayed {self.replayed} records from {len(sources)} files "
+                        f"in {self.replay_s:.2f}s")
+
+        segments = _numbered(self.directory, _SEGMENT_RE)
+        self._segment = max([base] + [n for n, _ in segments]) + 1   # never append to a possibly torn file
+        self._file = open(os.path.join(self.directory, f"journal-{self._segment:06d}.jsonl"), "ab")
+        self._dump = dump
+        self._last_snapshot = time.monotonic()
+        self._thread = threading.Thread(target=self._run, name="window-journal", daemon=True)
+        self._thread.start()
+
+    def close(self) -> None:
+        """Flush and fsync what is pending and stop the flusher (state stays replayable)."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        with self._io_lock:
+            self._flush_locked()
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)   # releases the flock
+            self._lock_fd = None
+
+    # ---------- hot path ----------
+
+    def record(self, user_id: str, window: List[float]) -> None:
+        """Queue the user's window after a push (empty = reset). Called under the user's shard lock."""
+        self._pending.append(_dumps((time.time(), user_id, window)))
+
+    # ---------- background ----------
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.fsync_s):
+            try:
+                self.flush()
+                if self.snapshot_interval_s > 0 and time.monotonic() - self._last_snapshot >= self.snapshot_interval_s:
+                    self.snapshot()
+            except Exception:
+                logger.exception("Window journal write failed")
+
+    def flush(self) -> None:
+        with self._io_lock:
+            self._flush_locked()
+
+    def _flush_locked(self) -> None:
+        if self._file is None or not self._pending:
+            return
+        pending = self._pending
+        lines = [pending.popleft() for _ in range(len(pending))]
+        data = b"\n".join(lines) + b"\n"
+        start = time.perf_counter()
+        self._file.write(data)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.fsync_s_total += time.perf_counter() - start
+        self.records += len(lines)
+        self.bytes_written += len(data)
+        self.flushes += 1
+
+    def snapshot(self) -> None:
+        """Rotate to a new segment, write the full state as snapshot-<segment>, drop older files."""
+        start = time.perf_counter()
+        with self._io_lock:
+            self._flush_locked()
+            self._file.close()
+            self._segment += 1
+            segment = self._segment
+            self._file = open(os.path.join(self.directory, f"journal-{segment:06d}.jsonl"), "ab")
+        # state is read after the rotation: anything it misses is in the new segment, and
+        # records from before the copy that also land there only restore the same window
+        path = os.path.join(self.directory, f"snapshot-{segment:06d}.jsonl")
+        users = 0
+        with open(path + ".tmp", "wb") as f:
+            batch = []
+            for rec in self._dump():
+                batch.append(_dumps(rec))
+                users += 1
+                if len(batch) >= 10000:
+                    f.write(b"\n".join(batch) + b"\n")
+                    batch = []
+            if batch:
+                f.write(b"\n".join(batch) + b"\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+        _fsync_dir(self.directory)
+        for n, old in _numbered(self.directory, _SEGMENT_RE) + _numbered(self.directory, _SNAPSHOT_RE):
+            if n < segment:
+                os.remove(old)
+        self._last_snapshot = time.monotonic()
+        self.snapshots += 1
+        self.snapshot_users = users
+        self.snapshot_s = time.perf_counter() - start
+
+    def stats(self) -> dict:
+        return {
+            "directory": self.directory,
+            "segment": self._segment,
+            "pending": len(self._pending),
+            "records": self.records,
+            "bytes_written": self.bytes_written,
+            "flushes": self.flushes,
+            "fsync_ms_mean": 1000 * self.fsync_s_total / self.flushes if self.flushes else None,
+            "snapshots": self.snapshots,
+            "snapshot_users": self.snapshot_users,
+            "snapshot_s": round(self.snapshot_s, 3),
+            "replayed": self.replayed,
+            "replay_s": round(self.replay_s, 3),
+        }
@@ -0,0 +1 @@
+"""Benchmarks and accuracy checks; run from the repo root, e.g. `python -m bench.decode_accuracy`."""
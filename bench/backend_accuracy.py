@@ -0,0 +1,111 @@
+"""
+CPU inference backends (CPU_BACKEND=int8 / bf16 / traced) vs the fp32 image tower.
+
+Encodes the same preprocessed images with every backend, runs the 2-stage rules and reports
+image-encoder throughput, embedding cosine similarity, final_prob drift and decision flips:
+stage-1 gate pass/fail and final_prob > window.MIN_PROB (whether an image counts towards the
+intervention sum). Exits 1 if a backend flips any decision or drifts beyond --tolerance.
+
+    python -m bench.backend_accuracy --images path/to/instagram_jpgs --json backends.json
+    python -m bench.backend_accuracy --synthetic 64 --backends int8,bf16
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import torch
+
+from app import clip_wrapper as cw
+from app import logic
+from app.window import MIN_PROB
+from bench.decode_accuracy import _EXTS, _synthetic
+
+
+def _run(model, device, inputs, urls, batch_size: int, repeat: int):
+    cw.encode_images(inputs[:batch_size], model, device, batch_size=batch_size)   # warm up
+    start = time.perf_counter()
+    for _ in range(repeat):
+        feats = cw.encode_images(inputs, model, device, batch_size=batch_size)
+    elapsed = (time.perf_counter() - start) / repeat
+    rows = logic._evaluate_batch_from_features(urls, [feats[i:i + 1] for i in range(len(urls))],
+                                               model, device, detail="scores")
+    return {
+        "images_per_s": len(inputs) / elapsed,
+        "features": feats.float().cpu(),
+        "final_prob": np.asarray([r["final_prob"] for r in rows]),
+        "gate": np.asarray([r["gate"]["passed"] for r in rows]),
+    }
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument("--images", help="directory of reference images")
+    ap.add_argument("--synthetic", type=int, default=32, help="generated images when --images is not given")
+    ap.add_argument("--limit", type=int, default=500)
+    ap.add_argument("--backends", default="int8,bf16,traced", help="comma-separated, compared against fp32")
+    ap.add_argument("--batch-size", type=int, default=cw.ENCODE_BATCH_SIZE)
+    ap.add_argument("--repeat", type=int, default=2, help="timed passes over the image set")
+    ap.add_argument("--tolerance", type=float, default=0.02, help="max allowed |final_prob| drift")
+    ap.add_argument("--json", help="write the report here")
+    args = ap.parse_args(argv)
+
+    tmp = tempfile.TemporaryDirectory()
+    if args.images:
+        paths = sorted(os.path.join(args.images, p) for p in os.listdir(args.images) if p.lower().endswith(_EXTS))
+    else:
+        paths = _synthetic(args.synthetic, tmp.name)
+    paths = paths[:args.limit]
+    if not paths:
+        print("no images found", file=sys.stderr)
+        return 2
+
+    model, preprocess, device = cw.load_clip_model(device="cpu", backend="fp32")
+    logic.warm_text_bank(model, device)
+    fetched = [f for f in cw.fetch_images(paths) if isinstance(f, cw.FetchedImage)]
+    inputs = [cw._prepare_input(f, preprocess) for f in fetched]
+    urls = [f.url for f in fetched]
+    ref = _run(model, device, inputs, urls, args.batch_size, args.repeat)
+    del model
+
+    report = {
+        "images": len(fetched),
+        "threads": torch.get_num_threads(),
+        "bf16_supported": cw.bf16_supported(),
+        "fp32_images_per_s": ref["images_per_s"],
+        "tolerance": args.tolerance,
+        "backends": {},
+    }
+    for name in [b.strip() for b in args.backends.split(",") if b.strip()]:
+        model, _, device = cw.load_clip_model(device="cpu", backend=name)
+        out = _run(model, device, inputs, urls, args.batch_size, args.repeat)
+        del model
+        cos = (ref["features"] * out["features"]).sum(dim=-1).numpy()
+        drift = np.abs(ref["final_prob"] - out["final_prob"])
+        gate_flips = int(np.sum(ref["gate"] != out["gate"]))
+        count_flips = int(np.sum((ref["final_prob"] > MIN_PROB) != (out["final_prob"] > MIN_PROB)))
+        report["backends"][name] = {
+            "active": model.cpu_backend,
+            "images_per_s": out["images_per_s"],
+            "speedup": out["images_per_s"] / ref["images_per_s"],
+            "embedding_cosine": {"min": float(cos.min()), "mean": float(cos.mean())},
+            "final_prob_drift": {"max": float(drift.max()), "mean": float(drift.mean())},
+            "gate_flips": gate_flips,
+            f"min_prob_flips_at_{MIN_PROB}": count_flips,
+            "pass": bool(drift.max() <= args.tolerance and gate_flips == 0 and count_flips == 0),
+        }
+    report["pass"] = all(b["pass"] for b in report["backends"].values())
+
+    print(json.dumps(report, indent=2))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+    tmp.cleanup()
+    return 0 if report["pass"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
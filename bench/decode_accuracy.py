@@ -0,0 +1,123 @@
+"""
+Reduced-resolution decode (FAST_DECODE) vs the full-resolution CLIP preprocess.
+
+Decodes every image both ways, encodes with the real model and reports decode time,
+decoded bitmap size, embedding cosine similarity, per-prompt probability drift and
+final_prob drift of the 2-stage rules. Exits 1 if the max final_prob drift exceeds --tolerance.
+
+    python -m bench.decode_accuracy --images path/to/instagram_jpgs --json decode.json
+    python -m bench.decode_accuracy --synthetic 64     # no image dir: 1080x1350 generated JPEGs
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+
+from app import clip_wrapper as cw
+from app import logic
+
+_EXTS = (".jpg", ".jpeg", ".png", ".webp")
+
+
+def _synthetic(n: int, out_dir: str):
+    """Smooth 1080x1350 pictures (Instagram portrait size) with some texture."""
+    rng = np.random.RandomState(0)
+    y, x = np.mgrid[0:1350, 0:1080].astype(np.float32)
+    paths = []
+    for i in range(n):
+        fx, fy = rng.uniform(10, 80, size=2)
+        img = np.stack([
+            x / 1080 * 255,
+            y / 1350 * 255,
+            128 + 100 * np.sin(x / fx) * np.cos(y / fy),
+        ], axis=-1) + rng.normal(0, 6, size=(1350, 1080, 3))
+        path = os.path.join(out_dir, f"{i:04d}.jpg")
+        Image.fromarray(img.clip(0, 255).astype(np.uint8)).save(path, quality=90)
+        paths.append(path)
+    return paths
+
+
+def _run(fast: bool, fetched, model, preprocess, device):
+    cw.FAST_DECODE = fast
+    decode_s, bitmap = [], []
+    inputs = []
+    for f in fetched:
+        start = time.perf_counter()
+        inputs.append(cw._prepare_input(f, preprocess))
+        decode_s.append(time.perf_counter() - start)
+        img = cw._open_reduced(f.data, 224) if fast else cw._open_image(f.data).convert("RGB")
+        bitmap.append(img.size[0] * img.size[1] * 3)
+    feats = cw.encode_images(inputs, model, device)
+    probs = np.asarray(cw.predict_probs_matrix(feats, model, device, logic.ALL_PAIR_PROMPTS))
+    rows = logic._evaluate_batch_from_features([f.url for f in fetched], [feats[i:i + 1] for i in range(len(fetched))],
+                                               model, device)
+    return {
+        "decode_ms": 1000 * np.asarray(decode_s),
+        "bitmap_bytes": np.asarray(bitmap),
+        "features": feats.float().cpu(),
+        "probs": probs,
+        "final_prob": np.asarray([r["final_prob"] for r in rows]),
+    }
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument("--images", help="directory of images to compare on")
+    ap.add_argument("--synthetic", type=int, default=32, help="generated images when --images is not given")
+    ap.add_argument("--limit", type=int, default=500)
+    ap.add_argument("--tolerance", type=float, default=0.02, help="max allowed |final_prob| drift")
+    ap.add_argument("--json", help="write the report here")
+    args = ap.parse_args(argv)
+
+    tmp = tempfile.TemporaryDirectory()
+    if args.images:
+        paths = sorted(os.path.join(args.images, p) for p in os.listdir(args.images) if p.lower().endswith(_EXTS))
+    else:
+        paths = _synthetic(args.synthetic, tmp.name)
+    paths = paths[:args.limit]
+    if not paths:
+        print("no images found", file=sys.stderr)
+        return 2
+
+    # measure real decodes, not pixel-tier hits
+    cw.PIXEL_CACHE_DIR = os.path.join(tmp.name, "pixels")
+    cw.PIXEL_CACHE_MAX_BYTES = 0
+
+    model, preprocess, device = cw.load_clip_model()
+    fetched = [f for f in cw.fetch_images(paths) if isinstance(f, cw.FetchedImage)]
+    full = _run(False, fetched, model, preprocess, device)
+    fast = _run(True, fetched, model, preprocess, device)
+
+    cos = (full["features"] * fast["features"]).sum(dim=-1).numpy()
+    prob_drift = np.abs(full["probs"] - fast["probs"])
+    final_drift = np.abs(full["final_prob"] - fast["final_prob"])
+    flips = int(np.sum((full["final_prob"] >= 0.5) != (fast["final_prob"] >= 0.5)))
+    report = {
+        "images": len(fetched),
+        "device": str(device),
+        "decode_ms_mean": {"full": float(full["decode_ms"].mean()), "fast": float(fast["decode_ms"].mean())},
+        "decode_speedup": float(full["decode_ms"].sum() / max(fast["decode_ms"].sum(), 1e-9)),
+        "bitmap_mb_mean": {"full": float(full["bitmap_bytes"].mean() / 1e6), "fast": float(fast["bitmap_bytes"].mean() / 1e6)},
+        "embedding_cosine": {"min": float(cos.min()), "mean": float(cos.mean())},
+        "prompt_prob_drift": {"max": float(prob_drift.max()), "mean": float(prob_drift.mean())},
+        "final_prob_drift": {"max": float(final_drift.max()), "mean": float(final_drift.mean())},
+        "decision_flips_at_0.5": flips,
+        "tolerance": args.tolerance,
+        "pass": bool(final_drift.max() <= args.tolerance),
+    }
+    print(json.dumps(report, indent=2))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+    tmp.cleanup()
+    return 0 if report["pass"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,171 @@
+"""
+Local stand-in for the Instagram CDN: serves a synthetic JPEG/WebP corpus over HTTP with
+injected latency and errors.
+
+    GET /p/<id>.<jpg|webp>   image id % corpus size; with unique=True every id gets distinct
+                             bytes (a comment / extra chunk is spliced in), so content-hash
+                             caches behave like a feed of new posts
+    latency_ms ± jitter_ms   sleep before answering
+    error_rate               fraction of requests answered 503 (retried by the app)
+    missing_rate             fraction of ids that are always 404 (expired signature)
+
+    python -m bench.fake_cdn --port 8081 --latency-ms 80 --error-rate 0.02
+"""
+import argparse
+import io
+import random
+import struct
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List
+
+import numpy as np
+from PIL import Image
+
+_CONTENT_TYPES = {"jpg": "image/jpeg", "webp": "image/webp"}
+
+
+def synthetic_image(rng: np.random.RandomState, width: int, height: int) -> Image.Image:
+    """Smooth gradients + texture + noise: compresses and decodes like a photo, not like a flat fill."""
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    fx, fy = rng.uniform(10, 80, size=2)
+    img = np.stack([
+        x / width * 255,
+        y / height * 255,
+        128 + 100 * np.sin(x / fx) * np.cos(y / fy),
+    ], axis=-1) + rng.normal(0, 6, size=(height, width, 3))
+    return Image.fromarray(img.clip(0, 255).astype(np.uint8))
+
+
+def _tag(data: bytes, ext: str, tag: bytes) -> bytes:
+    """Same pixels, different bytes: JPEG COM segment after SOI / WebP unknown RIFF chunk."""
+    if ext == "jpg":
+        return data[:2] + b"\xff\xfe" + struct.pack(">H", len(tag) + 2) + tag + data[2:]
+    if len(tag) % 2:
+        tag += b"\0"
+    body = data[8:] + b"XTRA" + struct.pack("<I", len(tag)) + tag
+    return b"RIFF" + struct.pack("<I", len(body)) + body
+
+
+class FakeCDN:
+    def __init__(self, corpus: int = 64, formats=("jpg", "webp"), size=(1080, 1350),
+                 latency_ms: float = 50.0, jitter_ms: float = 30.0,
+                 error_rate: float = 0.0, missing_rate: float = 0.0,
+                 unique: bool = True, seed: int = 0, host: str = "127.0.0.1", port: int = 0):
+        rng = np.random.RandomState(seed)
+        self.images = {ext: [] for ext in formats}
+        for i in range(corpus):
+            img = synthetic_image(rng, *size)
+            for ext in formats:
+                buf = io.BytesIO()
+                img.save(buf, "JPEG" if ext == "jpg" else "WEBP", quality=85)
+                self.images[ext].append(buf.getvalue())
+        self.formats = tuple(formats)
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.missing_rate = missing_rate
+        self.unique = unique
+        self.seed = seed
+        self._lock = threading.Lock()
+        self.served = self.errors = self.missing = 0
+        self.bytes_served = 0
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def urls(self, start: int, n: int) -> List[str]:
+        """n image URLs with ids start..start+n-1, formats interleaved."""
+        return [f"{self.base_url}/p/{i}.{self.formats[i % len(self.formats)]}" for i in range(start, start + n)]
+
+    def _is_missing(self, image_id: int) -> bool:
+        return random.Random(self.seed * 1_000_003 + image_id).random() < self.missing_rate
+
+    def body(self, image_id: int, ext: str) -> bytes:
+        data = self.images[ext][image_id % len(self.images[ext])]
+        return _tag(data, ext, f"id={image_id}".encode()) if self.unique else data
+
+    def _handler(self):
+        cdn = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"   # keep-alive, like the real CDN
+
+            def do_GET(self):
+                delay = max(0.0, cdn.latency_ms + random.uniform(-cdn.jitter_ms, cdn.jitter_ms)) / 1000
+                if delay:
+                    time.sleep(delay)
+                name = self.path.split("?")[0].rsplit("/", 1)[-1]
+                stem, _, ext = name.partition(".")
+                if not stem.isdigit() or ext not in cdn.images:
+                    return self._send(404, b"not found", "text/plain")
+                if cdn._is_missing(int(stem)):
+                    with cdn._lock:
+                        cdn.missing += 1
+                    return self._send(404, b"URL signature expired", "text/plain")
+                if random.random() < cdn.error_rate:
+                    with cdn._lock:
+                        cdn.errors += 1
+                    return self._send(503, b"busy", "text/plain")
+                data = cdn.body(int(stem), ext)
+                with cdn._lock:
+                    cdn.served += 1
+                    cdn.bytes_served += len(data)
+                self._send(200, data, _CONTENT_TYPES[ext])
+
+            def _send(self, status: int, data: bytes, content_type: str):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def start(self) -> "FakeCDN":
+        self._thread = threading.Thread(target=self._server.serve_forever, name="fake-cdn", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"served": self.served, "errors_503": self.errors, "missing_404": self.missing,
+                    "bytes_served": self.bytes_served}
+
+
+def main(argv=None) -> None:
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument("--port", type=int, default=8081)
+    ap.add_argument("--corpus", type=int, default=64)
+    ap.add_argument("--formats", default="jpg,webp")
+    ap.add_argument("--latency-ms", type=float, default=50.0)
+    ap.add_argument("--jitter-ms", type=float, default=30.0)
+    ap.add_argument("--error-rate", type=float, default=0.0)
+    ap.add_argument("--missing-rate", type=float, default=0.0)
+    args = ap.parse_args(argv)
+    cdn = FakeCDN(corpus=args.corpus, formats=args.formats.split(","), latency_ms=args.latency_ms,
+                  jitter_ms=args.jitter_ms, error_rate=args.error_rate, missing_rate=args.missing_rate,
+                  port=args.port).start()
+    print(f"serving {args.corpus} images at {cdn.base_url}/p/<id>.<{args.formats.replace(',', '|')}>")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        cdn.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,347 @@
+"""
+End-to-end benchmark: /analyze, /evaluate and /evaluate_with_window against a local fake CDN.
+
+Starts bench.fake_cdn, launches the app with uvicorn in a subprocess (fresh cache directories,
+MODEL_LOAD=startup) unless --url points at a running server, and drives each endpoint at every
+concurrency x batch size combination. Per run it reports request latency p50/p95/p99, images/s,
+server CPU time / utilization and peak RSS, and the server's time per pipeline stage
+(download, decode, preprocess, encode, scoring; diffed from GET /metrics). Writes JSON with
+the git revision so runs can be compared across versions.
+
+    python -m bench.pipeline --json bench.json
+    python -m bench.pipeline --endpoints evaluate --concurrency 1,8,32 --batch-size 1,12 --requests 64
+    python -m bench.pipeline --latency-ms 150 --error-rate 0.05 --missing-rate 0.02
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+from typing import List, Optional
+
+import httpx
+import numpy as np
+
+from bench.fake_cdn import FakeCDN
+
+ENDPOINTS = {
+    "analyze": "/analyze",
+    "evaluate": "/evaluate",
+    "evaluate_with_window": "/evaluate_with_window",
+}
+_REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _ints(text: str) -> List[int]:
+    return [int(x) for x in text.split(",") if x.strip()]
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _git_rev() -> Optional[str]:
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=_REPO, capture_output=True, text=True)
+        return out.stdout.strip() or None
+    except OSError:
+        return None
+
+
+# ---------- server process probes (Linux /proc; None elsewhere) ----------
+
+_CLK_TCK = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+
+def _tree(pid: int) -> List[int]:
+    """pid and all live descendants (decode workers hang off a forkserver child)."""
+    out, todo = [], [pid]
+    while todo:
+        p = todo.pop()
+        out.append(p)
+        try:
+            with open(f"/proc/{p}/task/{p}/children") as f:
+                todo.extend(int(c) for c in f.read().split())
+        except OSError:
+            pass
+    return out
+
+
+def _cpu_seconds(pid: Optional[int]) -> Optional[float]:
+    """utime + stime summed over the server process tree."""
+    if pid is None:
+        return None
+    try:
+        total = 0.0
+        for p in _tree(pid):
+            with open(f"/proc/{p}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            total += (int(fields[11]) + int(fields[12])) / _CLK_TCK
+        return total
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def _rss_mb(pid: Optional[int]) -> Optional[float]:
+    if pid is None:
+        return None
+    try:
+        total = 0
+        for p in _tree(pid):
+            with open(f"/proc/{p}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1])
+        return total / 1024
+    except OSError:
+        return None
+
+
+class _RssSampler:
+    """Peak RSS of the server (and its decode workers) while a run is in progress."""
+
+    def __init__(self, pid: Optional[int], interval_s: float = 0.1):
+        self.pid = pid
+        self.interval_s = interval_s
+        self.peak = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+
+    def _loop(self):
+        while not self._stop.is_set():
+            rss = _rss_mb(self.pid)
+            if rss is not None:
+                self.peak = rss if self.peak is None else max(self.peak, rss)
+            self._stop.wait(self.interval_s)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+# ---------- server ----------
+
+def _start_server(port: int, cache_dir: str, log_path: str, ready_timeout_s: float) -> subprocess.Popen:
+    env = dict(os.environ)
+    env.setdefault("MODEL_LOAD", "startup")
+    for name, sub in (("IMAGE_CACHE_DIR", "images"), ("PIXEL_CACHE_DIR", "pixels"), ("EMBED_CACHE_DIR", "embeddings")):
+        env[name] = os.path.join(cache_dir, sub)
+    with open(log_path, "w") as log:
+        proc = subprocess.Popen([sys.executable, "-m", "uvicorn", "app.main:app", "--host", "127.0.0.1",
+                                 "--port", str(port), "--log-level", "warning"],
+                                cwd=_REPO, env=env, stdout=log, stderr=subprocess.STDOUT)
+    deadline = time.monotonic() + ready_timeout_s
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"server exited with {proc.returncode}, see {log_path}")
+        try:
+            if httpx.get(f"http://127.0.0.1:{port}/ready", timeout=2).status_code == 200:
+                return proc
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.5)
+    proc.terminate()
+    raise RuntimeError(f"server not ready after {ready_timeout_s}s, see {log_path}")
+
+
+# ---------- load generation ----------
+
+def _percentiles(ms: List[float]) -> dict:
+    if not ms:
+        return {}
+    a = np.asarray(ms)
+    return {"p50": float(np.percentile(a, 50)), "p95": float(np.percentile(a, 95)),
+            "p99": float(np.percentile(a, 99)), "mean": float(a.mean()), "max": float(a.max())}
+
+
+def _url_errors(body) -> int:
+    if not isinstance(body, list):
+        return 0
+    return sum(1 for r in body if isinstance(r, dict) and r.get("error"))
+
+
+async def _drive(base: str, path: str, batches: List[List[str]], concurrency: int, timeout_s: int, run_id: str):
+    latencies, http_errors, url_errors = [], 0, 0
+    queue: "asyncio.Queue" = asyncio.Queue()
+    for i, b in enumerate(batches):
+        queue.put_nowait((i, b))
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=base, timeout=timeout_s + 30, limits=limits) as client:
+        async def worker(w: int):
+            nonlocal http_errors, url_errors
+            while not queue.empty():
+                i, urls = queue.get_nowait()
+                body = {"urls": urls, "timeout": timeout_s, "user_id": f"{run_id}-{w}"}
+                start = time.perf_counter()
+                try:
+                    resp = await client.post(path, json=body)
+                    latencies.append(1000 * (time.perf_counter() - start))
+                    if resp.status_code != 200:
+                        http_errors += 1
+                    else:
+                        url_errors += _url_errors(resp.json())
+                except httpx.HTTPError:
+                    http_errors += 1
+
+        await asyncio.gather(*(worker(w) for w in range(concurrency)))
+    return latencies, http_errors, url_errors
+
+
+def _stage_delta(before: dict, after: dict, images: int) -> dict:
+    out = {}
+    for stage, a in (after or {}).items():
+        b = (before or {}).get(stage, {"count": 0, "total_s": 0.0})
+        total = a["total_s"] - b["total_s"]
+        out[stage] = {"count": a["count"] - b["count"], "total_s": round(total, 4),
+                      "ms_per_image": round(1000 * total / images, 3) if images else None}
+    return out
+
+
+def _metrics(base: str) -> dict:
+    try:
+        return httpx.get(f"{base}/metrics", timeout=10).json()
+    except (httpx.HTTPError, ValueError):
+        return {}
+
+
+def run_one(base: str, pid: Optional[int], cdn: FakeCDN, next_id: int, endpoint: str,
+            concurrency: int, batch_size: int, requests: int, timeout_s: int, unique: bool) -> tuple:
+    """One endpoint x concurrency x batch size run; returns (report, next unused image id)."""
+    batches = []
+    for _ in range(requests):
+        batches.append(cdn.urls(next_id if unique else 0, batch_size))
+        if unique:
+            next_id += batch_size
+    images = requests * batch_size
+    run_id = f"bench-{endpoint}-{concurrency}x{batch_size}-{next_id}"
+
+    before = _metrics(base).get("stages")
+    cpu0 = _cpu_seconds(pid)
+    cdn0 = cdn.stats()
+    start = time.perf_counter()
+    with _RssSampler(pid) as rss:
+        latencies, http_errors, url_errors = asyncio.run(
+            _drive(base, ENDPOINTS[endpoint], batches, concurrency, timeout_s, run_id))
+    wall = time.perf_counter() - start
+    cpu1 = _cpu_seconds(pid)
+    after = _metrics(base).get("stages")
+    cdn1 = cdn.stats()
+
+    cpu = None if cpu0 is None or cpu1 is None else cpu1 - cpu0
+    report = {
+        "endpoint": endpoint,
+        "concurrency": concurrency,
+        "batch_size": batch_size,
+        "requests": requests,
+        "images": images,
+        "wall_s": round(wall, 3),
+        "latency_ms": _percentiles(latencies),
+        "requests_per_s": requests / wall,
+        "images_per_s": images / wall,
+        "http_errors": http_errors,
+        "url_errors": url_errors,
+        "server_cpu_s": cpu,
+        "server_cpu_util": None if cpu is None else cpu / wall,
+        "server_rss_peak_mb": rss.peak,
+        "stages": _stage_delta(before, after, images),
+        "cdn": {k: cdn1[k] - cdn0[k] for k in cdn1},
+    }
+    return report, next_id
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument("--url", help="benchmark a running server instead of starting one (no CPU/RSS unless --pid)")
+    ap.add_argument("--pid", type=int, help="server pid for CPU/RSS when --url is used")
+    ap.add_argument("--endpoints", default="analyze,evaluate,evaluate_with_window")
+    ap.add_argument("--concurrency", default="1,8", help="comma-separated client concurrency levels")
+    ap.add_argument("--batch-size", default="1,8", help="comma-separated URLs per request")
+    ap.add_argument("--requests", type=int, default=32, help="requests per run")
+    ap.add_argument("--timeout", type=int, default=8, help="request timeout field sent to the app")
+    ap.add_argument("--warm", action="store_true", help="reuse the same image ids (cache hits) instead of new ones")
+    ap.add_argument("--corpus", type=int, default=64, help="distinct synthetic pictures behind the CDN")
+    ap.add_argument("--formats", default="jpg,webp")
+    ap.add_argument("--latency-ms", type=float, default=50.0)
+    ap.add_argument("--jitter-ms", type=float, default=30.0)
+    ap.add_argument("--error-rate", type=float, default=0.0, help="fraction of CDN requests answered 503")
+    ap.add_argument("--missing-rate", type=float, default=0.0, help="fraction of image ids that are 404")
+    ap.add_argument("--ready-timeout", type=float, default=600.0)
+    ap.add_argument("--json", help="write the report here")
+    args = ap.parse_args(argv)
+
+    for e in args.endpoints.split(","):
+        if e not in ENDPOINTS:
+            ap.error(f"unknown endpoint {e!r}, choose from {list(ENDPOINTS)}")
+
+    cdn = FakeCDN(corpus=args.corpus, formats=args.formats.split(","), latency_ms=args.latency_ms,
+                  jitter_ms=args.jitter_ms, error_rate=args.error_rate, missing_rate=args.missing_rate,
+                  unique=not args.warm).start()
+    tmp = tempfile.TemporaryDirectory()
+    proc = None
+    try:
+        if args.url:
+            base, pid = args.url.rstrip("/"), args.pid
+        else:
+            port = _free_port()
+            log_path = os.path.join(tmp.name, "server.log")
+            proc = _start_server(port, tmp.name, log_path, args.ready_timeout)
+            base, pid = f"http://127.0.0.1:{port}", proc.pid
+
+        report = {
+            "started": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "git_rev": _git_rev(),
+            "python": sys.version.split()[0],
+            "cpu_count": os.cpu_count(),
+            "server": {"url": base, "ready": httpx.get(f"{base}/ready", timeout=10).json(),
+                       "rss_mb_idle": _rss_mb(pid)},
+            "env": {k: v for k, v in os.environ.items()
+                    if k.startswith(("CLIP_", "CPU_", "MODEL_", "DECODE_", "FAST_", "IO_", "INFER_", "TORCH_"))},
+            "cdn": {"corpus": args.corpus, "formats": args.formats, "latency_ms": args.latency_ms,
+                    "jitter_ms": args.jitter_ms, "error_rate": args.error_rate,
+                    "missing_rate": args.missing_rate, "unique_images": not args.warm},
+            "runs": [],
+        }
+        next_id = 0
+        for endpoint in args.endpoints.split(","):
+            for conc in _ints(args.concurrency):
+                for bs in _ints(args.batch_size):
+                    run, next_id = run_one(base, pid, cdn, next_id, endpoint, conc, bs,
+                                           args.requests, args.timeout, unique=not args.warm)
+                    report["runs"].append(run)
+                    lat = run["latency_ms"]
+                    print(f"{endpoint:<22} c={conc:<3} b={bs:<3} p50={lat.get('p50', 0):8.1f}ms "
+                          f"p99={lat.get('p99', 0):8.1f}ms {run['images_per_s']:7.1f} img/s "
+                          f"errors={run['http_errors']}+{run['url_errors']}", file=sys.stderr)
+        report["server"]["rss_mb_end"] = _rss_mb(pid)
+    finally:
+        if proc is not None:
+            proc.terminate()
+            try:
+                proc.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+        cdn.stop()
+        tmp.cleanup()
+
+    print(json.dumps(report, indent=2))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
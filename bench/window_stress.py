@@ -0,0 +1,131 @@
+"""
+Throughput and memory of the in-memory window store under many users and thread contention.
+
+Pushes random probabilities for random user ids from several threads and reports pushes/s,
+resident users, RSS growth and bytes per resident user. --store legacy runs the previous
+implementation (one threading.Lock + deque per user, never evicted, re-summed on every push)
+as a baseline.
+
+    python -m bench.window_stress --users 2000000 --pushes 4000000 --threads 16
+    python -m bench.window_stress --store legacy --users 2000000 --pushes 4000000 --threads 16
+"""
+import argparse
+import gc
+import json
+import random
+import sys
+import threading
+import time
+from collections import defaultdict, deque
+
+from app import window
+
+
+class LegacyWindowStore(window.WindowStore):
+    """The pre-eviction store: per-user Lock and deque in defaultdicts, kept forever."""
+
+    def __init__(self):
+        self._locks = defaultdict(lambda: threading.Lock())
+        self._windows = defaultdict(lambda: deque(maxlen=window.WINDOW_SIZE))
+
+    def push_and_decide(self, user_id, prob):
+        with self._locks[user_id]:
+            w = self._windows[user_id]
+            if prob is not None:
+                w.append(float(prob))
+            window_list = list(w)
+            cumulative, intervention = window.decide(window_list)
+            return window_list, cumulative, intervention
+
+    def snapshot(self, user_id):
+        with self._locks[user_id]:
+            return list(self._windows.get(user_id, []))
+
+    def reset(self, user_id):
+        with self._locks[user_id]:
+            self._windows.pop(user_id, None)
+
+    def stats(self):
+        return {"store": "legacy", "users": len(self._windows)}
+
+
+def _rss_mb() -> float:
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run(store: str = "memory", users: int = 1_000_000, pushes: int = 2_000_000, threads: int = 8,
+        max_users: int = window.WINDOW_MAX_USERS, stripes: int = window.WINDOW_LOCK_STRIPES,
+        seed: int = 0) -> dict:
+    if store == "legacy":
+        s = LegacyWindowStore()
+    else:
+        s = window.MemoryWindowStore(max_users=max_users, idle_ttl_s=0, stripes=stripes)
+    per_thread = pushes // threads
+    mismatches = []
+
+    def worker(t: int):
+        rng = random.Random(seed * 1000 + t)
+        push, bad = s.push_and_decide, 0
+        for _ in range(per_thread):
+            w, cumulative, intervention = push(f"anon-{rng.randrange(users)}", rng.random())
+            if intervention != (cumulative > window.THRESHOLD) or len(w) > window.WINDOW_SIZE:
+                bad += 1
+        mismatches.append(bad)
+
+    gc.collect()
+    rss0 = _rss_mb()
+    workers = [threading.Thread(target=worker, args=(t,)) for t in range(threads)]
+    start = time.perf_counter()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    elapsed = time.perf_counter() - start
+    gc.collect()
+    rss1 = _rss_mb()
+
+    stats = s.stats()
+    resident = stats["users"]
+    return {
+        "store": store,
+        "threads": threads,
+        "users": users,
+        "pushes": per_thread * threads,
+        "pushes_per_s": per_thread * threads / elapsed,
+        "resident_users": resident,
+        "rss_growth_mb": rss1 - rss0,
+        "bytes_per_user": (rss1 - rss0) * 1024 * 1024 / resident if resident else None,
+        "inconsistent_results": sum(mismatches),
+        "stats": stats,
+    }
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument("--store", choices=("memory", "legacy"), default="memory")
+    ap.add_argument("--users", type=int, default=1_000_000, help="distinct user ids drawn from")
+    ap.add_argument("--pushes", type=int, default=2_000_000)
+    ap.add_argument("--threads", type=int, default=8)
+    ap.add_argument("--max-users", type=int, default=window.WINDOW_MAX_USERS)
+    ap.add_argument("--stripes", type=int, default=window.WINDOW_LOCK_STRIPES)
+    ap.add_argument("--json", help="write the report here")
+    args = ap.parse_args(argv)
+
+    report = run(args.store, args.users, args.pushes, args.threads, args.max_users, args.stripes)
+    print(json.dumps(report, indent=2))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+    return 0 if report["inconsistent_results"] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())